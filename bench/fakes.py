@@ -0,0 +1,391 @@
+"""
+In-process stand-ins for bluepy, paho-mqtt and pyuv.
+
+install() registers the fake modules in sys.modules, so lib.* can be imported and
+exercised on a plain Linux box without a Bluetooth radio, a broker or libuv.
+It must be called before anything from lib is imported.
+"""
+import sys
+import struct
+import types
+from collections import deque
+
+
+# -------------------------------------------------------------------- bluepy.btle
+
+class BTLEException(Exception):
+    DISCONNECTED = 1
+    COMM_ERROR = 2
+    INTERNAL_ERROR = 3
+    GATT_ERROR = 4
+    MGMT_ERROR = 5
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
+
+
+class UUID(object):
+    def __init__(self, val):
+        self._val = str(val)
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(self._val)
+
+    def __str__(self):
+        return self._val
+
+    def getCommonName(self):
+        return self._val
+
+
+# Canned responses of SBrick protocol 17 query opcodes
+QUERY_RESPONSES = {
+    0x03: struct.pack('<B', 1),
+    0x09: struct.pack('<B', 50),
+    0x0A: struct.pack('<6B', 0x88, 0x6B, 0x0F, 0x23, 0x7B, 0x81),
+    0x0E: struct.pack('<B', 5),
+    0x15: struct.pack('<H', 26000),
+    0x20: struct.pack('<H', 255),
+    0x22: struct.pack('<7B', 0, 0, 0, 0, 0, 0, 0),
+    0x23: struct.pack('<B', 0),
+    0x25: struct.pack('<3H', 24, 40, 0),
+    0x27: struct.pack('<B', 1),
+    0x28: struct.pack('<I', 42),
+    0x29: struct.pack('<I', 123456),
+}
+
+ADC_RESPONSES = {
+    0x08: struct.pack('<H', 21600),
+    0x09: struct.pack('<H', 22000),
+}
+
+
+class Characteristic(object):
+    def __init__(self, uuid, properties='WRITE READ'):
+        self.uuid = UUID(uuid)
+        self._properties = properties
+        self._response = b''
+        self.writes = 0
+
+    def write(self, val, withResponse=False):
+        self.writes += 1
+        opcode = val[0]
+        if 0x0F == opcode:
+            self._response = ADC_RESPONSES.get(val[1], b'\x00\x00')
+        else:
+            self._response = QUERY_RESPONSES.get(opcode, b'')
+
+    def read(self):
+        return self._response
+
+    def supportsRead(self):
+        return True
+
+    def propertiesToString(self):
+        return self._properties
+
+    def __str__(self):
+        return 'Characteristic <{}>'.format(self.uuid)
+
+
+class Service(object):
+    def __init__(self, uuid, chars):
+        self.uuid = UUID(uuid)
+        self._chars = chars
+
+    def getCharacteristics(self, forUUID=None):
+        return self._chars
+
+    def __str__(self):
+        return 'Service <uuid={}>'.format(self.uuid)
+
+
+RCC_UUID = '02b8cbcc-0e25-4bda-8790-a15f53e6010f'
+RCS_UUID = '4dc591b0-857c-41de-b5f1-15abda665b0c'
+
+
+class Peripheral(object):
+    def __init__(self, deviceAddr=None, addrType='public', iface=None):
+        self.addr = deviceAddr
+        self.iface = iface
+        self._rcc = Characteristic(RCC_UUID)
+        self._services = [Service(RCS_UUID, [self._rcc])]
+        self.connected = False
+
+    def connect(self, addr, addrType='public', iface=None):
+        self.addr = addr
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+    def getCharacteristics(self, startHnd=1, endHnd=0xFFFF, uuid=None):
+        return [self._rcc]
+
+    def getServices(self):
+        return self._services
+
+
+class DefaultDelegate(object):
+    def __init__(self):
+        pass
+
+    def handleDiscovery(self, dev, isNewDev, isNewData):
+        pass
+
+
+class Scanner(object):
+    def __init__(self, iface=0):
+        self.iface = iface
+        self._delegate = None
+
+    def withDelegate(self, delegate):
+        self._delegate = delegate
+        return self
+
+    def scan(self, timeout=10):
+        return []
+
+
+# -------------------------------------------------------------------- paho.mqtt.client
+
+MQTTv31 = 3
+MQTTv311 = 4
+MQTT_ERR_SUCCESS = 0
+
+
+def topic_matches_sub(sub, topic):
+    sub_levels = sub.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(sub_levels):
+        if '#' == level:
+            return True
+        if i >= len(topic_levels):
+            return False
+        if '+' != level and level != topic_levels[i]:
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+
+class MQTTMessage(object):
+    __slots__ = ('topic', 'payload', 'qos', 'retain')
+
+    def __init__(self, topic, payload, qos=0, retain=False):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+
+
+class MQTTMessageInfo(object):
+    rc = MQTT_ERR_SUCCESS
+    mid = 0
+
+    def wait_for_publish(self):
+        pass
+
+    def is_published(self):
+        return True
+
+
+class FakeSocket(object):
+    def fileno(self):
+        return -1
+
+
+class FakeBroker(object):
+    """ Synchronous in-memory broker. Messages are delivered inside publish() """
+
+    def __init__(self):
+        self._clients = []
+        self._retained = {}
+
+    def attach(self, client):
+        self._clients.append(client)
+
+    def detach(self, client):
+        if client in self._clients:
+            self._clients.remove(client)
+
+    def route(self, topic, payload, retain):
+        if retain:
+            self._retained[topic] = payload
+        for client in list(self._clients):
+            client._deliver(topic, payload)
+
+    def retained(self, topic):
+        return self._retained.get(topic)
+
+
+class Client(object):
+    # Every fake client connects to this broker unless another one is assigned
+    broker = FakeBroker()
+
+    def __init__(self, client_id='', clean_session=True, userdata=None, protocol=MQTTv311):
+        self._client_id = client_id
+        self._userdata = userdata
+        self._subscriptions = set()
+        self._connected = False
+        self.on_message = None
+        self.on_connect = None
+        self.published = deque(maxlen=1024)
+
+    def username_pw_set(self, username, password=None):
+        pass
+
+    def connect(self, host, port=1883, keepalive=60):
+        self.broker.attach(self)
+        self._connected = True
+        if self.on_connect:
+            self.on_connect(self, self._userdata, {}, 0)
+        return MQTT_ERR_SUCCESS
+
+    def disconnect(self):
+        self.broker.detach(self)
+        self._connected = False
+        return MQTT_ERR_SUCCESS
+
+    def socket(self):
+        return FakeSocket() if self._connected else None
+
+    def subscribe(self, topic, qos=0):
+        self._subscriptions.add(topic)
+        return (MQTT_ERR_SUCCESS, 0)
+
+    def unsubscribe(self, topic):
+        self._subscriptions.discard(topic)
+        return (MQTT_ERR_SUCCESS, 0)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        self.published.append((topic, payload))
+        self.broker.route(topic, payload, retain)
+        return MQTTMessageInfo()
+
+    def _deliver(self, topic, payload):
+        if not self.on_message:
+            return
+        for sub in list(self._subscriptions):
+            if topic_matches_sub(sub, topic):
+                self.on_message(self, self._userdata, MQTTMessage(topic, payload))
+                return
+
+    def loop_read(self, max_packets=1):
+        return MQTT_ERR_SUCCESS
+
+    def loop_write(self, max_packets=1):
+        return MQTT_ERR_SUCCESS
+
+    def loop_misc(self):
+        return MQTT_ERR_SUCCESS
+
+    def want_write(self):
+        return False
+
+
+# -------------------------------------------------------------------- pyuv
+
+UV_READABLE = 1
+UV_WRITABLE = 2
+
+
+class Loop(object):
+    _default = None
+
+    @classmethod
+    def default_loop(cls):
+        if None == cls._default:
+            cls._default = cls()
+        return cls._default
+
+    def update_time(self):
+        pass
+
+    def run(self, mode=0):
+        return False
+
+    def stop(self):
+        pass
+
+
+class Handle(object):
+    def __init__(self, loop, *args):
+        self.loop = loop
+        self.data = None
+        self.active = False
+
+    def start(self, *args):
+        self.active = True
+
+    def stop(self):
+        self.active = False
+
+    def close(self, callback=None):
+        self.active = False
+
+
+class Timer(Handle):
+    pass
+
+
+class Poll(Handle):
+    pass
+
+
+class Signal(Handle):
+    pass
+
+
+class Async(Handle):
+    def __init__(self, loop, callback=None):
+        Handle.__init__(self, loop)
+        self._callback = callback
+
+    def send(self):
+        if self._callback:
+            self._callback(self)
+
+
+# -------------------------------------------------------------------- install
+
+def _module(name, attrs):
+    mod = types.ModuleType(name)
+    for attr in attrs:
+        setattr(mod, attr, globals()[attr])
+    return mod
+
+
+def install():
+    if getattr(sys.modules.get('bluepy.btle'), '_sbrick_fake', False):
+        return
+
+    btle = _module('bluepy.btle', ['BTLEException', 'UUID', 'Peripheral', 'Scanner', 'DefaultDelegate'])
+    bluepy = types.ModuleType('bluepy')
+    bluepy.btle = btle
+
+    client = _module('paho.mqtt.client', ['Client', 'MQTTMessage', 'MQTTMessageInfo', 'MQTTv31', 'MQTTv311',
+                                          'MQTT_ERR_SUCCESS', 'topic_matches_sub'])
+    paho = types.ModuleType('paho')
+    mqtt = types.ModuleType('paho.mqtt')
+    paho.mqtt = mqtt
+    mqtt.client = client
+
+    pyuv = _module('pyuv', ['Loop', 'Timer', 'Poll', 'Signal', 'Async', 'UV_READABLE', 'UV_WRITABLE'])
+
+    for mod in (btle, client, pyuv):
+        mod._sbrick_fake = True
+
+    sys.modules.update({
+        'bluepy': bluepy,
+        'bluepy.btle': btle,
+        'paho': paho,
+        'paho.mqtt': mqtt,
+        'paho.mqtt.client': client,
+        'pyuv': pyuv,
+    })
@@ -0,0 +1,248 @@
+"""
+Component micro-benchmarks of the SBrick server hot path.
+
+Runs on a plain Linux box: bluepy, paho-mqtt and pyuv are replaced by the stand-ins
+of bench/fakes.py. Results can be saved and compared against a previous run.
+
+    $ python3 -m bench.run_bench --output baseline.json
+    $ python3 -m bench.run_bench --compare baseline.json --threshold 10
+"""
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+
+from bench import fakes
+fakes.install()
+
+from lib.m2mipc import M2mipc
+from lib.sbrick_api import SbrickAPI
+from lib.sbrick_protocol import SbrickProtocol
+from lib.sbrick_command import IngressDecoder, drive_frame
+
+SBRICK_MAC = '11:22:33:44:55:66'
+
+
+def _logger():
+    logger = logging.getLogger('SBrick_Bench')
+    logger.addHandler(logging.NullHandler())
+    logger.setLevel(logging.WARNING)
+    logger.propagate = False
+    return logger
+
+
+def _sbrick():
+    sbrick = SbrickAPI(logger=_logger(), dev_mac=SBRICK_MAC)
+    sbrick.connect()
+    return sbrick
+
+
+class Benchmarks(object):
+    """
+    Every bench_* method runs its operation n times. An optional setup_* method prepares it and
+    teardown_* cleans up, both outside the timed region.
+    """
+
+    def __init__(self):
+        self._protocol = SbrickProtocol()
+        self._sbrick = None
+
+
+    def bench_m2mipc_dispatch_sp(self, n):
+        m2m = M2mipc('bench_sp', fakes.Loop())
+        m2m.register_subscribe(self._protocol.gen_sp_topic('drive'), None, lambda client, userdata, topic, msg: None)
+        m2m.register_subscribe(self._protocol.gen_sp_topic('stop'), None, lambda client, userdata, topic, msg: None)
+        payload = json.dumps(self._protocol.gen_sp_drive(SBRICK_MAC, '00', '00', 'f0', 5)).encode('utf-8')
+        msg = fakes.MQTTMessage(self._protocol.gen_sp_topic('drive'), payload)
+        on_message = m2m._on_mqtt_message
+        for _ in range(n):
+            on_message(m2m, m2m, msg)
+
+
+    def bench_m2mipc_dispatch_rr(self, n):
+        m2m = M2mipc('bench_rr', fakes.Loop())
+        topic = self._protocol.gen_rr_topic('get_adc')
+        response = self._protocol.gen_rr_get_adc_response(SbrickProtocol.CODE_SUCCESS, {'temperature': 30.0, 'voltage': 8.6})
+        m2m.register_server(topic, None, lambda request, userdata, json_msg: request.send_response(response))
+        payload = json.dumps({
+            'status': 0,
+            'req_msg': json.dumps(self._protocol.gen_rr_request(SBRICK_MAC)),
+            'resp_topic': topic.replace('rr', 'rr_resp') + '/12345'
+        }).encode('utf-8')
+        msg = fakes.MQTTMessage(topic + '/12345', payload)
+        on_message = m2m._on_mqtt_message
+        for _ in range(n):
+            on_message(m2m, m2m, msg)
+
+
+    def bench_protocol_sp_drive_payload(self, n):
+        protocol = self._protocol
+        for _ in range(n):
+            protocol.gen_sp_topic('drive')
+            json.dumps(protocol.gen_sp_drive(SBRICK_MAC, '00', '00', 'f0', 5))
+
+
+    def bench_protocol_drive_hex(self, n):
+        # how a drive frame was built from its hex strings before the pre-packed frames
+        for _ in range(n):
+            bytes.fromhex(SbrickAPI.drive_hex + '00' + '01' + 'f0')
+
+
+    def bench_protocol_drive_frame(self, n):
+        for _ in range(n):
+            drive_frame('00', '01', 'f0')
+
+
+    def bench_ingress_decode_drive(self, n):
+        decode = IngressDecoder().decode_drive
+        msg = self._protocol.gen_sp_drive(SBRICK_MAC, '00', '01', 'F0', 5)
+        for _ in range(n):
+            decode(msg)
+
+
+    def bench_ingress_reject_drive(self, n):
+        decode = IngressDecoder().decode_drive
+        msg = self._protocol.gen_sp_drive(SBRICK_MAC, '07', '01', 'f0', 5)
+        for _ in range(n):
+            decode(msg)
+
+
+    def setup_sbrick_drive_overwrite(self):
+        self._sbrick = _sbrick()
+        self._sbrick.drive(channel='00', direction='00', power='f0', exec_time=60)
+
+
+    def bench_sbrick_drive_overwrite(self, n):
+        # only the overwrite of a running channel, stopping it joins a drive thread in its refresh sleep
+        drive = self._sbrick.drive
+        for i in range(n):
+            drive(channel='00', direction='01', power='f0', exec_time=60)
+
+
+    def teardown_sbrick_drive_overwrite(self):
+        self._sbrick.stop(channels=['00'])
+        self._sbrick = None
+
+
+    def bench_sbrick_get_info_general(self, n):
+        sbrick = _sbrick()
+        for _ in range(n):
+            sbrick.get_info_general()
+
+
+    def bench_sbrick_get_info_adc(self, n):
+        sbrick = _sbrick()
+        for _ in range(n):
+            sbrick.get_info_adc()
+
+
+    def names(self):
+        return sorted(name[len('bench_'):] for name in dir(self) if name.startswith('bench_'))
+
+
+    def run(self, name, number, repeat):
+        func = getattr(self, 'bench_' + name)
+        setup = getattr(self, 'setup_' + name, None)
+        teardown = getattr(self, 'teardown_' + name, None)
+        timings = []
+        for _ in range(repeat):
+            if setup:
+                setup()
+            try:
+                start = time.perf_counter()
+                func(number)
+                timings.append(time.perf_counter() - start)
+            finally:
+                if teardown:
+                    teardown()
+
+        best = min(timings) / number
+        return {
+            'number': number,
+            'repeat': repeat,
+            'best_us': best * 1e6,
+            'mean_us': sum(timings) / len(timings) / number * 1e6,
+            'ops_per_sec': 1.0 / best if best > 0 else float('inf')
+        }
+
+
+
+# Number of iterations per repeat. Benchmarks which spawn threads run fewer iterations.
+NUMBERS = {
+    'sbrick_drive_overwrite': 500,
+    'sbrick_get_info_general': 2000,
+    'sbrick_get_info_adc': 5000,
+}
+DEFAULT_NUMBER = 20000
+
+
+def compare(results, baseline, threshold):
+    """ Print the change of every benchmark and return the names that regressed more than threshold percent """
+    regressions = []
+    print('{:<32} {:>12} {:>12} {:>9}'.format('benchmark', 'baseline_us', 'current_us', 'change'))
+    for name, current in sorted(results['benchmarks'].items()):
+        base = baseline['benchmarks'].get(name)
+        if not base:
+            print('{:<32} {:>12} {:>12.3f} {:>9}'.format(name, '-', current['best_us'], 'new'))
+            continue
+        change = (current['best_us'] - base['best_us']) / base['best_us'] * 100
+        flag = ' !' if change > threshold else ''
+        print('{:<32} {:>12.3f} {:>12.3f} {:>+8.1f}%{}'.format(name, base['best_us'], current['best_us'], change, flag))
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='SBrick hot-path micro-benchmarks')
+    parser.add_argument('names', nargs='*', help='benchmarks to run. Default is all')
+    parser.add_argument('--list', action='store_true', help='List benchmarks and exit')
+    parser.add_argument('--repeat', type=int, default=5, help='Repeat every benchmark N times and keep the best. Default is 5')
+    parser.add_argument('--scale', type=float, default=1.0, help='Scale the number of iterations. Default is 1.0')
+    parser.add_argument('--output', default=None, help='Save results as JSON to this file')
+    parser.add_argument('--compare', default=None, help='Compare against a JSON file saved by --output')
+    parser.add_argument('--threshold', type=float, default=10.0, help='Regression threshold in percent for --compare. Default is 10')
+    args = parser.parse_args(argv)
+
+    benchmarks = Benchmarks()
+    if args.list:
+        print('\n'.join(benchmarks.names()))
+        return 0
+
+    names = args.names or benchmarks.names()
+    unknown = set(names) - set(benchmarks.names())
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'benchmarks': {}
+    }
+    for name in names:
+        number = max(1, int(NUMBERS.get(name, DEFAULT_NUMBER) * args.scale))
+        result = benchmarks.run(name, number, args.repeat)
+        results['benchmarks'][name] = result
+        print('{:<32} {:>10.3f} us/op {:>12.0f} op/s'.format(name, result['best_us'], result['ops_per_sec']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print('')
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('Regressed: {}'.format(', '.join(regressions)))
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+import sys
+import asyncio
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+UV_READABLE = 1
+UV_WRITABLE = 2
+
+
+def uv_for(loop):
+    """ Handle module of a loop: this module for an asyncio Loop, pyuv for a pyuv.Loop """
+    if isinstance(loop, Loop):
+        return sys.modules[__name__]
+    import pyuv
+    return pyuv
+
+
+
+class Loop(object):
+    """
+    The subset of pyuv.Loop the server uses, run by one asyncio event loop.
+
+    Timer, Poll, Async and Signal below take a Loop like their pyuv namesakes, so M2mipc and the
+    server run on it unchanged. run_blocking() confines blocking work (BLE I/O) to a thread pool
+    and hands its result back to the loop thread.
+    """
+    _default = None
+
+    def __init__(self, executor_workers=8, logger=None):
+        self._aio = asyncio.new_event_loop()
+        self._executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix='ble')
+        self._logger = logger if logger else logging.getLogger('SBrick_Server')
+
+
+    @classmethod
+    def default_loop(cls):
+        if None == cls._default:
+            cls._default = cls()
+        return cls._default
+
+
+    @property
+    def aio(self):
+        return self._aio
+
+
+    def update_time(self):
+        pass
+
+
+    def now(self):
+        return self._aio.time()
+
+
+    def run(self, mode=None):
+        asyncio.set_event_loop(self._aio)
+        self._aio.run_forever()
+        return True
+
+
+    def stop(self):
+        # a stop from another thread must wake the loop up
+        self._aio.call_soon_threadsafe(self._aio.stop)
+
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._aio.close()
+
+
+    def call_soon_threadsafe(self, callback, *args):
+        self._aio.call_soon_threadsafe(callback, *args)
+
+
+    def call_later(self, delay, callback, *args):
+        """ Loop thread only """
+        return self._aio.call_later(delay, callback, *args)
+
+
+    def run_blocking(self, func, done=None):
+        """
+        Run func() in the executor. Callable from any thread; done(result) is called on the loop
+        thread, with None when func raised (SbrickAPI exits on unrecoverable bluepy errors).
+        """
+        future = self._executor.submit(func)
+        if done:
+            future.add_done_callback(lambda f: self._aio.call_soon_threadsafe(self._complete, f, done))
+        else:
+            future.add_done_callback(self._log_failure)
+        return future
+
+
+    def _log_failure(self, future):
+        try:
+            return future.result()
+        except BaseException as e:
+            self._logger.error('Executor job failed: {!r}'.format(e))
+            return None
+
+
+    def _complete(self, future, done):
+        done(self._log_failure(future))
+
+
+
+class LoopProxy(object):
+    """
+    Forward method calls of obj to the loop thread, e.g. send_response() of a ServerSession handled in the executor.
+    loop is a Loop or an AsyncCaller.
+    """
+
+    def __init__(self, loop, obj):
+        self._loop = loop
+        self._obj = obj
+
+
+    def __getattr__(self, name):
+        method = getattr(self._obj, name)
+        return lambda *args: self._loop.call_soon_threadsafe(method, *args)
+
+
+
+class AsyncCaller(object):
+    """ call_soon_threadsafe() of Loop for a pyuv loop: callbacks queued by any thread run on the loop thread, in order """
+
+    def __init__(self, loop):
+        self._jobs = deque()
+        self._async = uv_for(loop).Async(loop, self._on_async)
+
+
+    def call_soon_threadsafe(self, callback, *args):
+        self._jobs.append((callback, args))
+        self._async.send()
+
+
+    def _on_async(self, handle):
+        jobs = self._jobs
+        while jobs:
+            callback, args = jobs.popleft()
+            callback(*args)
+
+
+    def close(self):
+        self._on_async(self._async)
+        self._async.close()
+
+
+
+class Handle(object):
+    def __init__(self, loop):
+        self.loop = loop
+        self.data = None
+
+
+    def close(self, callback=None):
+        self.stop()
+        if callback:
+            callback(self)
+
+
+
+class Timer(Handle):
+    def __init__(self, loop):
+        Handle.__init__(self, loop)
+        self._callback = None
+        self._repeat = 0
+        self._handle = None
+
+
+    def start(self, callback, timeout, repeat):
+        self.stop()
+        self._callback = callback
+        self._repeat = repeat
+        self._handle = self.loop.call_later(timeout, self._fire)
+
+
+    def again(self):
+        self.stop()
+        if self._repeat:
+            self._handle = self.loop.call_later(self._repeat, self._fire)
+
+
+    def stop(self):
+        if self._handle:
+            self._handle.cancel()
+        self._handle = None
+
+
+    def _fire(self):
+        self._handle = self.loop.call_later(self._repeat, self._fire) if self._repeat else None
+        self._callback(self)
+
+
+
+class Poll(Handle):
+    def __init__(self, loop, fd):
+        Handle.__init__(self, loop)
+        self._fd = fd
+        self._events = 0
+        self._callback = None
+
+
+    def start(self, events, callback):
+        self.stop()
+        self._events = events
+        self._callback = callback
+        if events & UV_READABLE:
+            self.loop.aio.add_reader(self._fd, self._fire, UV_READABLE)
+        if events & UV_WRITABLE:
+            self.loop.aio.add_writer(self._fd, self._fire, UV_WRITABLE)
+
+
+    def stop(self):
+        if self._events & UV_READABLE:
+            self.loop.aio.remove_reader(self._fd)
+        if self._events & UV_WRITABLE:
+            self.loop.aio.remove_writer(self._fd)
+        self._events = 0
+
+
+    def _fire(self, events):
+        self._callback(self, events, None)
+
+
+
+class Async(Handle):
+    def __init__(self, loop, callback):
+        Handle.__init__(self, loop)
+        self._callback = callback
+        self._pending = False
+        self._closed = False
+
+
+    def send(self):
+        # like uv_async_send, sends before the callback runs are coalesced
+        if self._pending:
+            return
+        self._pending = True
+        self.loop.call_soon_threadsafe(self._fire)
+
+
+    def stop(self):
+        self._closed = True
+
+
+    def _fire(self):
+        self._pending = False
+        if not self._closed:
+            self._callback(self)
+
+
+
+class Signal(Handle):
+    def __init__(self, loop):
+        Handle.__init__(self, loop)
+        self._signum = None
+
+
+    def start(self, callback, signum):
+        self.stop()
+        self._signum = signum
+        self.loop.aio.add_signal_handler(signum, callback, self, signum)
+
+
+    def stop(self):
+        if None != self._signum:
+            self.loop.aio.remove_signal_handler(self._signum)
+        self._signum = None
@@ -0,0 +1,303 @@
+import os
+import socket
+import struct
+
+# libuv, or the asyncio loop of --engine asyncio
+from lib.aio_uv import uv_for, UV_READABLE, UV_WRITABLE
+
+# mqtt client, only for topic matching
+import paho.mqtt.client as Mqtt
+
+from lib.m2mipc import M2mipc
+
+PUBLISH = 1
+SUBSCRIBE = 2
+UNSUBSCRIBE = 3
+
+FLAG_RETAIN = 0x01
+
+# frame type, flags, topic length, payload length
+HEADER = struct.Struct('!BBHI')
+
+
+def _frame(frame_type, topic, payload=b'', flags=0):
+    encoded = topic.encode('utf-8')
+    return HEADER.pack(frame_type, flags, len(encoded), len(payload)) + encoded + payload
+
+
+def _payload_bytes(payload):
+    if None == payload:
+        return b''
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    return bytes(payload)
+
+
+
+class FramedSocket(object):
+    """
+    Non-blocking Unix stream socket driven by a pyuv.Poll, carrying length-prefixed frames.
+
+    on_frame(frame_type, flags, topic, payload) is called from the event loop for every complete
+    frame, on_close() once when the peer hangs up.
+    """
+
+    def __init__(self, loop, sock, on_frame, on_close):
+        sock.setblocking(False)
+        self._sock = sock
+        self._on_frame = on_frame
+        self._on_close = on_close
+        self._inbuf = bytearray()
+        self._outbuf = bytearray()
+        self._writing = False
+        self.subscriptions = set()
+        self._poll = uv_for(loop).Poll(loop, sock.fileno())
+        self._poll.start(UV_READABLE, self._on_uv_poll)
+
+
+    @property
+    def closed(self):
+        return None == self._sock
+
+
+    def send(self, frame):
+        if self.closed:
+            return
+        pending = bool(self._outbuf)
+        self._outbuf.extend(frame)
+        if not pending:
+            self._flush()
+
+
+    def close(self):
+        if self.closed:
+            return
+        self._poll.stop()
+        self._poll.close()
+        self._sock.close()
+        self._sock = None
+        self._on_close()
+
+
+    def _on_uv_poll(self, handle, events, errorno):
+        if events & UV_READABLE:
+            self._on_readable()
+        if not self.closed and events & UV_WRITABLE:
+            self._flush()
+
+
+    def _on_readable(self):
+        try:
+            data = self._sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = None
+        if not data:
+            self.close()
+            return
+
+        buf = self._inbuf
+        buf.extend(data)
+        while len(buf) >= HEADER.size:
+            frame_type, flags, topic_length, payload_length = HEADER.unpack_from(buf, 0)
+            end = HEADER.size + topic_length + payload_length
+            if len(buf) < end:
+                return
+            topic = buf[HEADER.size:HEADER.size + topic_length].decode('utf-8')
+            payload = bytes(buf[HEADER.size + topic_length:end])
+            del buf[:end]
+            self._on_frame(frame_type, flags, topic, payload)
+            if self.closed:
+                return
+
+
+    def _flush(self):
+        try:
+            sent = self._sock.send(self._outbuf)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self.close()
+            return
+        del self._outbuf[:sent]
+        writing = bool(self._outbuf)
+        if writing != self._writing:
+            self._writing = writing
+            self._poll.start(UV_READABLE | (UV_WRITABLE if writing else 0), self._on_uv_poll)
+
+
+
+class LocalIpcServer(object):
+    """
+    Unix domain socket endpoint of a M2mipc, for clients on the same host.
+
+    A local client sees the server as a broker holding only the server's topics: its publishes are
+    dispatched straight to the sp subscribers and rr servers registered on the M2mipc, and everything
+    the M2mipc publishes (rr responses, retained states, telemetry, metrics) is delivered to the
+    local clients subscribed to it, retained topics included. Responses to a local request only go
+    back to the requesting client. Nothing of the local traffic passes through the MQTT broker.
+    """
+
+    def __init__(self, logger, loop, m2mipc, path):
+        self._logger = logger
+        self._loop = loop
+        self._m2mipc = m2mipc
+        self._path = path
+        self._listener = None
+        self._poll = None
+        self._peers = []
+        self._retained = {}
+        self.received = 0
+        self.delivered = 0
+
+
+    @property
+    def path(self):
+        return self._path
+
+
+    def start(self):
+        if os.path.exists(self._path):
+            # left over by a server which did not shut down cleanly
+            os.unlink(self._path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self._path)
+        listener.listen(16)
+        listener.setblocking(False)
+        self._listener = listener
+        self._poll = uv_for(self._loop).Poll(self._loop, listener.fileno())
+        self._poll.start(UV_READABLE, self._on_accept)
+        self._m2mipc.set_local_server(self)
+        self._logger.info('Listen for local clients on {}'.format(self._path))
+
+
+    def stop(self):
+        self._m2mipc.set_local_server(None)
+        for peer in list(self._peers):
+            peer.close()
+        if self._poll:
+            self._poll.stop()
+            self._poll.close()
+        if self._listener:
+            self._listener.close()
+            os.unlink(self._path)
+        self._listener = None
+
+
+    def _on_accept(self, handle, events, errorno):
+        try:
+            sock, addr = self._listener.accept()
+        except OSError:
+            return
+        peer = FramedSocket(self._loop, sock,
+                            lambda frame_type, flags, topic, payload: self._on_frame(peer, frame_type, flags, topic, payload),
+                            lambda: self._peers.remove(peer))
+        self._peers.append(peer)
+        self._logger.debug('Accept local client ({} connected)'.format(len(self._peers)))
+
+
+    def _on_frame(self, peer, frame_type, flags, topic, payload):
+        if PUBLISH == frame_type:
+            self.received += 1
+            self.deliver(topic, payload, flags & FLAG_RETAIN)
+            self._m2mipc.dispatch(topic, payload, client=LocalIpcServer.Responder(self, peer))
+        elif SUBSCRIBE == frame_type:
+            peer.subscriptions.add(topic)
+            for retained_topic, retained in list(self._retained.items()):
+                if Mqtt.topic_matches_sub(topic, retained_topic):
+                    peer.send(_frame(PUBLISH, retained_topic, retained, FLAG_RETAIN))
+        elif UNSUBSCRIBE == frame_type:
+            peer.subscriptions.discard(topic)
+
+
+    def deliver(self, topic, payload, retain=False):
+        """ Send a publish to the local clients subscribed to topic """
+        payload = _payload_bytes(payload)
+        if retain:
+            if payload:
+                self._retained[topic] = payload
+            else:
+                self._retained.pop(topic, None)
+        out = None
+        for peer in self._peers:
+            for sub in peer.subscriptions:
+                if Mqtt.topic_matches_sub(sub, topic):
+                    if None == out:
+                        out = _frame(PUBLISH, topic, payload)
+                    peer.send(out)
+                    self.delivered += 1
+                    break
+
+
+    class Responder(object):
+        """ Stands in for the M2mipc of a server session, so a response goes back to its local client only """
+
+        def __init__(self, server, peer):
+            self._server = server
+            self._peer = peer
+
+        def publish(self, topic, payload=None, qos=0, retain=False):
+            self._peer.send(_frame(PUBLISH, topic, _payload_bytes(payload)))
+            self._server.delivered += 1
+
+
+
+class LocalIpcClient(M2mipc):
+    """
+    M2mipc talking to a LocalIpcServer over its Unix domain socket instead of to a MQTT broker.
+
+    register_subscribe(), register_server(), prepare_request() and publish() keep their M2mipc
+    semantics, so SbrickIpcClient runs unchanged on top of it.
+    """
+
+    def __init__(self, name, uv_loop):
+        super(LocalIpcClient, self).__init__(name, uv_loop)
+        self._conn = None
+
+
+    def connect(self, path):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(path)
+        except OSError:
+            sock.close()
+            raise Exception("Connect to local socket {} failed.".format(path))
+        self._conn = FramedSocket(self._uv_loop, sock, self._on_frame, self._on_close)
+
+
+    def disconnect(self):
+        if self._conn:
+            self._conn.close()
+
+
+    def _on_close(self):
+        self._conn = None
+
+
+    def _on_frame(self, frame_type, flags, topic, payload):
+        if PUBLISH == frame_type:
+            self.dispatch(topic, payload)
+
+
+    def _send(self, frame):
+        if None == self._conn:
+            raise Exception("Local socket is not connected.")
+        self._conn.send(frame)
+
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        self._send(_frame(PUBLISH, topic, _payload_bytes(payload), FLAG_RETAIN if retain else 0))
+
+
+    def publish_many(self, messages):
+        self._send(b''.join(_frame(PUBLISH, topic, _payload_bytes(payload)) for topic, payload in messages))
+
+
+    def subscribe(self, topic, qos=0):
+        self._send(_frame(SUBSCRIBE, topic))
+
+
+    def unsubscribe(self, topic):
+        if self._conn:
+            self._send(_frame(UNSUBSCRIBE, topic))
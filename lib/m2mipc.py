@@ -1,8 +1,8 @@
 import json
 from random import randrange
 
-# libuv
-import pyuv as uv
+# libuv, or the asyncio loop of --engine asyncio
+from lib.aio_uv import uv_for, UV_READABLE, UV_WRITABLE
 
 # mqtt client
 import paho.mqtt.client as Mqtt
@@ -73,7 +73,7 @@ class M2mipc(Mqtt.Client):
                 return REQ_RESP_ERROR
 
             if rr_status == REQ_RESP_DONE and self._timeout > 0:
-                self._timer = uv.Timer(self._client._uv_loop)
+                self._timer = uv_for(self._client._uv_loop).Timer(self._client._uv_loop)
                 self._timer.data = self
                 self._timer.start(self._on_req_timeout, self._timeout, 0)
 
@@ -96,6 +96,8 @@ class M2mipc(Mqtt.Client):
         self._reg_servers = {}
         self._req_waits = []
         self._reg_subscribes = {}
+        # LocalIpcServer sharing the registered handlers with local clients, None when disabled
+        self._local_server = None
 
         super(M2mipc, self).__init__(name, True, self, Mqtt.MQTTv31)
         self.on_message = self._on_mqtt_message
@@ -105,9 +107,11 @@ class M2mipc(Mqtt.Client):
 
         if self.socket():
             loop = self._uv_loop
+            uv = uv_for(loop)
             poll = uv.Poll(loop, self.socket().fileno())
-            poll.start(uv.UV_READABLE, self._on_uv_poll)
+            poll.start(UV_READABLE, self._on_uv_poll)
             self._uv_poll = poll
+            self._uv_writing = False
     
             timer  = uv.Timer(loop)
             timer.start(self._on_uv_timer, 1, 1)
@@ -120,6 +124,38 @@ class M2mipc(Mqtt.Client):
         self._uv_poll.stop()
         self._uv_timer.stop()
 
+    def set_local_server(self, local_server):
+        self._local_server = local_server
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        if self._local_server:
+            self._local_server.deliver(topic, payload, retain)
+        return super(M2mipc, self).publish(topic, payload, qos, retain)
+
+    def publish_many(self, messages):
+        """
+        Publish every (topic, payload) of messages in one write pass. Outside of a callback paho writes
+        each publish to the socket right away, holding its callback mutex makes it only queue them.
+        """
+        batching = self._in_callback_mutex.acquire(False)
+        try:
+            for topic, payload in messages:
+                self.publish(topic, payload)
+        finally:
+            if batching:
+                self._in_callback_mutex.release()
+        # inside a callback the poll handler writes the queue when the callback returns
+        if batching and self.want_write():
+            self.loop_write(100)
+            self._watch_write()
+
+    def _watch_write(self):
+        """ Poll for writable while paho holds data the socket did not take, instead of waiting for the 1 second timer """
+        writing = self.want_write()
+        if writing != self._uv_writing:
+            self._uv_writing = writing
+            self._uv_poll.start(UV_READABLE | (UV_WRITABLE if writing else 0), self._on_uv_poll)
+
     def register_subscribe(self, topic, userdata, on_subscribe):
         subs = self._reg_subscribes
         key = topic
@@ -135,12 +171,14 @@ class M2mipc(Mqtt.Client):
         regs[key] = data
         self.subscribe(server_topic)
 
+    def unregister_subscribe(self, topic):
+        if self._reg_subscribes.pop(topic, None):
+            self.unsubscribe(topic)
+
     def unregister_server(self, topic):
-        regs = self._reg_servers
-        data = regs[topic]
+        data = self._reg_servers.pop(topic, None)
         if data:
             self.unsubscribe(data[2])
-        regs[topic] = None
     
     def prepare_request(self, topic, userdata, resp_handle, timeout=0):
         cookie = self._gen_cookie(topic, userdata, resp_handle, timeout)
@@ -149,10 +187,11 @@ class M2mipc(Mqtt.Client):
 
     def _on_uv_poll(self, handle, events, errorno):
         try:
-            if events & uv.UV_READABLE:
+            if events & UV_READABLE:
                 self.loop_read(100)
             if self.want_write():
                 self.loop_write(100)
+            self._watch_write()
         except KeyboardInterrupt:
             handle.stop()
             self._uv_idle.stop()
@@ -162,20 +201,27 @@ class M2mipc(Mqtt.Client):
             if self.want_write():
                 self.loop_write(100)
             self.loop_misc()
+            self._watch_write()
         except KeyboardInterrupt:
             handle.stop()
             self._uv_poll.stop()
 
     def _on_mqtt_message(self, rr, agent, msg):
+        rr.dispatch(msg.topic, msg.payload)
+
+    def dispatch(self, topic, raw_payload, client=None):
+        """ Handle a message from the broker or, with the client answering it, from a local socket """
+        rr = self
+        agent = self
         try:
-            payload = json.loads(msg.payload.decode("utf-8", "ignore"))
+            payload = json.loads(raw_payload.decode("utf-8", "ignore"))
         except:
             """ Silently drop if json load failed """
             return
 
         """ As a req-resp server, handle incoming requests """
-        for server in rr._matched_server(msg.topic):
-            session = rr._gen_session(server, payload)
+        for server in rr._matched_server(topic):
+            session = rr._gen_session(server, payload, client)
             while REQ_RESP_CONTINUE == session.handle_req():
                 pass
             del session
@@ -183,7 +229,7 @@ class M2mipc(Mqtt.Client):
             return
 
         """ As a req-resp client, handle respones from server """
-        for cookie in rr._matched_response(msg.topic):
+        for cookie in rr._matched_response(topic):
 
             cookie.handle_resp(payload['status'], payload['resp_msg'])
 
@@ -196,15 +242,19 @@ class M2mipc(Mqtt.Client):
             return
 
         """ As a subscribe client, handle subscriber """
-        for subs in rr._match_subscriber(msg.topic):
-            subs[1](rr, agent, msg.topic, payload)
+        for subs in rr._match_subscriber(topic):
+            subs[1](rr, agent, topic, payload)
 
             return
 
     def _match_subscriber(self, sub_topic):
         subs = self._reg_subscribes
+        # most subscriptions have no wildcard, skip the scan of every per-brick topic
+        data = subs.get(sub_topic)
+        if data:
+            return [data]
         matched = []
-        for topic, data in subs.items():
+        for topic, data in list(subs.items()):
             if Mqtt.topic_matches_sub(topic, sub_topic):
                 matched.append(data)
 
@@ -212,16 +262,20 @@ class M2mipc(Mqtt.Client):
 
     def _matched_server(self, req_topic):
         regs = self._reg_servers
+        # a request topic is the registered topic plus a random level
+        data = regs.get(req_topic.rsplit('/', 1)[0])
+        if data:
+            return [data]
         matched = []
-        for topic, data in regs.items():
+        for topic, data in list(regs.items()):
             if Mqtt.topic_matches_sub(data[2], req_topic):
                 matched.append(data)
 
         return matched
 
-    def _gen_session(self, server, msg):
+    def _gen_session(self, server, msg, client=None):
         return self.ServerSession(
-            client=self,
+            client=client if client else self,
             userdata=server[0],
             handle=server[1],
             resp_topic=msg['resp_topic'],
@@ -0,0 +1,332 @@
+import socket
+import struct
+import logging
+import selectors
+from threading import Thread, Event
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+def topic_matches_sub(sub, topic):
+    sub_levels = sub.split('/')
+    topic_levels = topic.split('/')
+    for i, level in enumerate(sub_levels):
+        if '#' == level:
+            return True
+        if i >= len(topic_levels):
+            return False
+        if '+' != level and level != topic_levels[i]:
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+
+def _encode_length(length):
+    out = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        out.append(byte)
+        if 0 == length:
+            return bytes(out)
+
+
+def _packet(header, body=b''):
+    return bytes([header]) + _encode_length(len(body)) + body
+
+
+def _utf8(data, offset):
+    length = struct.unpack_from('!H', data, offset)[0]
+    start = offset + 2
+    return data[start:start + length].decode('utf-8'), start + length
+
+
+
+class MqttBroker(object):
+    """
+    Minimal in-process MQTT 3.1/3.1.1 broker, a stand-in for mosquitto in load tests.
+
+    Supports CONNECT, PUBLISH (QoS 0/1/2 accepted, delivered as QoS 0), retained messages,
+    SUBSCRIBE/UNSUBSCRIBE with + and # wildcards, PINGREQ and DISCONNECT. No authentication,
+    no persistence, no will messages.
+    """
+
+    class Connection(object):
+        def __init__(self, sock):
+            self.sock = sock
+            self.client_id = None
+            self.inbuf = bytearray()
+            self.outbuf = bytearray()
+            self.writing = False
+            self.subscriptions = set()
+
+
+    def __init__(self, host='127.0.0.1', port=1883, logger=None):
+        self._host = host
+        self._port = port
+        self._logger = logger if logger else logging.getLogger('SBrick_Broker')
+        self._selector = selectors.DefaultSelector()
+        self._connections = {}
+        self._client_ids = {}
+        self._retained = {}
+        self._thread = None
+        self._stop_event = Event()
+        self._listener = None
+        self.received = 0
+        self.delivered = 0
+
+
+    @property
+    def port(self):
+        return self._port
+
+
+    def start(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self._host, self._port))
+        listener.listen(128)
+        listener.setblocking(False)
+        # port 0 binds an ephemeral port
+        self._port = listener.getsockname()[1]
+        self._listener = listener
+        self._selector.register(listener, selectors.EVENT_READ, None)
+
+        self._thread = Thread(target=self._run, name='mqtt_broker')
+        self._thread.daemon = True
+        self._thread.start()
+        self._logger.info('MQTT broker stand-in listens on {}:{}'.format(self._host, self._port))
+
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+        for conn in list(self._connections.values()):
+            self._close(conn)
+        self._selector.unregister(self._listener)
+        self._listener.close()
+        self._selector.close()
+
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            for key, events in self._selector.select(timeout=0.1):
+                if None == key.data:
+                    self._accept()
+                    continue
+                conn = key.data
+                if events & selectors.EVENT_READ and conn.sock.fileno() >= 0:
+                    self._on_readable(conn)
+                if events & selectors.EVENT_WRITE and conn.sock.fileno() >= 0:
+                    self._flush(conn)
+
+
+    def _accept(self):
+        try:
+            sock, addr = self._listener.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = MqttBroker.Connection(sock)
+        self._connections[sock.fileno()] = conn
+        self._selector.register(sock, selectors.EVENT_READ, conn)
+
+
+    def _close(self, conn):
+        if conn.sock.fileno() < 0:
+            return
+        self._connections.pop(conn.sock.fileno(), None)
+        if conn.client_id is not None and self._client_ids.get(conn.client_id) is conn:
+            del self._client_ids[conn.client_id]
+        try:
+            self._selector.unregister(conn.sock)
+        except (KeyError, ValueError):
+            pass
+        conn.sock.close()
+
+
+    def _on_readable(self, conn):
+        try:
+            data = conn.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._close(conn)
+            return
+        if not data:
+            self._close(conn)
+            return
+
+        buf = conn.inbuf
+        buf.extend(data)
+        while True:
+            packet = self._split_packet(buf)
+            if None == packet:
+                return
+            header, body = packet
+            if False == self._handle(conn, header, body):
+                self._close(conn)
+                return
+
+
+    @staticmethod
+    def _split_packet(buf):
+        """ Pop one complete packet from buf, return (header, body) or None """
+        if len(buf) < 2:
+            return None
+        length = 0
+        multiplier = 1
+        pos = 1
+        while True:
+            if pos >= len(buf):
+                return None
+            byte = buf[pos]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            pos += 1
+            if not byte & 0x80:
+                break
+        if len(buf) < pos + length:
+            return None
+        header = buf[0]
+        body = bytes(buf[pos:pos + length])
+        del buf[:pos + length]
+        return header, body
+
+
+    def _handle(self, conn, header, body):
+        packet_type = header >> 4
+        if CONNECT == packet_type:
+            return self._on_connect(conn, body)
+        elif PUBLISH == packet_type:
+            self._on_publish(conn, header, body)
+        elif PUBREL == packet_type:
+            self._send(conn, _packet(PUBCOMP << 4, body[:2]))
+        elif SUBSCRIBE == packet_type:
+            self._on_subscribe(conn, body)
+        elif UNSUBSCRIBE == packet_type:
+            self._on_unsubscribe(conn, body)
+        elif PINGREQ == packet_type:
+            self._send(conn, _packet(PINGRESP << 4))
+        elif DISCONNECT == packet_type:
+            return False
+        return True
+
+
+    def _on_connect(self, conn, body):
+        # protocol name, protocol level, connect flags, keepalive
+        offset = 2 + struct.unpack_from('!H', body, 0)[0] + 4
+        client_id, offset = _utf8(body, offset)
+        old = self._client_ids.get(client_id)
+        if old is not None and old is not conn and client_id:
+            # MQTT: a new connection with the same client id takes over the old one
+            self._close(old)
+        conn.client_id = client_id
+        self._client_ids[client_id] = conn
+        self._send(conn, _packet(CONNACK << 4, b'\x00\x00'))
+        return True
+
+
+    def _on_publish(self, conn, header, body):
+        qos = (header >> 1) & 0x03
+        retain = header & 0x01
+        topic, offset = _utf8(body, 0)
+        if qos > 0:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            self._send(conn, _packet((PUBACK if 1 == qos else PUBREC) << 4, packet_id))
+        payload = body[offset:]
+        self.received += 1
+
+        if retain:
+            if payload:
+                self._retained[topic] = payload
+            else:
+                self._retained.pop(topic, None)
+
+        out = None
+        for other in list(self._connections.values()):
+            for sub in other.subscriptions:
+                if topic_matches_sub(sub, topic):
+                    if None == out:
+                        out = self._publish_packet(topic, payload, False)
+                    self._send(other, out)
+                    self.delivered += 1
+                    break
+
+
+    @staticmethod
+    def _publish_packet(topic, payload, retain):
+        encoded = topic.encode('utf-8')
+        body = struct.pack('!H', len(encoded)) + encoded + payload
+        return _packet((PUBLISH << 4) | (0x01 if retain else 0x00), body)
+
+
+    def _on_subscribe(self, conn, body):
+        packet_id = body[:2]
+        offset = 2
+        granted = bytearray()
+        topics = []
+        while offset < len(body):
+            topic, offset = _utf8(body, offset)
+            offset += 1   # requested QoS
+            conn.subscriptions.add(topic)
+            topics.append(topic)
+            granted.append(0)
+        self._send(conn, _packet((SUBACK << 4), packet_id + bytes(granted)))
+
+        for topic, payload in list(self._retained.items()):
+            for sub in topics:
+                if topic_matches_sub(sub, topic):
+                    self._send(conn, self._publish_packet(topic, payload, True))
+                    break
+
+
+    def _on_unsubscribe(self, conn, body):
+        packet_id = body[:2]
+        offset = 2
+        while offset < len(body):
+            topic, offset = _utf8(body, offset)
+            conn.subscriptions.discard(topic)
+        self._send(conn, _packet((UNSUBACK << 4), packet_id))
+
+
+    def _send(self, conn, data):
+        if conn.sock.fileno() < 0:
+            return
+        pending = bool(conn.outbuf)
+        conn.outbuf.extend(data)
+        if not pending:
+            self._flush(conn)
+
+
+    def _flush(self, conn):
+        try:
+            sent = conn.sock.send(conn.outbuf)
+        except (BlockingIOError, InterruptedError):
+            sent = 0
+        except OSError:
+            self._close(conn)
+            return
+        del conn.outbuf[:sent]
+        writing = bool(conn.outbuf)
+        if writing != conn.writing:
+            conn.writing = writing
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if writing else 0)
+            self._selector.modify(conn.sock, events, conn)
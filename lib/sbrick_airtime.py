@@ -0,0 +1,190 @@
+import time
+import functools
+from threading import Condition, local
+
+# traffic classes, a lower value is granted first
+CLASS_STOP = 0
+CLASS_DRIVE = 1
+CLASS_TELEMETRY = 2
+CLASS_DISCOVERY = 3
+CLASS_NAMES = ('stop', 'drive', 'telemetry', 'discovery')
+
+# traffic class of the GATT operations of the current thread
+_current = local()
+
+
+def traffic_class():
+    # None once the outermost scheduled method of the thread returned
+    current = getattr(_current, 'traffic_class', None)
+    return CLASS_DISCOVERY if None == current else current
+
+
+def traffic(traffic_class):
+    """ Schedule the GATT operations of the decorated method as traffic_class, a reconnect inside included """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            previous = getattr(_current, 'traffic_class', None)
+            _current.traffic_class = traffic_class
+            try:
+                return func(*args, **kwargs)
+            finally:
+                _current.traffic_class = previous
+        return wrapper
+    return decorator
+
+
+
+class BrickBudget(object):
+    """ Token bucket and airtime usage of one SBrick """
+    __slots__ = ('sbrick_id', 'rate', 'burst', 'tokens', 'stamp', 'granted', 'airtime', 'waited', 'over_budget')
+
+    def __init__(self, sbrick_id, rate, burst, now):
+        self.sbrick_id = sbrick_id
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = now
+        # per traffic class: grants, seconds holding the radio, seconds waiting for it
+        self.granted = [0] * len(CLASS_NAMES)
+        self.airtime = [0.0] * len(CLASS_NAMES)
+        self.waited = [0.0] * len(CLASS_NAMES)
+        # grants given while the bucket was empty, because nothing else was waiting
+        self.over_budget = 0
+
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+
+    def to_dict(self):
+        return {
+            'sbrick_id': self.sbrick_id,
+            'rate': self.rate,
+            'burst': self.burst,
+            'tokens': self.tokens,
+            'granted': dict(zip(CLASS_NAMES, self.granted)),
+            'airtime': dict(zip(CLASS_NAMES, self.airtime)),
+            'waited': dict(zip(CLASS_NAMES, self.waited)),
+            'over_budget': self.over_budget
+        }
+
+
+
+class AirtimeScheduler(object):
+    """
+    Grant the GATT operations of the SBricks on one adapter, at most slots at a time.
+
+    Waiting operations are granted by traffic class first (stop, drive refresh, telemetry,
+    discovery); within a class an operation of a SBrick with tokens left goes before one of a SBrick
+    which spent its budget, then the oldest first. Every grant takes a token from the bucket of its
+    SBrick, refilled at rate per second up to burst. The scheduler is work conserving: a SBrick over
+    its budget is still granted when nobody else waits.
+
+    Connection attempts are not scheduled, they take seconds and do not use the air time of a link.
+    """
+
+    class Ticket(object):
+        __slots__ = ('budget', 'traffic_class', 'seq', 'queued_at', 'granted_at')
+
+        def __init__(self, budget, traffic_class, seq, queued_at):
+            self.budget = budget
+            self.traffic_class = traffic_class
+            self.seq = seq
+            self.queued_at = queued_at
+            self.granted_at = None
+
+
+    def __init__(self, slots=1, rate=20, burst=40, metrics=None, adapter=None):
+        self._slots = slots
+        self._rate = rate
+        self._burst = burst
+        self._metrics = metrics
+        # metric labels, one scheduler per adapter when SBricks are sharded over adapters
+        self._labels = {'adapter': adapter} if adapter else {}
+        self._cond = Condition()
+        self._busy = 0
+        self._seq = 0
+        self._waiting = []
+        # sbrick_id -> BrickBudget
+        self._budgets = {}
+
+
+    def acquire(self, sbrick_id, traffic_class):
+        """ Block until the radio is granted, return the ticket to release() """
+        now = time.monotonic()
+        with self._cond:
+            budget = self._budgets.get(sbrick_id)
+            if None == budget:
+                budget = BrickBudget(sbrick_id, self._rate, self._burst, now)
+                self._budgets[sbrick_id] = budget
+            ticket = AirtimeScheduler.Ticket(budget, traffic_class, self._seq, now)
+            self._seq += 1
+            self._waiting.append(ticket)
+            self._dispatch(now)
+            while None == ticket.granted_at:
+                self._cond.wait()
+            waited = ticket.granted_at - ticket.queued_at
+            budget.waited[traffic_class] += waited
+        if self._metrics:
+            self._metrics.observe('airtime_wait_seconds', waited, traffic_class=CLASS_NAMES[traffic_class], **self._labels)
+        return ticket
+
+
+    def release(self, ticket):
+        now = time.monotonic()
+        held = now - ticket.granted_at
+        with self._cond:
+            ticket.budget.airtime[ticket.traffic_class] += held
+            self._busy -= 1
+            self._dispatch(now)
+        if self._metrics:
+            self._metrics.inc('airtime_seconds_total', held, sbrick=ticket.budget.sbrick_id, traffic_class=CLASS_NAMES[ticket.traffic_class])
+
+
+    def _rank(self, ticket):
+        return (ticket.traffic_class, 0 if ticket.budget.tokens >= 1 else 1, ticket.seq)
+
+
+    def _dispatch(self, now):
+        granted = False
+        while self._busy < self._slots and self._waiting:
+            for ticket in self._waiting:
+                ticket.budget.refill(now)
+            ticket = min(self._waiting, key=self._rank)
+            self._waiting.remove(ticket)
+            budget = ticket.budget
+            if budget.tokens >= 1:
+                budget.tokens -= 1
+            else:
+                budget.over_budget += 1
+            budget.granted[ticket.traffic_class] += 1
+            ticket.granted_at = now
+            self._busy += 1
+            granted = True
+        if granted:
+            self._cond.notify_all()
+
+
+    def forget(self, sbrick_id):
+        with self._cond:
+            self._budgets.pop(sbrick_id, None)
+
+
+    def usage(self, sbrick_id=None):
+        """ Budget usage of every SBrick, or of sbrick_id only """
+        now = time.monotonic()
+        with self._cond:
+            budgets = [budget for budget in self._budgets.values() if None == sbrick_id or budget.sbrick_id == sbrick_id]
+            for budget in budgets:
+                budget.refill(now)
+            usage = [budget.to_dict() for budget in budgets]
+        for entry in usage:
+            entry.update(self._labels)
+        return usage
+
+
+    @property
+    def slots(self):
+        return self._slots
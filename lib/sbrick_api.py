@@ -1,12 +1,31 @@
 import sys
 import struct
 import time
-import subprocess
-import shlex
+import functools
 from threading import Thread, Timer, Event, Lock
-from bluepy.btle import Peripheral, BTLEException, Scanner, DefaultDelegate
+from bluepy.btle import BTLEException, Scanner, DefaultDelegate
+from lib.sbrick_transport import BluepyTransport
+from lib.sbrick_trace import TRACE_WRITE, TRACE_READ, mac_to_bytes
+from lib.sbrick_profile import conn_param_to_dict
+from lib.sbrick_command import drive_frame, brake_frame, scale_frame
+from lib.sbrick_airtime import traffic, traffic_class, CLASS_STOP, CLASS_DRIVE, CLASS_TELEMETRY, CLASS_DISCOVERY
 
 MAGIC_FOREVER = 5566
+# a running channel rewrites its drive frame every DRIVE_REFRESH seconds
+DRIVE_REFRESH = 1
+
+
+def pinned(func):
+    """ Keep the SBrick out of connection pool eviction while a multi-frame query runs """
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self.pin()
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self.unpin()
+    return wrapper
+
 
 class ScanAPI(object):
     ad_type_manufacturer = 255
@@ -40,16 +59,94 @@ class SbrickAPI(object):
     rcc_uuid = '02b8cbcc-0e25-4bda-8790-a15f53e6010f'
     stop_hex = '00'
     drive_hex = '01'
+    # query ADC voltage (08) and temperature (09) channels in one frame
+    adc_query = bytes.fromhex('0F0809')
+    thermal_limit_query = bytes.fromhex('15')
 
-    class DriveThread(Thread):
-        def __init__(self, logger, sbrick, channel, direction, power):
-            Thread.__init__(self)
+    class ChannelDriver(object):
+        """ Command and state of a driven channel, shared by DriveThread and DriveTask """
+
+        def __init__(self, logger, sbrick, channel, direction, power, arrival=None, frame=None):
             self._sbrick = sbrick
             self._channel = channel
             self._direction = direction
             self._power = power
+            # pre-packed frames, every tick writes the same bytes object
+            self._frame = frame if frame else drive_frame(channel, direction, power)
+            self._brake_frame = brake_frame(channel)
             self._logger = logger
+            # monotonic time the command arrived, cleared after its first write
+            self._arrival = arrival
+
+            # channel state: wall clock deadline (None is forever), time and result of the last write
+            self._deadline = None
+            self._last_write = None
+            self._write_ok = None
+            # publish the state after the next write, it tells whether a new command landed
+            self._state_dirty = True
+
+        def reset_command(self, channel, direction, power, arrival=None, frame=None):
+           self._channel = channel
+           self._direction = direction
+           self._power = power
+           self._arrival = arrival
+           self._frame = frame if frame else drive_frame(channel, direction, power)
 
+        def _observe_latency(self):
+            arrival = self._arrival
+            metrics = self._sbrick.metrics
+            if None == arrival or None == metrics:
+                return
+            self._arrival = None
+            metrics.observe('drive_latency_seconds', metrics.now() - arrival, sbrick=self._sbrick.dev_mac)
+
+        def _update_write(self, ok):
+            if ok:
+                self._last_write = time.time()
+            # publish when a new command landed or the write result flips, not on every tick
+            if self._state_dirty or ok != self._write_ok:
+                self._state_dirty = False
+                self._write_ok = ok
+                self.publish_state(True)
+
+        @traffic(CLASS_STOP)
+        def break_channel(self):
+            ok = self._write_frame(self._brake_frame)
+            if ok:
+                self._last_write = time.time()
+            self._write_ok = ok
+            self.publish_state(False)
+
+        @traffic(CLASS_DRIVE)
+        def exec_command(self, binary):
+            scale = self._sbrick.power_scale
+            if scale < 1.0:
+                # throttled by the PowerGovernor, the channel state keeps the commanded power
+                binary = scale_frame(binary, scale)
+            return self._write_frame(binary)
+
+        def _write_frame(self, binary):
+            self._logger.debug('Exec command %s', binary)
+            return self._sbrick.rcc_char_write_ex(binary, reconnect_do_again=False)
+            #self._sbrick.rcc_char_read_ex(reconnect_do_again=False)
+
+        def publish_state(self, running):
+            if None == self._sbrick.on_channel_state:
+                return
+            self._sbrick.on_channel_state(self._sbrick.dev_mac, self._channel, {
+                'running': running,
+                'direction': self._direction,
+                'power': self._power if running else '00',
+                'deadline': self._deadline if running else None,
+                'last_write': self._last_write,
+                'write_ok': self._write_ok
+            })
+
+
+    class DriveThread(ChannelDriver, Thread):
+        def __init__(self, logger, sbrick, channel, direction, power, arrival=None, frame=None):
+            Thread.__init__(self)
+            SbrickAPI.ChannelDriver.__init__(self, logger, sbrick, channel, direction, power, arrival, frame)
             self._stop_event = Event()
             self._timer_thd = None
 
@@ -64,25 +161,25 @@ class SbrickAPI(object):
 
         def stop(self):
             self._stop_event.set()
-            self._timer_thd.cancel()
+            # no timer when driving forever
+            if self._timer_thd:
+                self._timer_thd.cancel()
 
         def times_up(self):
-            self._logger.debug('Drive action times_up {}{}{}{}'.format(SbrickAPI.drive_hex, self._channel, self._direction, self._power))
+            self._logger.debug('Drive action times_up %s%s%s%s', SbrickAPI.drive_hex, self._channel, self._direction, self._power)
             self._stop_event.set()
 
-        def reset_command(self, channel, direction, power):
-           self._channel = channel
-           self._direction = direction
-           self._power = power
-
         def reset_timer(self, exec_time):
             if self._timer_thd:
                 self._timer_thd.cancel()
             if self._stop_event:
                 self._stop_event.clear()
 
+            self._state_dirty = True
             if MAGIC_FOREVER == exec_time:
+                self._deadline = None
                 return
+            self._deadline = time.time() + exec_time
             self._timer_thd = Timer(exec_time, self.times_up)
             self._timer_thd.setName('timer_' + self._channel)
             self._timer_thd.start()
@@ -90,21 +187,12 @@ class SbrickAPI(object):
 
         def drive_channel(self):
             while(not self._stop_event.is_set()):
-                drive_hex_string = SbrickAPI.drive_hex + self._channel + self._direction + self._power
-                self.exec_command(drive_hex_string)
+                ok = self.exec_command(self._frame)
+                self._observe_latency()
+                self._update_write(ok)
                 # TODO: not need to sleep
                 #time.sleep(0.1)
-                time.sleep(1)
-
-        def break_channel(self):
-            stop_hex_string = SbrickAPI.stop_hex + self._channel
-            self.exec_command(stop_hex_string)
-
-        def exec_command(self, hex_string):
-            self._logger.debug('Exec command {}'.format(hex_string))
-            binary = bytes.fromhex(hex_string)
-            self._sbrick.rcc_char_write_ex(binary, reconnect_do_again=False)
-            #self._sbrick.rcc_char_read_ex(reconnect_do_again=False)
+                time.sleep(DRIVE_REFRESH)
             
 
         @property
@@ -115,13 +203,150 @@ class SbrickAPI(object):
         def timer_thd(self):
             return self._timer_thd
 
-    def __init__(self, logger, dev_mac):
+
+    class DriveTask(ChannelDriver):
+        """
+        DriveThread of the asyncio engine: the refresh ticks and the deadline are scheduled on the
+        loop, the GATT writes run in its executor. Every method may be called from any thread.
+
+        A stop while a write is in flight brakes right after it, so the brake is never overtaken by
+        a drive frame. A drive arriving before the brake has landed revives the task instead of
+        racing it with a second one.
+        """
+
+        def __init__(self, logger, sbrick, channel, direction, power, arrival=None, frame=None, engine=None):
+            SbrickAPI.ChannelDriver.__init__(self, logger, sbrick, channel, direction, power, arrival, frame)
+            self._engine = engine
+            self._lock = Lock()
+            self._stopped = False
+            # a write of this channel is in the executor
+            self._busy = False
+            # a tick or a deadline scheduled before the last reset is stale
+            self._tick_gen = 0
+            self._deadline_gen = 0
+            self._done = Event()
+
+        def start(self):
+            self._engine.call_soon_threadsafe(self._tick, self._tick_gen)
+
+        def is_alive(self):
+            return not self._done.is_set()
+
+        def join(self, timeout=None):
+            self._done.wait(timeout)
+
+        def reset_timer(self, exec_time):
+            with self._lock:
+                self._stopped = False
+                self._done.clear()
+                self._state_dirty = True
+                self._deadline_gen += 1
+                gen = self._deadline_gen
+                if MAGIC_FOREVER == exec_time:
+                    self._deadline = None
+                    return
+                self._deadline = time.time() + exec_time
+            self._engine.call_soon_threadsafe(self._engine.call_later, exec_time, self._times_up, gen)
+
+        def _times_up(self, gen):
+            if gen != self._deadline_gen:
+                return
+            self._logger.debug('Drive action times_up %s%s%s%s', SbrickAPI.drive_hex, self._channel, self._direction, self._power)
+            self.stop()
+
+        def stop(self):
+            with self._lock:
+                if self._stopped:
+                    return
+                self._stopped = True
+                self._deadline_gen += 1
+                if self._busy:
+                    # the write in flight brakes when it is done
+                    return
+                self._busy = True
+            self._engine.run_blocking(self._write_brake, self._after_write)
+
+        def _tick(self, gen):
+            with self._lock:
+                if gen != self._tick_gen or self._stopped or self._busy:
+                    return
+                self._busy = True
+            self._engine.run_blocking(self._write_tick, self._after_write)
+
+        def _write_tick(self):
+            ok = self.exec_command(self._frame)
+            self._observe_latency()
+            self._update_write(ok)
+            with self._lock:
+                braking = self._stopped
+            # brake in the same executor job, a shutdown blocking the loop still gets it
+            return self._write_brake() if braking else False
+
+        def _write_brake(self):
+            try:
+                self.break_channel()
+            finally:
+                with self._lock:
+                    if self._stopped:
+                        self._done.set()
+            return True
+
+        def _after_write(self, braked):
+            # None when the write raised, do not retry the brake of a broken link
+            with self._lock:
+                self._tick_gen += 1
+                gen = self._tick_gen
+                # stopped after the write looked, it still owes the brake
+                brake = self._stopped and False == braked
+                self._busy = brake
+                running = not self._stopped
+                if not running and not brake:
+                    self._done.set()
+            if brake:
+                self._engine.run_blocking(self._write_brake, self._after_write)
+            elif running:
+                # revived by a drive while braking: the drive frame goes at once
+                self._engine.call_later(0 if braked else DRIVE_REFRESH, self._tick, gen)
+
+    def __init__(self, logger, dev_mac, metrics=None, transport=None, trace=None, pool=None, latency_profile=None, on_channel_state=None,
+                 engine=None, airtime=None):
         self._dev_mac = dev_mac
         self._logger = logger
+        # BluepyTransport talks to a real SBrick, VirtualTransport to a simulated one
+        self._transport = transport if transport else BluepyTransport()
         self._lock = Lock()
+        self._lock_acquired_at = 0
+        # SbrickMetrics, None when metrics are disabled
+        self._metrics = metrics
+        # TraceRecorder of every rcc frame, None when tracing is disabled
+        self._trace = trace
+        # trace records only, a sbrick_id which is not a MAC is an error of the connect, not of the constructor
+        self._mac_bytes = mac_to_bytes(dev_mac) if trace else None
+        # SbrickConnectionPool bounding the live links, None when unbounded
+        self._pool = pool
+        # pinned SBricks are not evicted from the pool while a multi-frame query runs
+        self._pins = 0
+        self._pin_lock = Lock()
+        # LatencyProfile requested on every connect, None keeps the connection parameters of the SBrick
+        self._latency_profile = latency_profile
+        self._applying_profile = False
+        # connection parameters last read back (opcode 0x25)
+        self._conn_param = None
+        # monotonic time of the last GATT write or read
+        self._last_io = 0
+        # called as on_channel_state(dev_mac, channel, state) from the drive threads when a channel state changes
+        self._on_channel_state = on_channel_state
+        # aio_uv.Loop of the asyncio engine, channels are driven by DriveTasks on it instead of DriveThreads
+        self._engine = engine
+        # AirtimeScheduler of the adapter granting every GATT operation, None when unscheduled
+        self._airtime = airtime
+        # drive power multiplier (0~1) set by the PowerGovernor, 1.0 writes the commanded power
+        self.power_scale = 1.0
+        # thermal limit (0x15) in degrees, None until read
+        self._thermal_limit = None
 
         # bluepy is not thread-safe, must use lock to protect it
-        self._blue = Peripheral()
+        self._blue = self._transport.new_peripheral()
         self._rcc_char = None
 
         self._channel_thread = {
@@ -140,31 +365,56 @@ class SbrickAPI(object):
         self.disconnect()
 
 
-    def _construct_new_bluetooth_object(self):
+    def _acquire_lock(self):
+        metrics = self._metrics
+        if None == metrics:
+            self._lock.acquire()
+            return
+
+        metrics.add_gauge('queue_depth', 1, sbrick=self._dev_mac)
+        start = metrics.now()
         self._lock.acquire()
+        self._lock_acquired_at = metrics.now()
+        metrics.observe('lock_wait_seconds', self._lock_acquired_at - start, sbrick=self._dev_mac)
+
+
+    def _release_lock(self):
+        metrics = self._metrics
+        if None != metrics:
+            metrics.observe('lock_held_seconds', metrics.now() - self._lock_acquired_at, sbrick=self._dev_mac)
+            metrics.add_gauge('queue_depth', -1, sbrick=self._dev_mac)
+        self._lock.release()
+
+
+    def _construct_new_bluetooth_object(self):
+        self._acquire_lock()
         self._logger.info("Construct a new bluetooth object")
         del self._blue
-        self._blue = Peripheral()
-        self._lock.release()
+        self._blue = self._transport.new_peripheral()
+        self._release_lock()
 
 
     def connect(self):
+        if None != self._pool:
+            self._pool.make_room(self)
         try:
-            self._lock.acquire()
+            self._acquire_lock()
             self._logger.info('Try to connect to SBrick ({})'.format(self._dev_mac))
             # connect() is a blocking function
-            self._blue.connect(self._dev_mac)
+            self._transport.connect(self._blue, self._dev_mac)
         except BTLEException as e:
-            self._lock.release()
+            self._release_lock()
             self._logger.error('SBrick ({}): {}'.format(self._dev_mac, e.message))
             if BTLEException.DISCONNECTED == e.code:
+                if None != self._pool:
+                    self._pool.release(self)
                 return False
             else:
                 self._construct_new_bluetooth_object()
                 self._logger.error('exit -1')
                 sys.exit(-1)
         except Exception as e:
-            self._lock.release()
+            self._release_lock()
             self._logger.error(e)    
             self._construct_new_bluetooth_object()
             self._logger.error('exit -1')
@@ -177,7 +427,7 @@ class SbrickAPI(object):
             self._logger.info('Get rcc characteristic')
             chars = self._blue.getCharacteristics(uuid = SbrickAPI.rcc_uuid)
         except Exception as e:
-            self._lock.release()
+            self._release_lock()
             self._logger.error("Failed to get SBrick characteristics ({}): {}".format(SbrickAPI.rcc_uuid, e))
             self._construct_new_bluetooth_object()
             self._logger.error('exit -1')
@@ -191,152 +441,354 @@ class SbrickAPI(object):
         try:
             services = self._blue.getServices()
         except Exception as e:
-            self._lock.release()
+            self._release_lock()
             self._logger.error("Failed to get SBrick services ({}): {}".format(self._dev_mac, e))
             self._construct_new_bluetooth_object()
             self._logger.error('exit -1')
             sys.exit(-1)
         else:
             self._services = services
-            self._lock.release()
-            
+            self._release_lock()
+
+        # a reconnect inside apply_latency_profile() must not apply it again
+        if None != self._latency_profile and not self._applying_profile:
+            self.apply_latency_profile(self._latency_profile)
         return True
  
 
     def disconnect_ex(self):
-        # disconnect SBrick using bluetoothctl command
-        bl_cmd = 'disconnect {}\nquit'.format(self._dev_mac)
-        cmd = "echo -e '{}'".format(bl_cmd)
-        p1 = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE)
-        p2 = subprocess.Popen(shlex.split('bluetoothctl'), stdin=p1.stdout, stdout=subprocess.PIPE, shell=True)
-        p1.stdout.close()
-        p2.communicate()
-        # wait 3 seconds for real disconnection, because `bluetoothctl #disconnect` is an asynchronous command
-        time.sleep(3)
+        # drop a stale link left by a previous process, e.g. `bluetoothctl disconnect`
+        self._transport.release(self._dev_mac)
         
 
     def disconnect(self):
-        self._lock.acquire()
+        self._acquire_lock()
         self._blue.disconnect()
         self._logger.info('Disconnect from SBrick({}) successfully'.format(self._dev_mac))
-        self._lock.release()
+        self._release_lock()
+        if None != self._pool:
+            self._pool.release(self)
+
+
+    def release_link(self):
+        # evicted by the connection pool, the next command reconnects
+        self._acquire_lock()
+        self._rcc_char = None
+        self._blue.disconnect()
+        self._logger.info('Release link of SBrick({})'.format(self._dev_mac))
+        self._release_lock()
+
+
+    def set_transport(self, transport, pool=None, airtime=None):
+        # move to another adapter, the next command connects through it
+        old_pool = self._pool
+        old_airtime = self._airtime
+        self._acquire_lock()
+        try:
+            self._blue.disconnect()
+        except Exception as e:
+            # the old adapter is gone, so may be its bluepy-helper
+            self._logger.debug('Disconnect SBrick({}) from the old adapter: {}'.format(self._dev_mac, e))
+        self._transport = transport
+        self._pool = pool
+        self._airtime = airtime
+        self._blue = transport.new_peripheral()
+        self._rcc_char = None
+        self._release_lock()
+        if None != old_pool:
+            old_pool.release(self)
+        if None != old_airtime and old_airtime is not airtime:
+            old_airtime.forget(self._dev_mac)
+
+
+    def is_linked(self):
+        return None != self._rcc_char
+
+
+    def pin(self):
+        with self._pin_lock:
+            self._pins += 1
+
+
+    def unpin(self):
+        with self._pin_lock:
+            self._pins -= 1
+
+
+    def is_pinned(self):
+        if self._pins > 0:
+            return True
+        return self.is_driving()
 
 
     def re_connect(self):
         self._logger.info('Re-connect to SBrick ({})'.format(self._dev_mac))
+        if None != self._metrics:
+            self._metrics.inc('reconnect_total', sbrick=self._dev_mac)
         self.disconnect()
         return self.connect()
 
 
-    def drive(self, channel='00', direction='00', power='f0', exec_time=1):
+    def drive(self, channel='00', direction='00', power='f0', exec_time=1, arrival=None, frame=None):
         # reset thread status when the thread is dead
         if self._channel_thread[channel] and not self._channel_thread[channel].is_alive():
             self._channel_thread[channel].join()
             self._channel_thread[channel] = None
 
         if None == self._channel_thread[channel]:
-            # Create a thread for executing drive
-            thd = SbrickAPI.DriveThread(self._logger, self, channel, direction, power)
-            thd.setName('channel_' + channel)
+            if self._engine:
+                thd = SbrickAPI.DriveTask(self._logger, self, channel, direction, power, arrival, frame, self._engine)
+            else:
+                # Create a thread for executing drive
+                thd = SbrickAPI.DriveThread(self._logger, self, channel, direction, power, arrival, frame)
+                thd.setName('channel_' + channel)
             thd.reset_timer(exec_time)
             self._channel_thread[channel] = thd
+            thd.publish_state(True)
             thd.start()
         else:
             self._logger.debug('Overwrite drive action')
             running_thd = self._channel_thread[channel]
-            running_thd.reset_command(channel, direction, power)
+            running_thd.reset_command(channel, direction, power, arrival, frame)
             running_thd.reset_timer(exec_time)
+            running_thd.publish_state(True)
         
 
 
     def stop(self, channels=['00']):
         # TODO: validate parameters
         self._logger.debug('Stop action')
+        # signal every thread first, so the joins overlap
+        stopped = []
         for channel in channels:
             thd = self._channel_thread[channel]
-            if thd:
+            # a channel listed twice is joined once
+            if thd and channel not in stopped:
                 thd.stop()
-                thd.join()
-                self._channel_thread[channel] = None
+                stopped.append(channel)
+
+        for channel in stopped:
+            thd = self._channel_thread[channel]
+            if not isinstance(thd, Thread):
+                # a DriveTask brakes in the executor, drive() replaces it once it is done
+                continue
+            thd.join()
+            self._channel_thread[channel] = None
+
+
+    def wait_stopped(self, timeout=None):
+        """ Wait for the brakes of stopped DriveTasks to land, DriveThreads are joined by stop() already """
+        for thd in list(self._channel_thread.values()):
+            if thd and not isinstance(thd, Thread):
+                thd.join(timeout)
+
+
+    def stop_all(self):
+        self.stop(channels=list(self._channel_thread.keys()))
+
+
+    def _gatt_write(self, binary):
+        """ Write the rcc characteristic in an airtime grant of the traffic class of this thread. Lock held """
+        ticket = self._airtime.acquire(self._dev_mac, traffic_class()) if None != self._airtime else None
+        try:
+            if None == self._metrics:
+                self._rcc_char.write(binary)
+            else:
+                start = self._metrics.now()
+                self._rcc_char.write(binary)
+                self._metrics.observe('gatt_write_seconds', self._metrics.now() - start, sbrick=self._dev_mac)
+        finally:
+            if None != ticket:
+                self._airtime.release(ticket)
+
+
+    def _gatt_read(self):
+        ticket = self._airtime.acquire(self._dev_mac, traffic_class()) if None != self._airtime else None
+        try:
+            if None == self._metrics:
+                return self._rcc_char.read()
+            start = self._metrics.now()
+            out = self._rcc_char.read()
+            self._metrics.observe('gatt_read_seconds', self._metrics.now() - start, sbrick=self._dev_mac)
+            return out
+        finally:
+            if None != ticket:
+                self._airtime.release(ticket)
 
 
     def rcc_char_write_ex(self, binary, reconnect_do_again=True):
+        if None != self._pool:
+            self._pool.touch(self)
         # make sure _rcc_char exist
-        self._lock.acquire()
-        self._logger.debug('RCC characteristic writes binary: {}'.format(binary))
+        self._acquire_lock()
+        self._logger.debug('RCC characteristic writes binary: %s', binary)
         if not self._rcc_char:
-            self._lock.release()
+            # never connected (lazy connect) or the characteristic is missing
+            self._release_lock()
             self._construct_new_bluetooth_object()
             if False == self.re_connect(): return False
+            self._acquire_lock()
 
         # write binary
         try:
-            self._rcc_char.write(binary)
+            self._gatt_write(binary)
         except BrokenPipeError as e:
-            self._lock.release()
+            self._release_lock()
             self._logger.error('BrokerPipeError with bluepy-helper')
             self._logger.error('exit -1')
             sys.exit(-1)
         except BTLEException as e:
-            self._lock.release()
+            self._release_lock()
             self._logger.error('SBrick ({}): {}'.format(self._dev_mac, e.message))
             if BTLEException.DISCONNECTED == e.code:
                 self._construct_new_bluetooth_object()
                 if False == self.re_connect(): return False
-                if reconnect_do_again: self.rcc_char_write_ex(binary, reconnect_do_again=False)
+                # the frame is lost with the link unless it is written again
+                return self.rcc_char_write_ex(binary, reconnect_do_again=False) if reconnect_do_again else False
             elif BTLEException.INTERNAL_ERROR == e.code and "Helper not started (did you call connect()?)" == e.message:
                 self._construct_new_bluetooth_object()
                 if False == self.re_connect(): return False
-                if reconnect_do_again: self.rcc_char_write_ex(binary, reconnect_do_again=False)
+                return self.rcc_char_write_ex(binary, reconnect_do_again=False) if reconnect_do_again else False
             else:
                 self._construct_new_bluetooth_object()
                 self._logger.error('exit -1')
                 sys.exit(-1)
         except Exception as e:
-            self._lock.release()
+            self._release_lock()
             self._logger.error(e)
             self._construct_new_bluetooth_object()
             self._logger.error('exit -1')
             sys.exit(-1)
         else:
-            self._lock.release()
+            if None != self._trace:
+                self._trace.record(TRACE_WRITE, self._mac_bytes, binary)
+            self._last_io = time.monotonic()
+            self._release_lock()
 
         
         return True
 
 
     def rcc_char_read_ex(self, reconnect_do_again=True):
+        if None != self._pool:
+            self._pool.touch(self)
         try:
-            self._lock.acquire()
-            out = self._rcc_char.read()
+            self._acquire_lock()
+            if not self._rcc_char:
+                # the link was released, the response of the previous write is lost with it
+                self._release_lock()
+                return False
+            out = self._gatt_read()
         except BrokenPipeError as e:
-            self._lock.release()
+            self._release_lock()
             self._logger.error('BrokerPipeError with bluepy-helper')
             self._logger.error('exit -1')
             sys.exit(-1)
         except BTLEException as e:
-            self._lock.release()
+            self._release_lock()
             self._logger.error('SBrick ({}): {}'.format(self._dev_mac, e.message))
             if BTLEException.DISCONNECTED == e.code:
                 if False == self.re_connect(): return False
-                if reconnect_do_again: self.rcc_char_read_ex(reconnect_do_again=False)
+                # the response of the previous write is lost with the link
+                return self.rcc_char_read_ex(reconnect_do_again=False) if reconnect_do_again else False
             else:
                 self._construct_new_bluetooth_object()
                 self._logger.error('exit -1')
                 sys.exit(-1)
         except Exception as e:
-            self._lock.release()
+            self._release_lock()
             self._logger.error(e)
             self._construct_new_bluetooth_object()
             self._logger.error('exit -1')
             sys.exit(-1)
         else:
-            self._lock.release()
+            if None != self._trace:
+                self._trace.record(TRACE_READ, self._mac_bytes, out)
+            self._last_io = time.monotonic()
+            self._release_lock()
             
         return out
 
 
+    def rcc_char_query_ex(self, binary):
+        """
+        Write a query and read its response under one lock hold, so no drive frame goes in between.
+        Never reconnects: return False when the SBrick is not connected or the link drops, the next
+        command reconnects.
+        """
+        self._acquire_lock()
+        try:
+            if not self._rcc_char:
+                return False
+            ticket = self._airtime.acquire(self._dev_mac, traffic_class()) if None != self._airtime else None
+            try:
+                self._rcc_char.write(binary)
+                out = self._rcc_char.read()
+            finally:
+                if None != ticket:
+                    self._airtime.release(ticket)
+        except BTLEException as e:
+            self._logger.error('SBrick ({}): {}'.format(self._dev_mac, e.message))
+            if BTLEException.DISCONNECTED == e.code:
+                self._rcc_char = None
+            return False
+        else:
+            if None != self._trace:
+                self._trace.record(TRACE_WRITE, self._mac_bytes, binary)
+                self._trace.record(TRACE_READ, self._mac_bytes, out)
+            self._last_io = time.monotonic()
+        finally:
+            self._release_lock()
+        return out
+
+
+    @traffic(CLASS_TELEMETRY)
+    def sample_adc(self):
+        """ Return (voltage, temperature) of a single 0x0F query of both ADC channels, None on failure """
+        binary = self.rcc_char_query_ex(SbrickAPI.adc_query)
+        if False == binary or len(binary) < 4:
+            return None
+        voltage, temperature = struct.unpack('<2H', binary[:4])
+        return ((voltage * 0.83875) / 2047.0, (temperature / 118.85795) - 160)
+
+
+    @traffic(CLASS_TELEMETRY)
+    def sample_thermal_limit(self):
+        """ Read the thermal limit with a single 0x15 query. Return it, None on failure """
+        binary = self.rcc_char_query_ex(SbrickAPI.thermal_limit_query)
+        if False == binary or len(binary) < 2:
+            return None
+        self._thermal_limit = (struct.unpack('<H', binary[:2])[0] / 118.85795) - 160
+        return self._thermal_limit
+
+
+    @property
+    def thermal_limit(self):
+        return self._thermal_limit
+
+
+    def idle_time(self):
+        """ Seconds since the last GATT write or read """
+        return time.monotonic() - self._last_io
+
+
+    def is_busy(self):
+        return self._lock.locked()
+
+
+    def is_driving(self):
+        return any(thd and thd.is_alive() for thd in list(self._channel_thread.values()))
+
+
+    def ensure_connected(self):
+        if self._rcc_char:
+            return True
+        return self.connect()
+
+
+    @pinned
     def get_info_service(self):
+        if False == self.ensure_connected(): return []
         self._logger.debug("Service information:")
         for s in self._services:
             self._logger.debug("  {service}, {uuid}".format(service=s, uuid=s.uuid))
@@ -363,12 +815,15 @@ class SbrickAPI(object):
         return ret
 
 
+    @pinned
+    @traffic(CLASS_TELEMETRY)
     def get_info_adc(self):
         ret = {}
         # Get temperature
         code = bytes.fromhex('0F09')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<H", binary)[0]
         self._temperature = (value / 118.85795) - 160
 
@@ -376,6 +831,7 @@ class SbrickAPI(object):
         code = bytes.fromhex('0F08')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack('<H', binary)[0]
         self._voltage = (value * 0.83875) / 2047.0
 
@@ -389,12 +845,15 @@ class SbrickAPI(object):
         return ret
 
 
+    @pinned
+    @traffic(CLASS_DISCOVERY)
     def get_info_general(self):
         ret = {}
         # Get is_authenticated
         code = bytes.fromhex('03')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<B", binary)[0]
         self._is_auth = value
 
@@ -402,6 +861,7 @@ class SbrickAPI(object):
         code = bytes.fromhex('09')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<B", binary)[0]
         self._auth_timeout = value * 0.1    # second
 
@@ -409,6 +869,7 @@ class SbrickAPI(object):
         code = bytes.fromhex('0A')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<6B", binary)
         l = list(map(lambda v: "%X" %(v), list(value)))
         self._brick_id = ' '.join(l)
@@ -417,6 +878,7 @@ class SbrickAPI(object):
         code = bytes.fromhex('0E')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<B", binary)[0]
         self._watchdog_timeout = value * 0.1  # second
 
@@ -424,6 +886,7 @@ class SbrickAPI(object):
         code = bytes.fromhex('15')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<H", binary)[0]
         self._thermal_limit = (value / 118.85795) - 160
 
@@ -431,6 +894,7 @@ class SbrickAPI(object):
         code = bytes.fromhex('20')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<H", binary)[0]
         self._pwm_counter_value = value
 
@@ -438,6 +902,7 @@ class SbrickAPI(object):
         code = bytes.fromhex('22')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<7B", binary)
         self._channel_status = value
 
@@ -445,6 +910,7 @@ class SbrickAPI(object):
         code = bytes.fromhex('23')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<B", binary)[0]
         self._is_quest_pw_set = value
 
@@ -452,6 +918,7 @@ class SbrickAPI(object):
         code = bytes.fromhex('25')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<3H", binary)
         self._conn_param = value
 
@@ -459,6 +926,7 @@ class SbrickAPI(object):
         code = bytes.fromhex('27')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<B", binary)[0]
         self._ror = value
 
@@ -466,6 +934,7 @@ class SbrickAPI(object):
         code = bytes.fromhex('28')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<I", binary)[0]
         self._power_cycle_counter = value
 
@@ -473,6 +942,7 @@ class SbrickAPI(object):
         code = bytes.fromhex('29')
         if False == self.rcc_char_write_ex(code): return ret
         binary = self.rcc_char_read_ex()
+        if False == binary: return ret
         value = struct.unpack("<I", binary)[0]
         self._uptime_counter = value
 
@@ -498,10 +968,48 @@ class SbrickAPI(object):
         ret['is_quest_password_set'] = self._is_quest_pw_set
         ret['power_cycle_count'] = self._power_cycle_counter
         ret['uptime_count'] = self._uptime_counter
+        ret['conn_param'] = conn_param_to_dict(self._conn_param)
         self.disconnect()
         return ret
 
 
+    def get_conn_param(self):
+        """ Return (min interval, max interval, slave latency) of opcode 0x25, None on failure """
+        code = bytes.fromhex('25')
+        if False == self.rcc_char_write_ex(code): return None
+        binary = self.rcc_char_read_ex()
+        if False == binary: return None
+        self._conn_param = struct.unpack("<3H", binary)
+        if None != self._metrics:
+            self._metrics.set_gauge('conn_interval_seconds', self._conn_param[1] * 0.00125, sbrick=self._dev_mac)
+        return self._conn_param
+
+
+    @pinned
+    def apply_latency_profile(self, profile):
+        """
+        Request the connection parameters of a LatencyProfile (opcode 0x24), then read them back.
+        The profile is kept and requested again on every connect.
+        Return the parameters read back, None when the SBrick is unreachable.
+        """
+        self._latency_profile = profile
+        self._applying_profile = True
+        try:
+            code = bytes.fromhex('24') + struct.pack('<3H', *profile.params())
+            if False == self.rcc_char_write_ex(code, reconnect_do_again=False): return None
+            conn_param = self.get_conn_param()
+        finally:
+            self._applying_profile = False
+
+        if None == conn_param:
+            self._logger.error('SBrick ({}): failed to read back latency profile {}'.format(self._dev_mac, profile))
+        elif conn_param != profile.params():
+            self._logger.warning('SBrick ({}): latency profile {} read back as {}'.format(self._dev_mac, profile, conn_param_to_dict(conn_param)))
+        else:
+            self._logger.info('SBrick ({}): latency profile {}'.format(self._dev_mac, profile))
+        return conn_param
+
+
     def set_watchdog_timeout(self, timeout):
         """
         timeout: 0.1 seconds, 1 byte. Ragne: 0 ~ 255
@@ -518,3 +1026,27 @@ class SbrickAPI(object):
     def blue(self):
         return self._blue
 
+    @property
+    def dev_mac(self):
+        return self._dev_mac
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @property
+    def transport(self):
+        return self._transport
+
+    @property
+    def on_channel_state(self):
+        return self._on_channel_state
+
+    @property
+    def latency_profile(self):
+        return self._latency_profile
+
+    @property
+    def conn_param(self):
+        return self._conn_param
+
@@ -0,0 +1,133 @@
+import math
+import numbers
+
+from lib.sbrick_protocol import SbrickProtocol
+
+CHANNELS = ('00', '01', '02', '03')
+DIRECTIONS = ('00', '01')
+
+# reasons of rejected ingress messages
+REASON_NOT_OBJECT = 'not_object'
+REASON_BAD_SBRICK_ID = 'bad_sbrick_id'
+REASON_UNKNOWN_SBRICK = 'unknown_sbrick'
+REASON_BAD_CHANNEL = 'bad_channel'
+REASON_BAD_DIRECTION = 'bad_direction'
+REASON_BAD_POWER = 'bad_power'
+REASON_BAD_EXEC_TIME = 'bad_exec_time'
+
+
+def _hex_table(values):
+    """ Map every spelling of a 2-digit hex string (any case) to its normalized lower-case form """
+    table = {}
+    for value in values:
+        normalized = '{:02x}'.format(value)
+        table[normalized] = normalized
+        table[normalized.upper()] = normalized
+        table[normalized[0] + normalized[1].upper()] = normalized
+        table[normalized[0].upper() + normalized[1]] = normalized
+    return table
+
+
+# precompiled once: normalized hex strings and every binary frame the hot path writes
+_CHANNEL_TABLE = _hex_table(range(len(CHANNELS)))
+_DIRECTION_TABLE = _hex_table(range(len(DIRECTIONS)))
+_POWER_TABLE = _hex_table(range(256))
+
+# DRIVE_FRAMES[channel][direction][power] and BRAKE_FRAMES[channel], keyed by normalized hex strings
+DRIVE_FRAMES = dict((ch, dict((d, dict(('{:02x}'.format(p), bytes((0x01, int(ch, 16), int(d, 16), p))) for p in range(256)))
+                              for d in DIRECTIONS)) for ch in CHANNELS)
+BRAKE_FRAMES = dict((ch, bytes((0x00, int(ch, 16)))) for ch in CHANNELS)
+
+
+def _lookup(table, value):
+    # a list or a dict value is not hashable
+    return table.get(value) if isinstance(value, str) else None
+
+
+def drive_frame(channel, direction, power):
+    """ Pre-packed drive frame of hex string arguments, e.g. ('00', '01', 'f0') """
+    return DRIVE_FRAMES[_CHANNEL_TABLE[channel]][_DIRECTION_TABLE[direction]][_POWER_TABLE[power]]
+
+
+def brake_frame(channel):
+    return BRAKE_FRAMES[_CHANNEL_TABLE[channel]]
+
+
+def scale_frame(frame, scale):
+    """ Pre-packed drive frame of frame with its power scaled by scale (0~1) """
+    return DRIVE_FRAMES[CHANNELS[frame[1]]][DIRECTIONS[frame[2]]]['{:02x}'.format(int(frame[3] * scale))]
+
+
+
+class DriveCommand(object):
+    __slots__ = ('sbrick_id', 'channel', 'direction', 'power', 'exec_time', 'frame')
+
+    def __init__(self, sbrick_id, channel, direction, power, exec_time, frame):
+        self.sbrick_id = sbrick_id
+        self.channel = channel
+        self.direction = direction
+        self.power = power
+        self.exec_time = exec_time
+        self.frame = frame
+
+
+
+class StopCommand(object):
+    __slots__ = ('sbrick_id', 'channels')
+
+    def __init__(self, sbrick_id, channels):
+        self.sbrick_id = sbrick_id
+        self.channels = channels
+
+
+
+class IngressDecoder(object):
+    """
+    Validate and normalize sp/drive and sp/stop payloads once, on arrival.
+
+    decode_drive() and decode_stop() return (command, None) or (None, reason). Hex strings are
+    normalized to lower case, the SBrick MAC to upper case, and the binary frame of a drive is looked up in DRIVE_FRAMES, so the
+    drive threads write pre-packed bytes and never build a frame again.
+    """
+
+    def decode_drive(self, msg):
+        if not isinstance(msg, dict):
+            return None, REASON_NOT_OBJECT
+        sbrick_id = msg.get('sbrick_id')
+        if not SbrickProtocol.is_sbrick_id(sbrick_id):
+            return None, REASON_BAD_SBRICK_ID
+        sbrick_id = sbrick_id.upper()
+        channel = _lookup(_CHANNEL_TABLE, msg.get('channel'))
+        if None == channel:
+            return None, REASON_BAD_CHANNEL
+        direction = _lookup(_DIRECTION_TABLE, msg.get('direction'))
+        if None == direction:
+            return None, REASON_BAD_DIRECTION
+        power = _lookup(_POWER_TABLE, msg.get('power'))
+        if None == power:
+            return None, REASON_BAD_POWER
+        exec_time = msg.get('exec_time')
+        # bool is a Number too
+        if isinstance(exec_time, bool) or not isinstance(exec_time, numbers.Real) or not math.isfinite(exec_time) or exec_time <= 0:
+            return None, REASON_BAD_EXEC_TIME
+        return DriveCommand(sbrick_id, channel, direction, power, exec_time, DRIVE_FRAMES[channel][direction][power]), None
+
+
+    def decode_stop(self, msg):
+        if not isinstance(msg, dict):
+            return None, REASON_NOT_OBJECT
+        sbrick_id = msg.get('sbrick_id')
+        if not SbrickProtocol.is_sbrick_id(sbrick_id):
+            return None, REASON_BAD_SBRICK_ID
+        sbrick_id = sbrick_id.upper()
+        channels = msg.get('channels')
+        if not isinstance(channels, list) or not channels:
+            return None, REASON_BAD_CHANNEL
+        normalized = []
+        for channel in channels:
+            channel = _lookup(_CHANNEL_TABLE, channel)
+            if None == channel:
+                return None, REASON_BAD_CHANNEL
+            if channel not in normalized:
+                normalized.append(channel)
+        return StopCommand(sbrick_id, tuple(normalized)), None
@@ -0,0 +1,160 @@
+import sys
+import time
+import pstats
+import cProfile
+import threading
+import traceback
+from collections import Counter
+
+MODE_SAMPLE = 'sample'
+MODE_CPROFILE = 'cprofile'
+
+# longest profile a rr/debug request may start
+MAX_PROFILE_SECONDS = 600
+# shortest interval between two stack samples, shorter ones are raised to it
+MIN_SAMPLE_INTERVAL = 0.001
+
+
+def _where(filename, lineno, name):
+    return '{}:{} {}'.format(filename, lineno, name)
+
+
+def thread_dump():
+    """ Name and stack (outermost frame first) of every thread """
+    frames = sys._current_frames()
+    dump = []
+    for thd in threading.enumerate():
+        frame = frames.get(thd.ident)
+        stack = traceback.extract_stack(frame) if frame else []
+        dump.append({
+            'name': thd.name,
+            'daemon': thd.daemon,
+            'stack': ['{} {}'.format(_where(f.filename, f.lineno, f.name), f.line) for f in stack]
+        })
+    return dump
+
+
+
+class SamplingProfiler(object):
+    """
+    Sample the stack of every thread every interval seconds from a thread of its own.
+
+    A function is counted as self when it is the innermost frame of a sample, as total when it is
+    anywhere on the stack. Threads blocked in a lock or a socket wait show up with their wait as the
+    innermost frame, which is what a stall looks like.
+    """
+
+    def __init__(self, interval=0.01):
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+        self._self = Counter()
+        self._total = Counter()
+        # innermost frame -> names of the threads it was sampled on
+        self._threads = {}
+        self.samples = 0
+
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='debug_sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stopped.wait(self._interval):
+            names = dict((thd.ident, thd.name) for thd in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                leaf = _where(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+                self._self[leaf] += 1
+                self._threads.setdefault(leaf, set()).add(names.get(ident, str(ident)))
+                seen = set()
+                while frame:
+                    code = frame.f_code
+                    if code not in seen:
+                        seen.add(code)
+                        self._total[_where(code.co_filename, code.co_firstlineno, code.co_name)] += 1
+                    frame = frame.f_back
+            self.samples += 1
+
+
+    def top(self, n):
+        return {
+            'self': [{'where': where, 'samples': count, 'threads': sorted(self._threads[where])}
+                     for where, count in self._self.most_common(n)],
+            'total': [{'where': where, 'samples': count} for where, count in self._total.most_common(n)]
+        }
+
+
+
+class LoopProfiler(object):
+    """
+    cProfile of the thread calling start() and stop(), the event loop thread: MQTT dispatch, rr
+    handlers and, with --engine asyncio, the drive ticks. Exact call counts and times, but blind to
+    the channel and rr threads, use SamplingProfiler for those.
+    """
+
+    def __init__(self):
+        self._profile = cProfile.Profile()
+        # function calls profiled, known after top()
+        self.samples = 0
+
+
+    def start(self):
+        self._profile.enable()
+
+
+    def stop(self):
+        self._profile.disable()
+
+
+    def top(self, n):
+        stats = pstats.Stats(self._profile).stats
+        self.samples = sum(nc for cc, nc, tt, ct, callers in stats.values())
+
+        def entries(index):
+            ranked = sorted(stats.items(), key=lambda item: item[1][index], reverse=True)[:n]
+            return [{'where': _where(*func), 'calls': value[1], 'self_seconds': value[2], 'total_seconds': value[3]}
+                    for func, value in ranked]
+        return {'self': entries(2), 'total': entries(3)}
+
+
+
+class ProfileRun(object):
+    """ A profiler started by rr/debug, and the requests waiting for its report """
+
+    def __init__(self, mode, top, interval=0.01):
+        self.mode = mode
+        self._top = top
+        self._profiler = SamplingProfiler(interval) if MODE_SAMPLE == mode else LoopProfiler()
+        self._started = None
+        # ServerSessions answered with the report
+        self.sessions = []
+        self.timer = None
+
+
+    def start(self):
+        self._started = time.monotonic()
+        self._profiler.start()
+
+
+    def stop(self):
+        """ Stop profiling, return the report: hot spots and the stacks of every thread at the end """
+        self._profiler.stop()
+        duration = time.monotonic() - self._started
+        top = self._profiler.top(self._top)
+        return {
+            'mode': self.mode,
+            'duration': duration,
+            'samples': self._profiler.samples,
+            'top': top,
+            'threads': thread_dump()
+        }
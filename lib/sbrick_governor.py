@@ -0,0 +1,152 @@
+import time
+from threading import Lock
+
+# ADC samples per second the governor needs, telemetry streams of a governed server never go below it
+GOVERNOR_RATE = 1.0
+
+REASON_THERMAL = 'thermal'
+REASON_VOLTAGE = 'voltage'
+
+
+class GovernorState(object):
+    """ Power scale of one SBrick and its throttling history """
+    __slots__ = ('sbrick_id', 'scale', 'reason', 'voltage', 'temperature', 'thermal_limit', 'updated',
+                 'throttled_since', 'throttled_seconds', 'throttles', 'lowest_scale')
+
+    def __init__(self, sbrick_id, now):
+        self.sbrick_id = sbrick_id
+        self.scale = 1.0
+        self.reason = None
+        self.voltage = None
+        self.temperature = None
+        self.thermal_limit = None
+        self.updated = now
+        # wall clock start of the current throttling, None when running at full power
+        self.throttled_since = None
+        self.throttled_seconds = 0.0
+        self.throttles = 0
+        self.lowest_scale = 1.0
+
+
+    def to_dict(self):
+        return {
+            'sbrick_id': self.sbrick_id,
+            'power_scale': self.scale,
+            'reason': self.reason,
+            'voltage': self.voltage,
+            'temperature': self.temperature,
+            'thermal_limit': self.thermal_limit,
+            'throttled_since': self.throttled_since,
+            'throttled_seconds': self.throttled_seconds,
+            'throttles': self.throttles,
+            'lowest_scale': self.lowest_scale,
+            'timestamp': time.time()
+        }
+
+
+
+class PowerGovernor(object):
+    """
+    Scale the drive power of SBricks approaching their thermal limit or with a sagging battery, so
+    they keep running slower instead of hitting the thermal cut-off.
+
+    update() is called by the telemetry thread with every ADC sample, nothing is read for the
+    governor on the drive path. The thermal scale falls linearly from 1 at thermal_band below the
+    thermal limit of the SBrick (0x15, read once) to min_scale at thermal_margin below it; the
+    voltage scale from 1 at voltage_knee to min_scale at voltage_floor. The lower one is applied
+    at once, a recovery rises by at most recovery per second, so a battery recovering under a lighter
+    load does not make the power oscillate.
+    """
+
+    def __init__(self, logger, thermal_band=15.0, thermal_margin=3.0, voltage_knee=6.0, voltage_floor=5.0, min_scale=0.4,
+                 recovery=0.1, metrics=None):
+        self._logger = logger
+        self._thermal_band = thermal_band
+        self._thermal_margin = thermal_margin
+        self._voltage_knee = voltage_knee
+        self._voltage_floor = voltage_floor
+        self._min_scale = min_scale
+        self._recovery = recovery
+        self._metrics = metrics
+        self._lock = Lock()
+        # sbrick_id -> GovernorState
+        self._states = {}
+
+
+    @staticmethod
+    def _ramp(value, full, lowest, min_scale):
+        """ 1 at full, min_scale at lowest and beyond, linear in between """
+        if full == lowest:
+            return 1.0 if value < lowest else min_scale
+        position = (value - full) / (lowest - full)
+        return 1.0 - (1.0 - min_scale) * min(1.0, max(0.0, position))
+
+
+    def target(self, voltage, temperature, thermal_limit):
+        """ (scale, reason) for a sample, reason is None at full power """
+        thermal = 1.0
+        if None != thermal_limit:
+            thermal = self._ramp(temperature, thermal_limit - self._thermal_band, thermal_limit - self._thermal_margin, self._min_scale)
+        battery = self._ramp(voltage, self._voltage_knee, self._voltage_floor, self._min_scale)
+        if thermal >= 1.0 and battery >= 1.0:
+            return 1.0, None
+        return (thermal, REASON_THERMAL) if thermal <= battery else (battery, REASON_VOLTAGE)
+
+
+    def update(self, sbrick, voltage, temperature):
+        """ Apply the power scale of a sample to sbrick. Return the state of the SBrick when its scale changed, else None """
+        sbrick_id = sbrick.dev_mac
+        if None == sbrick.thermal_limit:
+            # cached by get_info_general() too, a single 0x15 query otherwise
+            sbrick.sample_thermal_limit()
+        thermal_limit = sbrick.thermal_limit
+        target, reason = self.target(voltage, temperature, thermal_limit)
+
+        now = time.monotonic()
+        with self._lock:
+            state = self._states.get(sbrick_id)
+            if None == state:
+                state = GovernorState(sbrick_id, now)
+                self._states[sbrick_id] = state
+            previous = state.scale
+            if target < previous:
+                scale = target
+            else:
+                scale = min(target, previous + self._recovery * (now - state.updated))
+            if previous < 1.0:
+                state.throttled_seconds += now - state.updated
+            state.updated = now
+            state.voltage = voltage
+            state.temperature = temperature
+            state.thermal_limit = thermal_limit
+            state.scale = scale
+            if scale < 1.0:
+                # a recovering SBrick keeps the reason it was throttled for
+                state.reason = reason if reason else state.reason
+                state.lowest_scale = min(state.lowest_scale, scale)
+                if previous >= 1.0:
+                    state.throttles += 1
+                    state.throttled_since = time.time()
+            else:
+                state.reason = None
+                state.throttled_since = None
+            report = state.to_dict() if scale != previous else None
+
+        sbrick.power_scale = scale
+        if self._metrics:
+            self._metrics.set_gauge('governor_power_scale', scale, sbrick=sbrick_id)
+            if scale < 1.0 <= previous:
+                self._metrics.inc('governor_throttles_total', sbrick=sbrick_id)
+        if None == report:
+            return None
+        if previous >= 1.0:
+            self._logger.warning('Throttle SBrick ({}) to {:.0%} power: {} (voltage {:.2f}V, temperature {:.1f}C, thermal limit {})'.format(
+                sbrick_id, scale, report['reason'], voltage, temperature, thermal_limit))
+        elif scale >= 1.0:
+            self._logger.info('SBrick ({}) back to full power after {:.1f}s'.format(sbrick_id, report['throttled_seconds']))
+        return report
+
+
+    def forget(self, sbrick_id):
+        with self._lock:
+            self._states.pop(sbrick_id, None)
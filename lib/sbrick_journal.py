@@ -0,0 +1,165 @@
+import os
+import time
+import struct
+from threading import Thread, Lock, Event
+
+from lib.sbrick_trace import mac_to_bytes, bytes_to_mac
+
+JOURNAL_MAGIC = b'SBJOURN1'
+
+RECORD_STOP = 0
+RECORD_DRIVE = 1
+
+# SBrick MAC, record type, channel, direction, power, wall clock deadline (0 is forever)
+RECORD = struct.Struct('<6sBBBBd')
+
+
+class DriveJournal(object):
+    """
+    Append-only file of the commands of the running channels, for restoring them after a crash.
+
+    update() is called with every channel state change; it only packs a record when the command of
+    the channel changed and queues it in memory. A writer thread appends the queued records and
+    fsyncs every sync_interval seconds, so a crash loses at most that much. Once compact_records
+    records were appended the file is rewritten with one record per running channel.
+
+    A channel braked by a clean shutdown (SIGINT or SIGTERM) is journaled as stopped: only commands
+    cut off by a crash are restored.
+    """
+
+    def __init__(self, path, logger, sync_interval=0.5, compact_records=4096):
+        self._path = path
+        self._logger = logger
+        self._sync_interval = sync_interval
+        self._compact_records = compact_records
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = False
+        self._thread = None
+        self._fd = None
+        # records queued for the writer thread
+        self._pending = bytearray()
+        self._appended = 0
+        # (mac bytes, channel) -> last record, what a compaction writes
+        self._live = {}
+        self.syncs = 0
+
+
+    def open(self):
+        """
+        Read the journal left by the previous run, compact it and start the writer thread.
+        Return {SBRICK MAC (upper case): [(channel, direction, power, deadline), ...]} of the
+        commands still running at the end of the journal whose deadline has not passed, deadline
+        None is forever.
+        """
+        self._live = self._read()
+        now = time.time()
+        for key, record in list(self._live.items()):
+            deadline = RECORD.unpack(record)[5]
+            if RECORD_DRIVE != record[6] or (deadline and deadline <= now):
+                del self._live[key]
+        self._rewrite(list(self._live.values()))
+
+        restore = {}
+        for record in self._live.values():
+            mac, kind, channel, direction, power, deadline = RECORD.unpack(record)
+            restore.setdefault(bytes_to_mac(mac), []).append(
+                ('{:02x}'.format(channel), '{:02x}'.format(direction), '{:02x}'.format(power), deadline if deadline else None))
+
+        self._thread = Thread(target=self._run, name='journal')
+        self._thread.daemon = True
+        self._thread.start()
+        return restore
+
+
+    def _read(self):
+        live = {}
+        try:
+            with open(self._path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return live
+        if not data.startswith(JOURNAL_MAGIC):
+            self._logger.error('Drive journal {} is not a journal, start empty'.format(self._path))
+            return live
+        # a torn record at the end is a write the crash interrupted
+        end = len(data) - (len(data) - len(JOURNAL_MAGIC)) % RECORD.size
+        for offset in range(len(JOURNAL_MAGIC), end, RECORD.size):
+            record = data[offset:offset + RECORD.size]
+            live[(record[:6], record[7])] = record
+        return live
+
+
+    def _rewrite(self, records):
+        tmp = self._path + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, JOURNAL_MAGIC + b''.join(records))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, self._path)
+        if None != self._fd:
+            os.close(self._fd)
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND)
+        self._appended = 0
+
+
+    def update(self, sbrick_id, channel, state):
+        """ Journal a channel state of on_channel_state(), from any thread """
+        try:
+            mac = mac_to_bytes(sbrick_id)
+        except ValueError:
+            return
+        if state['running']:
+            record = RECORD.pack(mac, RECORD_DRIVE, int(channel, 16), int(state['direction'], 16), int(state['power'], 16),
+                                 state['deadline'] if state['deadline'] else 0.0)
+        else:
+            record = RECORD.pack(mac, RECORD_STOP, int(channel, 16), 0, 0, 0.0)
+        key = (mac, record[7])
+        with self._lock:
+            # a state change of the same command, e.g. a write result, is not journaled again
+            if self._live.get(key) == record:
+                return
+            self._live[key] = record
+            self._pending.extend(record)
+
+
+    def _run(self):
+        while not self._stopped:
+            # 0 fsyncs as soon as possible, without spinning
+            self._wakeup.wait(max(self._sync_interval, 0.01))
+            self.flush()
+
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, bytearray()
+            compact = self._appended + len(pending) // RECORD.size > self._compact_records
+            records = [record for record in self._live.values() if RECORD_DRIVE == record[6]] if compact else None
+        if None == self._fd:
+            return
+        try:
+            if compact:
+                # the live records include everything pending
+                self._rewrite(records)
+            elif pending:
+                os.write(self._fd, pending)
+                os.fsync(self._fd)
+                self._appended += len(pending) // RECORD.size
+            else:
+                return
+            self.syncs += 1
+        except OSError as e:
+            self._logger.error('Drive journal {}: {}'.format(self._path, e))
+
+
+    def close(self):
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+        if None != self._fd:
+            os.close(self._fd)
+            self._fd = None
@@ -1,15 +1,38 @@
 import sys
 import json
-import pyuv
+import time
 import logging
+import functools
+from collections import deque
+from threading import Thread, Lock, Event
 from lib.m2mipc import M2mipc, REQ_RESP_DONE, REQ_RESP_TIMEOUT
-from lib.sbrick_api import  SbrickAPI
+from lib.local_ipc import LocalIpcServer, LocalIpcClient
+from lib.aio_uv import uv_for, Loop as AioLoop, LoopProxy, AsyncCaller
+from lib.sbrick_api import  SbrickAPI, MAGIC_FOREVER
 from lib.sbrick_protocol import SbrickProtocol
+from lib.sbrick_profile import parse_profile, conn_param_to_dict
+from lib.sbrick_command import IngressDecoder, CHANNELS, REASON_UNKNOWN_SBRICK
+from lib.sbrick_state import ChannelStatePublisher, idle_state
+from lib.sbrick_telemetry import TelemetrySampler
+from lib.sbrick_governor import GOVERNOR_RATE
+from lib.sbrick_singleflight import SingleFlight, request_key
+from lib.sbrick_status import ServerStatus, offline_status, BRICK_CONNECTING, BRICK_READY, BRICK_LAZY, BRICK_FAILED
+from lib.sbrick_debug import ProfileRun, thread_dump, MODE_SAMPLE, MODE_CPROFILE, MAX_PROFILE_SECONDS, MIN_SAMPLE_INTERVAL
+
+# seconds a client waits for its I/O thread past the request timeout before checking it is still running
+IO_SLACK = 1.0
+
+# read-only rr actions: identical requests in flight share one BLE query
+SINGLE_FLIGHT_ACTIONS = ('get_service', 'get_adc', 'get_general', 'get_latency_profile')
 
 
 class SbrickIpcServer():
-    def __init__(self, logger, broker_ip, broker_port,loop, broker_user=None,broker_passwd=None):
+    def __init__(self, logger, broker_ip, broker_port,loop, broker_user=None,broker_passwd=None, metrics=None, metrics_interval=0, transport=None, trace=None, scan_service=None, lazy_connect=False, pool=None, shards=None, latency_profiles=None,
+                 telemetry_rate=0, telemetry_deadband=(0.05, 0.5), local_path=None,
+                 per_brick_topics=False, airtime=None, journal=None, governor=None):
         self._loop = loop
+        # --engine asyncio: drive ticks and rr handlers run BLE I/O in the executor of the loop
+        self._aio = loop if isinstance(loop, AioLoop) else None
         self._logger = logger
         self._broker_ip = broker_ip
         self._broker_port = broker_port
@@ -17,106 +40,746 @@ class SbrickIpcServer():
         self._broker_passwd = broker_passwd
         
         self._protocol = SbrickProtocol()
+        # validates sp/drive and sp/stop payloads into command objects
+        self._decoder = IngressDecoder()
+
+        # SbrickMetrics, None when metrics are disabled
+        self._metrics = metrics
+        # publish metrics to the retained metrics topic every metrics_interval seconds, 0 means never
+        self._metrics_interval = metrics_interval
+        self._metrics_timer = None
+
+        # transport of every SbrickAPI, None means the default bluepy one
+        self._transport = transport
+        # TraceRecorder shared by every SbrickAPI, None when tracing is disabled
+        self._trace = trace
+        # background ScanService answering rr/get_scan, None when disabled
+        self._scan_service = scan_service
+
+        # create SbrickAPI objects without connecting, the first command connects
+        self._lazy_connect = lazy_connect
+        # SbrickConnectionPool shared by every SbrickAPI, None when the live links are unbounded
+        self._pool = pool
+        # ShardManager placing SBricks on several BLE adapters, None means one adapter (transport and pool above)
+        self._shards = shards
+        # AirtimeScheduler of the adapter, None when GATT operations are unscheduled; shards have their own
+        self._airtime = airtime
+        # sbrick_id -> LatencyProfile, the None key is the profile of every other SBrick
+        self._latency_profiles = dict((SbrickProtocol.normalize_sbrick_id(sbrick_id), profile)
+                                      for sbrick_id, profile in (latency_profiles or {}).items())
+        # DriveJournal of the running channel commands, None when commands are not restored after a crash
+        self._journal = journal
+        # sbrick_id -> commands of the journal to restore once the SBrick is created
+        self._restore = {}
+        # PowerGovernor scaling the drive power by the telemetry samples, None drives at the commanded power
+        self._governor = governor
 
-        # sbrick_id -> sbrick object
+        # publishes the retained channel state topics, created on connect
+        self._state_publisher = None
+        # ADC samples per second of every SBrick, 0 means only on rr/telemetry request
+        self._telemetry_rate = telemetry_rate
+        # default (voltage, temperature) deadbands of telemetry streams
+        self._telemetry_deadband = telemetry_deadband
+        self._telemetry = None
+        # Unix socket path serving the same sp/rr topics to clients on this host, None when disabled
+        self._local_path = local_path
+        self._local_server = None
+        # subscribe to the per-brick topics of the own SBricks only, instead of the shared sp/rr topics
+        self._per_brick_topics = per_brick_topics
+        self._mqtt_connected = False
+        # identical read-only requests in flight, and the loop caller their responses are published through
+        self._single_flight = SingleFlight()
+        self._loop_caller = None
+        # ProfileRun started by rr/debug, None when no profiler runs
+        self._profile_run = None
+        # readiness published to the retained status topic and to systemd, created on connect
+        self._status = None
+
+        # sbrick_id (upper case MAC) -> sbrick object, changed on the loop thread only
         self._sbrick_map = {}
+        # sbrick_id of rr/attach requests still connecting
+        self._attaching = set()
+        self._attach_lock = Lock()
 
 
-    def connect(self, sbrick_list):
+    def connect(self, sbrick_list, wait=True):
+        """
+        Connect to the MQTT broker and to the SBricks of sbrick_list. Unless wait, the SBricks are
+        connected one after the other by a thread, once the event loop runs; the status topic tells
+        which ones are ready.
+        """
         # connect to MQTT broker
         m2m = M2mipc('sbrick_server', self._loop)
         m2m.on_connect = self._on_mqtt_connect
         if self._broker_user is not None or self._broker_passwd is not None:
             m2m.username_pw_set(self._broker_user, password=self._broker_passwd)
+        m2m.will_set(self._protocol.gen_status_topic(), json.dumps(offline_status()), retain=True)
 
         m2m.connect(self._broker_ip, self._broker_port)
         self._m2mipc = m2m
+        if self._local_path:
+            self._local_server = LocalIpcServer(self._logger, self._loop, m2m, self._local_path)
+            self._local_server.start()
+        self._state_publisher = ChannelStatePublisher(self._loop, m2m, self._protocol)
+        self._status = ServerStatus(self._state_publisher.publish, self._protocol.gen_status_topic())
+        self._loop_caller = self._aio if self._aio else AsyncCaller(self._loop)
+        self._telemetry = TelemetrySampler(self._logger, self._sbrick_map.get, self._publish_telemetry, metrics=self._metrics,
+                                           on_sample=self._on_telemetry_sample if self._governor else None)
+        self._telemetry.start()
+        if self._journal:
+            self._restore = self._journal.open()
+
+        if self._metrics and self._metrics_interval > 0:
+            timer = uv_for(self._loop).Timer(self._loop)
+            timer.start(self._on_metrics_timer, self._metrics_interval, self._metrics_interval)
+            self._metrics_timer = timer
+
+        if self._scan_service:
+            self._scan_service.start()
+        if self._shards:
+            self._shards.start()
 
         # connect to sbrick
+        sbrick_list = [SbrickProtocol.normalize_sbrick_id(sbrick_id) for sbrick_id in sbrick_list]
+        for sbrick_id in sbrick_list:
+            self._status.brick(sbrick_id, BRICK_CONNECTING)
+        if not wait:
+            thd = Thread(target=self._bring_up, args=(sbrick_list,))
+            thd.setName('bring_up')
+            thd.daemon = True
+            thd.start()
+            return
         for sbrick_id in sbrick_list:
-            sbrick = SbrickAPI(logger=self._logger, dev_mac=sbrick_id)
-            sbrick.disconnect_ex()
-            sbrick.connect()
+            # a SBrick which fails to connect is kept, its first command connects again
+            sbrick = self._new_sbrick(sbrick_id)
+            connected = self._lazy_connect or self._connect_sbrick(sbrick)
             self._sbrick_map[sbrick_id] = sbrick
+            self._start_sbrick(sbrick_id, sbrick)
+            if not connected:
+                self._status.brick(sbrick_id, BRICK_FAILED)
+            else:
+                self._status.brick(sbrick_id, BRICK_LAZY if self._lazy_connect else BRICK_READY)
+
+
+    def _bring_up(self, sbrick_list):
+        # the same path as rr/attach: a SBrick takes commands once it is connected, one which fails is reported and skipped
+        for sbrick_id in sbrick_list:
+            self.attach(sbrick_id)
+
+
+    def _new_sbrick(self, sbrick_id):
+        """ SbrickAPI placed on its adapter, not connected yet """
+        transport, pool, airtime = self._transport, self._pool, self._airtime
+        if self._shards:
+            shard = self._shards.assign(sbrick_id)
+            transport, pool, airtime = shard.transport, shard.pool, shard.airtime
+        profile = self._latency_profiles.get(sbrick_id, self._latency_profiles.get(None, None))
+        sbrick = SbrickAPI(logger=self._logger, dev_mac=sbrick_id, metrics=self._metrics, transport=transport, trace=self._trace,
+                           pool=pool, latency_profile=profile, on_channel_state=self._on_channel_state, engine=self._aio,
+                           airtime=airtime)
+        if self._shards:
+            self._shards.register(sbrick)
+        return sbrick
+
+
+    def _connect_sbrick(self, sbrick):
+        """ Blocking. Return False when the SBrick is unreachable """
+        sbrick.disconnect_ex()
+        return sbrick.connect()
+
+
+    def _discard_sbrick(self, sbrick):
+        """ Undo _new_sbrick() of a SBrick which failed to connect: its pool slot and its adapter placement """
+        sbrick.disconnect()
+        if self._shards:
+            self._shards.release(sbrick.dev_mac)
+        for airtime in self._airtime_schedulers():
+            airtime.forget(sbrick.dev_mac)
+
+
+    def _start_sbrick(self, sbrick_id, sbrick):
+        """ Publish, sample and restore a SBrick once it is in the map, the telemetry thread looks it up there """
+        # late joiners get a state of every channel, not only of the driven ones
+        for channel in CHANNELS:
+            self._state_publisher.update(sbrick_id, channel, idle_state())
+        rate = self._telemetry_rate
+        if self._governor:
+            # only sampled while linked: a lazy or evicted SBrick is neither connected nor governed by its stream
+            rate = max(rate, GOVERNOR_RATE)
+        if rate > 0:
+            self._telemetry.subscribe(sbrick_id, rate, *self._telemetry_deadband)
+        self._restore_commands(sbrick_id, sbrick)
+
+
+    def _on_channel_state(self, sbrick_id, channel, state):
+        # called by the drive threads
+        if self._journal:
+            self._journal.update(sbrick_id, channel, state)
+        self._state_publisher.update(sbrick_id, channel, state)
+
+
+    def _restore_commands(self, sbrick_id, sbrick):
+        """ Drive the commands the journal of the previous run left running, for the time they have left """
+        now = time.time()
+        for channel, direction, power, deadline in self._restore.pop(sbrick_id, []):
+            if None == deadline:
+                exec_time = MAGIC_FOREVER
+            elif deadline > now:
+                exec_time = deadline - now
+            else:
+                continue
+            self._logger.info('Restore drive of SBrick ({}) channel {}: direction {} power {} for {}'.format(
+                sbrick_id, channel, direction, power, 'ever' if None == deadline else '{:.1f}s'.format(exec_time)))
+            sbrick.drive(channel=channel, direction=direction, power=power, exec_time=exec_time)
+            if self._metrics:
+                self._metrics.inc('journal_restored_total', sbrick=sbrick_id)
+
+
+    def attach(self, sbrick_id, lazy=None):
+        """
+        Add a SBrick at runtime. Blocking, it connects unless lazy: call it off the event loop thread.
+        The SBrick is added to the map and its topics subscribed on the loop thread, anything the
+        caller hands to self._loop_caller after attach() returns runs after that.
+        Return a ret_code of SbrickProtocol.
+        """
+        sbrick_id = SbrickProtocol.normalize_sbrick_id(sbrick_id)
+        lazy = self._lazy_connect if None == lazy else lazy
+        with self._attach_lock:
+            if sbrick_id in self._sbrick_map:
+                return SbrickProtocol.CODE_SUCCESS
+            if sbrick_id in self._attaching:
+                return SbrickProtocol.CODE_ERR_BUSY
+            self._attaching.add(sbrick_id)
+
+        self._status.brick(sbrick_id, BRICK_CONNECTING)
+        sbrick = self._new_sbrick(sbrick_id)
+        try:
+            connected = lazy or self._connect_sbrick(sbrick)
+        except SystemExit:
+            # SbrickAPI exits on unrecoverable bluepy errors, an operator typo must not kill the daemon
+            connected = False
+        if not connected:
+            self._logger.error('Attach SBrick ({}) failed'.format(sbrick_id))
+            self._discard_sbrick(sbrick)
+            self._status.brick(sbrick_id, BRICK_FAILED)
+            with self._attach_lock:
+                self._attaching.discard(sbrick_id)
+            return SbrickProtocol.CODE_ERR_COMMON
+
+        # the loop iterates the map and dispatches the topics
+        self._loop_caller.call_soon_threadsafe(self._add_sbrick, sbrick_id, sbrick, lazy)
+        self._logger.info('Attach SBrick ({}){}'.format(sbrick_id, ' lazily' if lazy else ''))
+        return SbrickProtocol.CODE_SUCCESS
+
+
+    def _add_sbrick(self, sbrick_id, sbrick, lazy):
+        # on the loop thread: still attaching until it is in the map, a second attach is busy meanwhile
+        self._sbrick_map[sbrick_id] = sbrick
+        with self._attach_lock:
+            self._attaching.discard(sbrick_id)
+        if self._per_brick_topics and self._mqtt_connected:
+            self._register_sbrick_topics(sbrick_id)
+        self._start_sbrick(sbrick_id, sbrick)
+        # ready once commands find it
+        self._status.brick(sbrick_id, BRICK_LAZY if lazy else BRICK_READY)
+
+
+    def detach(self, sbrick_id):
+        """ Stop the running channels of a SBrick, disconnect and forget it """
+        sbrick_id = SbrickProtocol.normalize_sbrick_id(sbrick_id)
+        sbrick = self._sbrick_map.pop(sbrick_id, None)
+        if None == sbrick:
+            return SbrickProtocol.CODE_ERR_PARM
+        if self._per_brick_topics:
+            # the executor of --engine asyncio runs detach, the topics change on the loop thread
+            self._loop_caller.call_soon_threadsafe(self._unregister_sbrick_topics, sbrick_id)
+        self._telemetry.unsubscribe(sbrick_id)
+        sbrick.stop_all()
+        sbrick.wait_stopped(timeout=2)
+        sbrick.disconnect()
+        self._state_publisher.clear(sbrick_id, CHANNELS)
+        self._state_publisher.publish(self._protocol.gen_telemetry_topic(sbrick_id), None)
+        self._status.brick(sbrick_id, None)
+        if self._governor:
+            self._governor.forget(sbrick_id)
+            self._state_publisher.publish(self._protocol.gen_governor_topic(sbrick_id), None)
+        for airtime in self._airtime_schedulers():
+            airtime.forget(sbrick_id)
+        if self._shards:
+            self._shards.release(sbrick_id)
+        self._logger.info('Detach SBrick ({})'.format(sbrick_id))
+        return SbrickProtocol.CODE_SUCCESS
 
 
     def disconnect(self):
         self._logger.info('Disconnect from mosquitto broker {}:{}'.format(self._broker_ip, self._broker_port))
+        if self._metrics_timer:
+            self._metrics_timer.stop()
+        if self._scan_service:
+            self._scan_service.stop()
+        if self._shards:
+            self._shards.stop()
+        self._telemetry.stop()
+        self._status.stopping()
+
+        # stop the channels first, their final states are published before leaving the broker
+        for sbrick_id, sbrick in list(self._sbrick_map.items()):
+            sbrick.stop_all()
+        for sbrick_id, sbrick in list(self._sbrick_map.items()):
+            sbrick.wait_stopped(timeout=2)
+        if self._profile_run:
+            self._finish_profile()
+        self._status.close()
+        self._state_publisher.close()
+        if None == self._aio:
+            self._loop_caller.close()
+        if self._local_server:
+            self._local_server.stop()
         self._m2mipc.disconnect()
 
-        for sbrick_id, sbrick in self._sbrick_map.items():
+        for sbrick_id, sbrick in list(self._sbrick_map.items()):
             sbrick.disconnect()
 
+        if self._trace:
+            self._trace.close()
+        # after stop_all, the channels are journaled as stopped and nothing is restored on the next start
+        if self._journal:
+            self._journal.close()
+
+
+    def _airtime_schedulers(self):
+        if self._shards:
+            return [shard.airtime for shard in self._shards.shards if shard.airtime]
+        return [self._airtime] if self._airtime else []
+
 
     def _get_sbrick(self, sbrick_id):
-        obj = self._sbrick_map.get(sbrick_id, None)
+        obj = self._sbrick_map.get(SbrickProtocol.normalize_sbrick_id(sbrick_id), None)
         if None == obj:
             self._logger.error('Wrong SBrick MAC ({})'.format(sbrick_id))
         return obj
 
 
+    def _publish_telemetry(self, sbrick_id, voltage, temperature):
+        # called by the telemetry thread, the state publisher hands it to the event loop
+        self._state_publisher.publish(self._protocol.gen_telemetry_topic(sbrick_id), {
+            'sbrick_id': sbrick_id,
+            'voltage': voltage,
+            'temperature': temperature,
+            'timestamp': time.time()
+        })
+
+
+    def _on_telemetry_sample(self, sbrick, voltage, temperature):
+        # called by the telemetry thread with every sample
+        report = self._governor.update(sbrick, voltage, temperature)
+        if report:
+            self._state_publisher.publish(self._protocol.gen_governor_topic(sbrick.dev_mac), report)
+
+
+    def _on_metrics_timer(self, timer):
+        self._m2mipc.publish(self._protocol.gen_metrics_topic(), self._metrics.render_prometheus(), retain=True)
+
+
+    def _observe_handler(self, name, start, sbrick_id, action):
+        metrics = self._metrics
+        metrics.observe(name, metrics.now() - start, sbrick=sbrick_id, action=action)
+
+
     def _on_mqtt_connect(self, client, userdata, flags, rc):
         if 0 == rc:
             self._logger.info('Connect to mosquitto broker {}:{}'.format(self._broker_ip, self._broker_port))
-            self._m2mipc.register_subscribe(self._protocol.gen_sp_topic('drive'), self, self._on_subscribe_drive)
-            self._m2mipc.register_subscribe(self._protocol.gen_sp_topic('stop'), self, self._on_subscribe_stop)
+            self._m2mipc.register_server(self._protocol.gen_rr_topic('get_scan'), self, self._offload(self._on_rr_get_scan))
+            self._m2mipc.register_server(self._protocol.gen_rr_topic('get_airtime'), self, self._offload(self._on_rr_get_airtime))
+            # attach connects in a thread of its own
+            self._m2mipc.register_server(self._protocol.gen_rr_topic('attach'), self, self._on_rr_attach)
+            self._m2mipc.register_server(self._protocol.gen_rr_topic('detach'), self, self._offload(self._on_rr_detach))
+            # on the loop thread: a cProfile run profiles the thread which starts it
+            self._m2mipc.register_server(self._protocol.gen_rr_topic('debug'), self, self._on_rr_debug)
+
+            self._mqtt_connected = True
+            if self._per_brick_topics:
+                for sbrick_id in list(self._sbrick_map):
+                    self._register_sbrick_topics(sbrick_id)
+            else:
+                self._register_sbrick_topics(None)
+            self._status.mqtt_up()
+
+
+    def _offload(self, handler):
+        """ asyncio engine: run a rr handler in the executor, its response is published from the loop thread """
+        if None == self._aio:
+            return handler
+
+        @functools.wraps(handler)
+        def offloaded(request, userdata, json_msg):
+            self._aio.run_blocking(functools.partial(handler, LoopProxy(self._aio, request), userdata, json_msg))
+            return REQ_RESP_DONE
+        return offloaded
+
 
-            self._m2mipc.register_server(self._protocol.gen_rr_topic('get_service'), self, self._on_rr_get_service)
-            self._m2mipc.register_server(self._protocol.gen_rr_topic('get_adc'), self, self._on_rr_get_adc)
-            self._m2mipc.register_server(self._protocol.gen_rr_topic('get_general'), self, self._on_rr_get_general)
+    def _single_flight_handler(self, action, handler):
+        """
+        Run a read-only rr handler once for every identical request in flight. The handler runs off the
+        loop (executor, or a thread with pyuv) so requests arriving meanwhile can join it; its response
+        is published to every joined session from the loop thread.
+        """
+        @functools.wraps(handler)
+        def single_flight(request, userdata, json_msg):
+            key = request_key(action, json_msg)
+            if None == key:
+                return self._offload(handler)(request, userdata, json_msg)
+            if self._single_flight.join(key, request):
+                if self._metrics:
+                    self._metrics.inc('rr_deduplicated_total', action=action)
+                return REQ_RESP_DONE
+
+            fan_out = LoopProxy(self._loop_caller, SingleFlight.FanOut(self._single_flight, key))
+            job = functools.partial(self._run_single_flight, handler, fan_out, userdata, json_msg, key)
+            if self._aio:
+                self._aio.run_blocking(job)
+            else:
+                thd = Thread(target=job)
+                thd.setName('rr_' + action)
+                thd.daemon = True
+                thd.start()
+            return REQ_RESP_DONE
+        return single_flight
+
+
+    def _run_single_flight(self, handler, fan_out, userdata, json_msg, key):
+        try:
+            handler(fan_out, userdata, json_msg)
+        finally:
+            # queued behind the response; a handler which failed answers nobody, its sessions time out
+            self._loop_caller.call_soon_threadsafe(self._single_flight.finish, key)
+
+
+    def _sbrick_handlers(self):
+        """ (sp handlers, rr handlers) of the actions addressed to one SBrick """
+        sp = (('drive', self._on_subscribe_drive),
+              ('stop', self._on_subscribe_stop))
+        rr = (('get_service', self._on_rr_get_service),
+              ('get_adc', self._on_rr_get_adc),
+              ('get_general', self._on_rr_get_general),
+              ('set_latency_profile', self._on_rr_set_latency_profile),
+              ('get_latency_profile', self._on_rr_get_latency_profile),
+              ('telemetry', self._on_rr_telemetry))
+        return sp, rr
+
+
+    def _register_sbrick_topics(self, sbrick_id):
+        """ Subscribe to the topics of one SBrick, or to the shared ones when sbrick_id is None """
+        sp, rr = self._sbrick_handlers()
+        for action, handler in sp:
+            self._m2mipc.register_subscribe(self._protocol.gen_sp_topic(action, sbrick_id), self, handler)
+        for action, handler in rr:
+            if action in SINGLE_FLIGHT_ACTIONS:
+                handler = self._single_flight_handler(action, handler)
+            else:
+                handler = self._offload(handler)
+            self._m2mipc.register_server(self._protocol.gen_rr_topic(action, sbrick_id), self, handler)
+
+
+    def _unregister_sbrick_topics(self, sbrick_id):
+        sp, rr = self._sbrick_handlers()
+        for action, handler in sp:
+            self._m2mipc.unregister_subscribe(self._protocol.gen_sp_topic(action, sbrick_id))
+        for action, handler in rr:
+            self._m2mipc.unregister_server(self._protocol.gen_rr_topic(action, sbrick_id))
 
 
     def _on_rr_get_service(self, request, userdata, json_msg):
+        start = self._metrics.now() if self._metrics else None
         message = json.loads(json_msg)
         self._logger.debug('Accept get_service() event: {}'.format(message))
         sbrick = self._get_sbrick(message['sbrick_id'])
         services = sbrick.get_info_service() if sbrick else self._protocol.gen_rr_get_service_response(ret_code=SbrickProtocol.CODE_ERR_PARM, msg={})
         rc = request.send_response(services)
+        if None != start:
+            self._observe_handler('rr_handler_seconds', start, message['sbrick_id'], 'get_service')
         return rc
 
 
     def _on_rr_get_adc(self, request, userdata, json_msg):
+        start = self._metrics.now() if self._metrics else None
         message = json.loads(json_msg)
         self._logger.debug('Accept get_adc() event: {}'.format(message))
         sbrick = self._get_sbrick(message['sbrick_id'])
         adc = sbrick.get_info_adc() if sbrick else self._protocol.gen_rr_get_adc_response(ret_code=SbrickProtocol.CODE_ERR_PARM, msg={})
         rc = request.send_response(adc)
+        if None != start:
+            self._observe_handler('rr_handler_seconds', start, message['sbrick_id'], 'get_adc')
         return rc
 
 
     def _on_rr_get_general(self, request, userdata, json_msg):
+        start = self._metrics.now() if self._metrics else None
         message = json.loads(json_msg)
         self._logger.debug('Accept get_general() event: {}'.format(message))
         sbrick = self._get_sbrick(message['sbrick_id'])
         general = sbrick.get_info_general() if sbrick else self._protocol.gen_rr_get_general_response(ret_code=SbrickProtocol.CODE_ERR_PARM, msg={})
         rc = request.send_response(general)
+        if None != start:
+            self._observe_handler('rr_handler_seconds', start, message['sbrick_id'], 'get_general')
+        return rc
+
+
+    def _on_rr_get_scan(self, request, userdata, json_msg):
+        start = self._metrics.now() if self._metrics else None
+        message = json.loads(json_msg)
+        self._logger.debug('Accept get_scan() event: {}'.format(message))
+        sbrick_id = message.get('sbrick_id', None)
+        if None == self._scan_service:
+            devices = self._protocol.gen_rr_get_scan_response(ret_code=SbrickProtocol.CODE_ERR_COMMON, msg=[])
+        else:
+            attached = set(self._sbrick_map)
+            snapshot = self._scan_service.registry.snapshot()
+            if sbrick_id:
+                snapshot = [dev for dev in snapshot if dev['sbrick_id'] == sbrick_id.upper()]
+            for dev in snapshot:
+                dev['attached'] = dev['sbrick_id'] in attached
+            devices = self._protocol.gen_rr_get_scan_response(ret_code=SbrickProtocol.CODE_SUCCESS, msg=snapshot)
+        rc = request.send_response(devices)
+        if None != start:
+            self._observe_handler('rr_handler_seconds', start, sbrick_id if sbrick_id else '', 'get_scan')
+        return rc
+
+
+    def _on_rr_get_airtime(self, request, userdata, json_msg):
+        message = json.loads(json_msg)
+        self._logger.debug('Accept get_airtime() event: {}'.format(message))
+        sbrick_id = SbrickProtocol.normalize_sbrick_id(message.get('sbrick_id', None))
+        schedulers = self._airtime_schedulers()
+        if not schedulers:
+            return request.send_response(self._protocol.gen_rr_get_airtime_response(ret_code=SbrickProtocol.CODE_ERR_COMMON, msg=[]))
+        usage = []
+        for airtime in schedulers:
+            usage.extend(airtime.usage(sbrick_id))
+        return request.send_response(self._protocol.gen_rr_get_airtime_response(ret_code=SbrickProtocol.CODE_SUCCESS, msg=usage))
+
+
+    def _on_rr_debug(self, request, userdata, json_msg):
+        message = json.loads(json_msg)
+        self._logger.debug('Accept debug() event: {}'.format(message))
+        action = message.get('action', 'threads')
+        if 'threads' == action:
+            return request.send_response(self._protocol.gen_rr_debug_response(ret_code=SbrickProtocol.CODE_SUCCESS, msg={'threads': thread_dump()}))
+        if 'stop' == action:
+            if None == self._profile_run:
+                return request.send_response(self._protocol.gen_rr_debug_response(ret_code=SbrickProtocol.CODE_ERR_COMMON, msg={}))
+            # the report goes to the starting request and to this one
+            self._profile_run.sessions.append(request)
+            self._finish_profile()
+            return REQ_RESP_DONE
+
+        mode = message.get('mode', MODE_SAMPLE)
+        duration = message.get('duration', 5)
+        top = message.get('top', 20)
+        interval = message.get('interval', 0.01)
+        numbers = (duration, top, interval)
+        if 'start' != action or mode not in (MODE_SAMPLE, MODE_CPROFILE) or \
+                any(isinstance(v, bool) or not isinstance(v, (int, float)) or v <= 0 for v in numbers) or \
+                not isinstance(top, int) or duration > MAX_PROFILE_SECONDS:
+            return request.send_response(self._protocol.gen_rr_debug_response(ret_code=SbrickProtocol.CODE_ERR_PARM, msg={}))
+        # a shorter interval turns the sampler into a busy loop
+        interval = max(interval, MIN_SAMPLE_INTERVAL)
+        if self._profile_run:
+            return request.send_response(self._protocol.gen_rr_debug_response(ret_code=SbrickProtocol.CODE_ERR_BUSY, msg={}))
+
+        self._logger.info('Start {} profiler for {}s'.format(mode, duration))
+        run = ProfileRun(mode, top, interval)
+        run.sessions.append(request)
+        run.timer = uv_for(self._loop).Timer(self._loop)
+        run.timer.start(lambda handle: self._finish_profile(), duration, 0)
+        self._profile_run = run
+        run.start()
+        # answered with the report when the profile ends
+        return REQ_RESP_DONE
+
+
+    def _finish_profile(self):
+        run, self._profile_run = self._profile_run, None
+        run.timer.stop()
+        run.timer.close()
+        report = run.stop()
+        self._logger.info('Stop {} profiler after {:.1f}s'.format(run.mode, report['duration']))
+        response = self._protocol.gen_rr_debug_response(ret_code=SbrickProtocol.CODE_SUCCESS, msg=report)
+        for session in run.sessions:
+            session.send_response(response)
+
+
+    def _on_rr_attach(self, request, userdata, json_msg):
+        message = json.loads(json_msg)
+        self._logger.debug('Accept attach() event: {}'.format(message))
+        sbrick_id = message.get('sbrick_id', None)
+        if not SbrickProtocol.is_sbrick_id(sbrick_id):
+            return request.send_response(self._protocol.gen_rr_attach_response(ret_code=SbrickProtocol.CODE_ERR_PARM, sbrick_id=sbrick_id))
+
+        # connecting blocks for seconds, keep the event loop and the other bricks running; the response
+        # is queued to the loop behind the map insert, a client driving on success finds the SBrick
+        request = LoopProxy(self._loop_caller, request)
+        thd = Thread(target=self._attach_worker, args=(request, sbrick_id, message.get('lazy', None)))
+        thd.setName('attach_' + sbrick_id)
+        thd.daemon = True
+        thd.start()
+        return REQ_RESP_DONE
+
+
+    def _attach_worker(self, request, sbrick_id, lazy):
+        start = self._metrics.now() if self._metrics else None
+        ret_code = self.attach(sbrick_id, lazy)
+        request.send_response(self._protocol.gen_rr_attach_response(ret_code=ret_code, sbrick_id=sbrick_id))
+        if None != start:
+            self._observe_handler('rr_handler_seconds', start, sbrick_id, 'attach')
+
+
+    def _on_rr_detach(self, request, userdata, json_msg):
+        start = self._metrics.now() if self._metrics else None
+        message = json.loads(json_msg)
+        self._logger.debug('Accept detach() event: {}'.format(message))
+        sbrick_id = message.get('sbrick_id', None)
+        ret_code = self.detach(sbrick_id)
+        rc = request.send_response(self._protocol.gen_rr_attach_response(ret_code=ret_code, sbrick_id=sbrick_id))
+        if None != start:
+            self._observe_handler('rr_handler_seconds', start, sbrick_id, 'detach')
+        return rc
+
+
+    def _latency_profile_response(self, sbrick_id, profile, conn_param):
+        msg = {
+            'sbrick_id': sbrick_id,
+            'profile': profile.to_dict() if profile else None,
+            'effective': conn_param_to_dict(conn_param) if conn_param else None,
+            # nothing requested means nothing to verify
+            'verified': None != conn_param and (None == profile or conn_param == profile.params())
+        }
+        ret_code = SbrickProtocol.CODE_SUCCESS if msg['verified'] else SbrickProtocol.CODE_ERR_COMMON
+        return self._protocol.gen_rr_latency_profile_response(ret_code=ret_code, msg=msg)
+
+
+    def _on_rr_set_latency_profile(self, request, userdata, json_msg):
+        start = self._metrics.now() if self._metrics else None
+        message = json.loads(json_msg)
+        self._logger.debug('Accept set_latency_profile() event: {}'.format(message))
+        sbrick_id = SbrickProtocol.normalize_sbrick_id(message.get('sbrick_id', None))
+        sbrick = self._get_sbrick(sbrick_id)
+        try:
+            profile = parse_profile(message.get('profile', None))
+        except ValueError as e:
+            self._logger.error(e)
+            sbrick = None
+        if not sbrick:
+            return request.send_response(self._protocol.gen_rr_latency_profile_response(ret_code=SbrickProtocol.CODE_ERR_PARM, msg={'sbrick_id': sbrick_id}))
+
+        self._latency_profiles[sbrick_id] = profile
+        conn_param = sbrick.apply_latency_profile(profile)
+        rc = request.send_response(self._latency_profile_response(sbrick_id, profile, conn_param))
+        if None != start:
+            self._observe_handler('rr_handler_seconds', start, sbrick_id, 'set_latency_profile')
+        return rc
+
+
+    def _on_rr_get_latency_profile(self, request, userdata, json_msg):
+        start = self._metrics.now() if self._metrics else None
+        message = json.loads(json_msg)
+        self._logger.debug('Accept get_latency_profile() event: {}'.format(message))
+        sbrick_id = message.get('sbrick_id', None)
+        sbrick = self._get_sbrick(sbrick_id)
+        if not sbrick:
+            return request.send_response(self._protocol.gen_rr_latency_profile_response(ret_code=SbrickProtocol.CODE_ERR_PARM, msg={'sbrick_id': sbrick_id}))
+
+        # read the parameters back from the SBrick, not from the cache
+        conn_param = sbrick.get_conn_param()
+        rc = request.send_response(self._latency_profile_response(sbrick_id, sbrick.latency_profile, conn_param))
+        if None != start:
+            self._observe_handler('rr_handler_seconds', start, sbrick_id, 'get_latency_profile')
         return rc
 
 
+    def _on_rr_telemetry(self, request, userdata, json_msg):
+        message = json.loads(json_msg)
+        self._logger.debug('Accept telemetry() event: {}'.format(message))
+        sbrick_id = SbrickProtocol.normalize_sbrick_id(message.get('sbrick_id', None))
+        rate = message.get('rate', None)
+        deadband_voltage = message.get('deadband_voltage', self._telemetry_deadband[0])
+        deadband_temperature = message.get('deadband_temperature', self._telemetry_deadband[1])
+        numbers = (rate, deadband_voltage, deadband_temperature)
+        if not self._get_sbrick(sbrick_id) or any(isinstance(v, bool) or not isinstance(v, (int, float)) or v < 0 for v in numbers):
+            return request.send_response(self._protocol.gen_rr_telemetry_response(ret_code=SbrickProtocol.CODE_ERR_PARM, msg={'sbrick_id': sbrick_id}))
+
+        if self._governor:
+            # the governor throttles by the samples of the stream, it can be slowed down to GOVERNOR_RATE but not stopped
+            if 0 == rate:
+                stream = self._telemetry.get(sbrick_id)
+                msg = stream.to_dict() if stream else {'sbrick_id': sbrick_id}
+                return request.send_response(self._protocol.gen_rr_telemetry_response(ret_code=SbrickProtocol.CODE_ERR_PARM, msg=msg))
+            rate = max(rate, GOVERNOR_RATE)
+        stream = self._telemetry.subscribe(sbrick_id, rate, deadband_voltage, deadband_temperature)
+        msg = stream.to_dict() if stream else {'sbrick_id': sbrick_id}
+        return request.send_response(self._protocol.gen_rr_telemetry_response(ret_code=SbrickProtocol.CODE_SUCCESS, msg=msg))
+
+
+    def _reject(self, action, msg, reason):
+        self._logger.warning('Reject {}() event ({}): {}'.format(action, reason, msg))
+        if self._metrics:
+            self._metrics.inc('ingress_rejected_total', action=action, reason=reason)
+
+
     def _on_subscribe_drive(self, client, userdata, topic, msg):
-        self._logger.debug('Accept drive() event: {}'.format(msg))
-        sbrick = self._get_sbrick(msg['sbrick_id'])
+        start = self._metrics.now() if self._metrics else None
+        self._logger.debug('Accept drive() event: %s', msg)
+        command, reason = self._decoder.decode_drive(msg)
+        if reason:
+            return self._reject('drive', msg, reason)
+        sbrick = self._get_sbrick(command.sbrick_id)
         if not sbrick:
-            return
-        # TODO: validate param
-        sbrick.drive(channel=msg['channel'], direction=msg['direction'], power=msg['power'], exec_time=msg['exec_time'])
+            return self._reject('drive', msg, REASON_UNKNOWN_SBRICK)
+        sbrick.drive(channel=command.channel, direction=command.direction, power=command.power, exec_time=command.exec_time,
+                     arrival=start, frame=command.frame)
+        if None != start:
+            self._observe_handler('mqtt_dispatch_seconds', start, command.sbrick_id, 'drive')
 
 
     def _on_subscribe_stop(self, client, userdata, topic, msg):
-        self._logger.debug('Accept sopt() evnet: {}'.format(msg))
-        # TODO: validate param
-        sbrick = self._sbrick_map[msg['sbrick_id']]
-        sbrick.stop(channels=msg['channels'])
+        start = self._metrics.now() if self._metrics else None
+        self._logger.debug('Accept stop() event: %s', msg)
+        command, reason = self._decoder.decode_stop(msg)
+        if reason:
+            return self._reject('stop', msg, reason)
+        sbrick = self._get_sbrick(command.sbrick_id)
+        if not sbrick:
+            return self._reject('stop', msg, REASON_UNKNOWN_SBRICK)
+        sbrick.stop(channels=command.channels)
+        if None != start:
+            self._observe_handler('mqtt_dispatch_seconds', start, command.sbrick_id, 'stop')
 
 
 
 class SbrickIpcClient():
-    def __init__(self, logger=None, broker_ip='127.0.0.1', broker_port=1883):
-        self._loop = pyuv.Loop.default_loop()
+    def __init__(self, logger=None, broker_ip='127.0.0.1', broker_port=1883, name='sbrick_client', loop=None, local_path=None, per_brick_topics=False,
+                 background=False):
+        # MQTT client id, must be unique per broker
+        self._name = name
+        if None == loop:
+            # pyuv is only loaded by a client without a loop of its own, not by a --engine asyncio server
+            import pyuv
+            loop = pyuv.Loop.default_loop()
+        self._loop = loop
         """ Important. The base time of event loop is cahced at the earliest running """
         self._loop.update_time()
         self._broker_ip = broker_ip
         self._broker_port = broker_port
+        # talk to a server on this host over its --local-socket instead of the broker
+        self._local_path = local_path
+        # address SBrick commands to sbrick/01/sp/<action>/<sbrick_id>, for servers started with --per-brick-topics
+        self._per_brick_topics = per_brick_topics
+        # run the event loop in an I/O thread from connect() to disconnect(), instead of inside rr_* calls only
+        self._background = background
+        self._io_thread = None
+        # calls handed from caller threads to the I/O thread
+        self._io_jobs = deque()
+        self._io_async = None
         self._json_response = None
         self._protocol = SbrickProtocol()
 
@@ -139,59 +802,223 @@ class SbrickIpcClient():
 
 
     def connect(self): 
-        m2m = M2mipc('sbrick_client', self._loop)
-        m2m.on_connect = self._on_mqtt_connect
-        m2m.connect(self._broker_ip, self._broker_port)
+        if self._local_path:
+            m2m = LocalIpcClient(self._name, self._loop)
+            m2m.connect(self._local_path)
+            self._logger.info('Connect to local socket {}'.format(self._local_path))
+        else:
+            m2m = M2mipc(self._name, self._loop)
+            m2m.on_connect = self._on_mqtt_connect
+            m2m.connect(self._broker_ip, self._broker_port)
         self._m2mipc = m2m
 
+        if self._background:
+            self._io_async = uv_for(self._loop).Async(self._loop, self._on_io_jobs)
+            self._io_thread = Thread(target=self._loop.run, name='{}_io'.format(self._name))
+            self._io_thread.daemon = True
+            self._io_thread.start()
+
 
     def disconnect(self):
-        self._logger.info('Disconnect from mosquitto broker {}:{}'.format(self._broker_ip, self._broker_port))
+        if self._local_path:
+            self._logger.info('Disconnect from local socket {}'.format(self._local_path))
+        else:
+            self._logger.info('Disconnect from mosquitto broker {}:{}'.format(self._broker_ip, self._broker_port))
+        if self._io_thread:
+            # queued publishes go out first, then the loop stops
+            self._call_soon(self._stop_io)
+            self._io_thread.join()
+            self._io_thread = None
+        else:
+            self._m2mipc.disconnect()
+
+
+    def _call_soon(self, func, *args):
+        """ Call func on the thread running the event loop: the I/O thread in background mode, else right here """
+        if None == self._io_thread:
+            return func(*args)
+        self._io_jobs.append(functools.partial(func, *args))
+        self._io_async.send()
+
+
+    def _on_io_jobs(self, handle):
+        jobs = self._io_jobs
+        while jobs:
+            jobs.popleft()()
+
+
+    def _stop_io(self):
         self._m2mipc.disconnect()
+        self._io_async.close()
+        self._loop.stop()
+
+
+    def _topic_id(self, sbrick_id):
+        # the server subscribes to the upper case MAC
+        return SbrickProtocol.normalize_sbrick_id(sbrick_id) if self._per_brick_topics else None
 
 
     def publish_drive(self, sbrick_id, channel, direction, power, exec_time):
-        topic = self._protocol.gen_sp_topic('drive')
+        topic = self._protocol.gen_sp_topic('drive', self._topic_id(sbrick_id))
         json_payload = json.dumps(self._protocol.gen_sp_drive(sbrick_id, channel, direction, power, exec_time))
-        self._m2mipc.publish(topic, json_payload)
+        self._call_soon(self._m2mipc.publish, topic, json_payload)
+
+
+    def publish_drive_many(self, commands):
+        """
+        Publish a drive per (sbrick_id, channel, direction, power, exec_time) of commands. The payloads
+        are built first and written in one pass, instead of one socket write per drive.
+        """
+        messages = []
+        for sbrick_id, channel, direction, power, exec_time in commands:
+            messages.append((self._protocol.gen_sp_topic('drive', self._topic_id(sbrick_id)),
+                             json.dumps(self._protocol.gen_sp_drive(sbrick_id, channel, direction, power, exec_time))))
+        self._call_soon(self._m2mipc.publish_many, messages)
 
 
     def publish_stop(self, sbrick_id, channel_list):
-        topic = self._protocol.gen_sp_topic('stop')
+        topic = self._protocol.gen_sp_topic('stop', self._topic_id(sbrick_id))
         json_payload = json.dumps(self._protocol.gen_sp_stop(sbrick_id, channel_list))
-        self._m2mipc.publish(topic, json_payload)
+        self._call_soon(self._m2mipc.publish, topic, json_payload)
+
+
+    def subscribe_channel_state(self, on_state, sbrick_id='+'):
+        """
+        Call on_state(state) with the retained state of every channel of sbrick_id ('+' is every SBrick),
+        then on every change. States arrive while the event loop runs, on the I/O thread in background mode.
+        """
+        topic = self._protocol.gen_state_topic(SbrickProtocol.normalize_sbrick_id(sbrick_id), '+')
+        self._call_soon(self._m2mipc.register_subscribe, topic, self, lambda client, userdata, topic, msg: on_state(msg))
+
+
+    def subscribe_telemetry(self, on_sample, sbrick_id='+'):
+        """
+        Call on_sample(sample) with the retained voltage and temperature of sbrick_id ('+' is every SBrick),
+        then on every published sample. Samples arrive while the event loop runs, on the I/O thread in background mode.
+        """
+        topic = self._protocol.gen_telemetry_topic(SbrickProtocol.normalize_sbrick_id(sbrick_id))
+        self._call_soon(self._m2mipc.register_subscribe, topic, self, lambda client, userdata, topic, msg: on_sample(msg))
+
+
+    def subscribe_status(self, on_status):
+        """
+        Call on_status(status) with the retained server status, then on every change: 'state' (starting,
+        ready, stopping, offline) and the status of every SBrick. Status arrive while the event loop runs,
+        on the I/O thread in background mode.
+        """
+        topic = self._protocol.gen_status_topic()
+        self._call_soon(self._m2mipc.register_subscribe, topic, self, lambda client, userdata, topic, msg: on_status(msg))
+
+
+    def subscribe_governor(self, on_report, sbrick_id='+'):
+        """
+        Call on_report(report) with the retained power governor report of sbrick_id ('+' is every SBrick),
+        then on every change of its power scale. Reports arrive while the event loop runs, on the I/O thread in background mode.
+        """
+        topic = self._protocol.gen_governor_topic(SbrickProtocol.normalize_sbrick_id(sbrick_id))
+        self._call_soon(self._m2mipc.register_subscribe, topic, self, lambda client, userdata, topic, msg: on_report(msg))
+
+
+    def rr_telemetry(self, sbrick_id, rate, timeout, deadband_voltage=None, deadband_temperature=None):
+        topic = self._protocol.gen_rr_topic('telemetry')
+        json_payload = json.dumps(self._protocol.gen_rr_telemetry(sbrick_id, rate, deadband_voltage, deadband_temperature))
+        return self._request(self._protocol.gen_rr_topic('telemetry', self._topic_id(sbrick_id)), topic, json_payload, timeout)
 
 
     def rr_get_service(self, sbrick_id, timeout):
         topic = self._protocol.gen_rr_topic('get_service')
         json_payload = json.dumps(self._protocol.gen_rr_request(sbrick_id))
-        client = self._m2mipc.prepare_request(topic, topic, self._on_rr_resp, timeout)
-        client.send(json_payload)
-        self._loop.run()
-        return self._json_response
+        return self._request(self._protocol.gen_rr_topic('get_service', self._topic_id(sbrick_id)), topic, json_payload, timeout)
         
 
     def rr_get_adc(self, sbrick_id, timeout):
         topic = self._protocol.gen_rr_topic('get_adc')
         json_payload = json.dumps(self._protocol.gen_rr_request(sbrick_id))
-        client = self._m2mipc.prepare_request(topic, topic, self._on_rr_resp, timeout)
-        client.send(json_payload)
-        self._loop.run()
-        return self._json_response
+        return self._request(self._protocol.gen_rr_topic('get_adc', self._topic_id(sbrick_id)), topic, json_payload, timeout)
 
 
     def rr_get_general(self, sbrick_id, timeout):
         topic = self._protocol.gen_rr_topic('get_general')
         json_payload = json.dumps(self._protocol.gen_rr_request(sbrick_id))
-        client = self._m2mipc.prepare_request(topic, topic, self._on_rr_resp, timeout)
-        client.send(json_payload)
-        self._loop.run()
-        return self._json_response
+        return self._request(self._protocol.gen_rr_topic('get_general', self._topic_id(sbrick_id)), topic, json_payload, timeout)
+
+
+    def rr_attach(self, sbrick_id, timeout, lazy=None):
+        topic = self._protocol.gen_rr_topic('attach')
+        json_payload = json.dumps(self._protocol.gen_rr_attach(sbrick_id, lazy))
+        return self._request(topic, topic, json_payload, timeout)
+
+
+    def rr_detach(self, sbrick_id, timeout):
+        topic = self._protocol.gen_rr_topic('detach')
+        json_payload = json.dumps(self._protocol.gen_rr_request(sbrick_id))
+        return self._request(topic, topic, json_payload, timeout)
+
+
+    def rr_set_latency_profile(self, sbrick_id, profile, timeout):
+        topic = self._protocol.gen_rr_topic('set_latency_profile')
+        json_payload = json.dumps(self._protocol.gen_rr_set_latency_profile(sbrick_id, profile))
+        return self._request(self._protocol.gen_rr_topic('set_latency_profile', self._topic_id(sbrick_id)), topic, json_payload, timeout)
+
+
+    def rr_get_latency_profile(self, sbrick_id, timeout):
+        topic = self._protocol.gen_rr_topic('get_latency_profile')
+        json_payload = json.dumps(self._protocol.gen_rr_request(sbrick_id))
+        return self._request(self._protocol.gen_rr_topic('get_latency_profile', self._topic_id(sbrick_id)), topic, json_payload, timeout)
+
+
+    def rr_get_airtime(self, sbrick_id=None, timeout=5):
+        topic = self._protocol.gen_rr_topic('get_airtime')
+        json_payload = json.dumps(self._protocol.gen_rr_request(sbrick_id))
+        return self._request(topic, topic, json_payload, timeout)
+
+
+    def rr_debug(self, timeout, action='threads', mode=None, duration=None, top=None, interval=None):
+        topic = self._protocol.gen_rr_topic('debug')
+        json_payload = json.dumps(self._protocol.gen_rr_debug(action, mode, duration, top, interval))
+        return self._request(topic, topic, json_payload, timeout)
+
+
+    def rr_get_scan(self, sbrick_id=None, timeout=5):
+        topic = self._protocol.gen_rr_topic('get_scan')
+        json_payload = json.dumps(self._protocol.gen_rr_request(sbrick_id))
+        return self._request(topic, topic, json_payload, timeout)
+
+
+    def _request(self, rr_topic, userdata, json_payload, timeout):
+        if None == self._io_thread:
+            client = self._m2mipc.prepare_request(rr_topic, userdata, self._on_rr_resp, timeout)
+            client.send(json_payload)
+            self._loop.run()
+            return self._json_response
+
+        # the I/O thread runs the loop, wait for the response there. Requests of several threads may be in flight,
+        # each returns its own response; json_response is only the last one, as without the I/O thread
+        done = Event()
+        result = []
+        def on_resp(status, userdata, msg):
+            result.append(self._gen_response(status, userdata, msg))
+            done.set()
+        self._call_soon(lambda: self._m2mipc.prepare_request(rr_topic, userdata, on_resp, timeout).send(json_payload))
+        # the I/O thread answers a timeout itself, the slack only covers an I/O thread which is gone
+        while not done.wait(timeout + IO_SLACK):
+            if None == self._io_thread or not self._io_thread.is_alive():
+                self._logger.error('I/O thread is gone, {} request not answered'.format(rr_topic))
+                result.append(self._gen_response(REQ_RESP_TIMEOUT, userdata, {}))
+                break
+        response = result[0]
+        self._json_response = response
+        return response
 
 
     def _on_rr_resp(self, status, userdata, msg):
+        self._json_response = self._gen_response(status, userdata, msg)
+        self._loop.stop()
+
+
+    def _gen_response(self, status, userdata, msg):
         if REQ_RESP_DONE == status:
-            ret_code =  msg['ret_code'] if 'ret_code' in msg else SbrickProtocol.CODE_SUCCESS
+            ret_code =  msg['ret_code'] if isinstance(msg, dict) and 'ret_code' in msg else SbrickProtocol.CODE_SUCCESS
         elif REQ_RESP_TIMEOUT == status:
             msg = {}
             ret_code = SbrickProtocol.CODE_ERR_TIMEOUT
@@ -202,10 +1029,20 @@ class SbrickIpcClient():
             response = self._protocol.gen_rr_get_service_response(ret_code=ret_code, msg=msg)
         elif userdata == self._protocol.gen_rr_topic('get_general'):
             response = self._protocol.gen_rr_get_general_response(ret_code=ret_code, msg=msg)
+        elif userdata == self._protocol.gen_rr_topic('get_scan'):
+            response = self._protocol.gen_rr_get_scan_response(ret_code=ret_code, msg=msg.get('devices', []))
+        elif userdata in (self._protocol.gen_rr_topic('attach'), self._protocol.gen_rr_topic('detach')):
+            response = self._protocol.gen_rr_attach_response(ret_code=ret_code, sbrick_id=msg.get('sbrick_id', None))
+        elif userdata in (self._protocol.gen_rr_topic('set_latency_profile'), self._protocol.gen_rr_topic('get_latency_profile')):
+            response = self._protocol.gen_rr_latency_profile_response(ret_code=ret_code, msg=msg)
+        elif userdata == self._protocol.gen_rr_topic('telemetry'):
+            response = self._protocol.gen_rr_telemetry_response(ret_code=ret_code, msg=msg)
+        elif userdata == self._protocol.gen_rr_topic('get_airtime'):
+            response = self._protocol.gen_rr_get_airtime_response(ret_code=ret_code, msg=msg.get('bricks', []))
+        elif userdata == self._protocol.gen_rr_topic('debug'):
+            response = self._protocol.gen_rr_debug_response(ret_code=ret_code, msg=msg)
 
-        self._json_response = json.dumps(response)
-
-        self._loop.stop()
+        return json.dumps(response)
  
 
     @property
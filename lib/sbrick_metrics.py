@@ -0,0 +1,194 @@
+import time
+from bisect import bisect_left
+from threading import Lock, Thread
+
+# Upper bounds (seconds) of latency histogram buckets
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram(object):
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        # the last slot counts samples above the largest bucket (+Inf)
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        self.counts[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+
+class SbrickMetrics(object):
+    """
+    Counters, gauges and latency histograms of the server hot path.
+
+    Samples are keyed by metric name and label pairs, e.g. ('gatt_write_seconds', (('sbrick', '11:22:..'),)).
+    Callers keep a None reference instead of an instance when metrics are disabled, so the
+    disabled cost is a single attribute test.
+    """
+
+    HELP = {
+        'mqtt_dispatch_seconds': ('histogram', 'Time spent in a MQTT subscribe handler'),
+        'drive_latency_seconds': ('histogram', 'Time from MQTT drive arrival to the end of the GATT write'),
+        'lock_wait_seconds': ('histogram', 'Time spent waiting for the SBrick bluepy lock'),
+        'lock_held_seconds': ('histogram', 'Time the SBrick bluepy lock is held'),
+        'gatt_write_seconds': ('histogram', 'Duration of a GATT write to the rcc characteristic'),
+        'gatt_read_seconds': ('histogram', 'Duration of a GATT read from the rcc characteristic'),
+        'rr_handler_seconds': ('histogram', 'Duration of a request-response handler'),
+        'reconnect_total': ('counter', 'Number of SBrick re-connections'),
+        'queue_depth': ('gauge', 'Number of threads holding or waiting for the SBrick bluepy lock'),
+        'pool_live_links': ('gauge', 'Number of live BLE links in the connection pool'),
+        'pool_evictions_total': ('counter', 'Number of SBricks disconnected to make room in the connection pool'),
+        'adapter_sbricks': ('gauge', 'Number of SBricks placed on a BLE adapter'),
+        'adapter_down_total': ('counter', 'Number of times a BLE adapter went down'),
+        'ingress_rejected_total': ('counter', 'Number of sp/drive and sp/stop messages rejected by the ingress decoder, labelled by reason'),
+        'telemetry_samples_total': ('counter', 'Number of ADC samples taken by the telemetry stream'),
+        'airtime_seconds_total': ('counter', 'Seconds a SBrick held the radio for GATT operations, labelled by traffic class'),
+        'airtime_wait_seconds': ('histogram', 'Time a GATT operation waited for its airtime grant, labelled by traffic class'),
+        'rr_deduplicated_total': ('counter', 'Number of rr requests answered by an identical request in flight'),
+        'conn_interval_seconds': ('gauge', 'Maximum BLE connection interval read back from the SBrick'),
+        'journal_restored_total': ('counter', 'Number of channel commands restored from the drive journal after a crash'),
+        'governor_power_scale': ('gauge', 'Drive power multiplier applied by the power governor'),
+        'governor_throttles_total': ('counter', 'Number of times the power governor throttled a SBrick at full power'),
+    }
+
+    def __init__(self, prefix='sbrick'):
+        self._prefix = prefix
+        self._lock = Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+
+    @staticmethod
+    def now():
+        return time.monotonic()
+
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+
+    def add_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+
+    def set_gauge(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if None == hist:
+                hist = Histogram()
+                self._histograms[key] = hist
+            hist.observe(seconds)
+
+
+    def snapshot(self):
+        """ Return a JSON friendly copy of every sample """
+        ret = {'counters': [], 'gauges': [], 'histograms': []}
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                ret['counters'].append({'name': name, 'labels': dict(labels), 'value': value})
+            for (name, labels), value in self._gauges.items():
+                ret['gauges'].append({'name': name, 'labels': dict(labels), 'value': value})
+            for (name, labels), hist in self._histograms.items():
+                ret['histograms'].append({
+                    'name': name,
+                    'labels': dict(labels),
+                    'buckets': list(LATENCY_BUCKETS),
+                    'counts': list(hist.counts),
+                    'sum': hist.sum,
+                    'count': hist.count
+                })
+        return ret
+
+
+    def render_prometheus(self):
+        """ Render every sample in Prometheus text exposition format (version 0.0.4) """
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted((key, (list(h.counts), h.sum, h.count)) for key, h in self._histograms.items())
+
+        described = set()
+        for (name, labels), value in counters + gauges:
+            self._describe(lines, described, name)
+            lines.append('{}{} {}'.format(self._full_name(name), self._format_labels(labels), value))
+
+        for (name, labels), (counts, total, count) in histograms:
+            self._describe(lines, described, name)
+            full_name = self._full_name(name)
+            cumulative = 0
+            for bound, bucket_count in zip(LATENCY_BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = labels + (('le', str(bound)),)
+                lines.append('{}_bucket{} {}'.format(full_name, self._format_labels(le), cumulative))
+            lines.append('{}_sum{} {}'.format(full_name, self._format_labels(labels), total))
+            lines.append('{}_count{} {}'.format(full_name, self._format_labels(labels), count))
+
+        return '\n'.join(lines) + '\n'
+
+
+    def _full_name(self, name):
+        return '{}_{}'.format(self._prefix, name)
+
+
+    def _describe(self, lines, described, name):
+        if name in described:
+            return
+        described.add(name)
+        kind, text = self.HELP.get(name, ('untyped', name))
+        lines.append('# HELP {} {}'.format(self._full_name(name), text))
+        lines.append('# TYPE {} {}'.format(self._full_name(name), kind))
+
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        pairs = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels]
+        return '{' + ','.join(pairs) + '}'
+
+
+
+def start_http_exporter(metrics, port, host='0.0.0.0'):
+    """ Serve metrics.render_prometheus() on http://host:port/metrics from a daemon thread """
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            """ Keep the scraper quiet """
+            pass
+
+    httpd = HTTPServer((host, port), MetricsHandler)
+    thd = Thread(target=httpd.serve_forever, name='metrics_http')
+    thd.daemon = True
+    thd.start()
+    return httpd
@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+class SbrickConnectionPool(object):
+    """
+    Bound on the number of live BLE links of one adapter.
+
+    SbrickAPI calls make_room() before it connects and touch() on every frame. When the pool is full,
+    make_room() disconnects the least recently used SBricks which are not pinned (running channels or
+    a multi-frame query in progress). An evicted SBrick reconnects on its next command.
+    """
+
+    def __init__(self, max_links, logger, metrics=None, adapter=None):
+        self._max_links = max_links
+        self._logger = logger
+        self._metrics = metrics
+        # metric labels, one pool per adapter when SBricks are sharded over adapters
+        self._labels = {'adapter': adapter} if adapter else {}
+        self._lock = Lock()
+        # dev_mac -> SbrickAPI, least recently used first
+        self._live = OrderedDict()
+        self.evictions = 0
+
+
+    def make_room(self, sbrick):
+        dev_mac = sbrick.dev_mac
+        victims = []
+        with self._lock:
+            self._live.pop(dev_mac, None)
+            excess = len(self._live) + 1 - self._max_links
+            for other_mac, other in list(self._live.items()):
+                if excess <= 0:
+                    break
+                if other.is_pinned():
+                    continue
+                del self._live[other_mac]
+                victims.append(other)
+                excess -= 1
+            self._live[dev_mac] = sbrick
+            live = len(self._live)
+
+        if excess > 0:
+            self._logger.warning('Connection pool over capacity ({}/{}), every live SBrick is pinned'.format(live, self._max_links))
+
+        # disconnect outside the pool lock, a victim may be waiting for it while holding its own lock
+        for victim in victims:
+            self._logger.info('Evict SBrick ({}) from connection pool'.format(victim.dev_mac))
+            victim.release_link()
+            self.evictions += 1
+            if self._metrics:
+                self._metrics.inc('pool_evictions_total', sbrick=victim.dev_mac, **self._labels)
+        if self._metrics:
+            self._metrics.set_gauge('pool_live_links', live, **self._labels)
+
+
+    def touch(self, sbrick):
+        with self._lock:
+            if sbrick.dev_mac in self._live:
+                self._live.move_to_end(sbrick.dev_mac)
+
+
+    def release(self, sbrick):
+        with self._lock:
+            self._live.pop(sbrick.dev_mac, None)
+            live = len(self._live)
+        if self._metrics:
+            self._metrics.set_gauge('pool_live_links', live, **self._labels)
+
+
+    def live(self):
+        """ MACs of live links, least recently used first """
+        with self._lock:
+            return list(self._live.keys())
+
+
+    @property
+    def max_links(self):
+        return self._max_links
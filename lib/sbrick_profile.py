@@ -0,0 +1,85 @@
+import re
+
+# BLE connection interval unit, 1.25 ms
+INTERVAL_UNIT = 1.25
+# BLE limits of a connection interval (7.5 ms ~ 4 s) and of the slave latency
+INTERVAL_MIN = 6
+INTERVAL_MAX = 3200
+LATENCY_MAX = 499
+
+PROFILE_SPEC_PATTERN = re.compile('^([0-9.]+):([0-9.]+):([0-9]+)$')
+
+
+class LatencyProfile(object):
+    """
+    BLE connection parameters a SBrick requests with opcode 0x24.
+
+    min_interval, max_interval : connection interval in 1.25 ms units
+    latency                    : connection events the SBrick may skip when it has nothing to send
+    """
+    __slots__ = ('name', 'min_interval', 'max_interval', 'latency')
+
+    def __init__(self, name, min_interval, max_interval, latency=0):
+        if min_interval < INTERVAL_MIN or max_interval > INTERVAL_MAX or min_interval > max_interval:
+            raise ValueError('Connection interval must be {} ~ {} ms'.format(INTERVAL_MIN * INTERVAL_UNIT, INTERVAL_MAX * INTERVAL_UNIT))
+        if latency < 0 or latency > LATENCY_MAX:
+            raise ValueError('Slave latency must be 0 ~ {}'.format(LATENCY_MAX))
+        self.name = name
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.latency = latency
+
+
+    def params(self):
+        return (self.min_interval, self.max_interval, self.latency)
+
+
+    def to_dict(self):
+        return conn_param_to_dict(self.params(), name=self.name)
+
+
+    def __str__(self):
+        return '{} ({}~{} ms, latency {})'.format(self.name, self.min_interval * INTERVAL_UNIT,
+                                                  self.max_interval * INTERVAL_UNIT, self.latency)
+
+
+
+# drive: short interval for the lowest command latency
+# balanced: the SBrick default
+# telemetry: long interval and skipped events, for bricks only polled for ADC
+LATENCY_PROFILES = {
+    'drive': LatencyProfile('drive', 6, 12, 0),
+    'balanced': LatencyProfile('balanced', 24, 40, 0),
+    'telemetry': LatencyProfile('telemetry', 80, 400, 4),
+}
+
+
+def conn_param_to_dict(params, name=None):
+    min_interval, max_interval, latency = params
+    ret = {
+        'min_interval_ms': min_interval * INTERVAL_UNIT,
+        'max_interval_ms': max_interval * INTERVAL_UNIT,
+        'latency': latency
+    }
+    if None != name:
+        ret['profile'] = name
+    return ret
+
+
+def parse_profile(spec):
+    """
+    Return the LatencyProfile of a profile name (drive, balanced, telemetry) or of a
+    MIN_MS:MAX_MS:LATENCY spec, e.g. 10:20:0. Raise ValueError on anything else.
+    """
+    if not isinstance(spec, str):
+        raise ValueError('Latency profile must be a string')
+    profile = LATENCY_PROFILES.get(spec.lower())
+    if profile:
+        return profile
+
+    result = PROFILE_SPEC_PATTERN.match(spec)
+    if not result:
+        raise ValueError('Unknown latency profile {}, expect {} or MIN_MS:MAX_MS:LATENCY'.format(spec, ' | '.join(sorted(LATENCY_PROFILES))))
+    min_interval = int(round(float(result.group(1)) / INTERVAL_UNIT))
+    max_interval = int(round(float(result.group(2)) / INTERVAL_UNIT))
+    return LatencyProfile(spec, min_interval, max_interval, int(result.group(3)))
@@ -1,15 +1,43 @@
+import re
+
+SBRICK_ID_PATTERN = re.compile('^[0-9A-Fa-f]{2}(:[0-9A-Fa-f]{2}){5}$')
+
+
 class SbrickProtocol(object):
     def __init__(self):
         self.module = 'sbrick'
         self.version = '01'
 
 
-    def gen_sp_topic(self, action):
-        return "{module}/{version}/sp/{action}".format(action=action, **(self.__dict__))
+    def gen_sp_topic(self, action, sbrick_id=None):
+        topic = "{module}/{version}/sp/{action}".format(action=action, **(self.__dict__))
+        # per-brick topic, the broker only delivers it to the server owning the SBrick
+        return topic + '/' + sbrick_id if sbrick_id else topic
     
 
-    def gen_rr_topic(self, action):
-        return "{module}/{version}/rr/{action}".format(action=action, **(self.__dict__))
+    def gen_rr_topic(self, action, sbrick_id=None):
+        topic = "{module}/{version}/rr/{action}".format(action=action, **(self.__dict__))
+        return topic + '/' + sbrick_id if sbrick_id else topic
+
+
+    def gen_state_topic(self, sbrick_id, channel):
+        return "{module}/{version}/state/{sbrick_id}/{channel}".format(sbrick_id=sbrick_id, channel=channel, **(self.__dict__))
+
+
+    def gen_telemetry_topic(self, sbrick_id):
+        return "{module}/{version}/telemetry/{sbrick_id}".format(sbrick_id=sbrick_id, **(self.__dict__))
+
+
+    def gen_governor_topic(self, sbrick_id):
+        return "{module}/{version}/governor/{sbrick_id}".format(sbrick_id=sbrick_id, **(self.__dict__))
+
+
+    def gen_status_topic(self):
+        return "{module}/{version}/status".format(**(self.__dict__))
+
+
+    def gen_metrics_topic(self):
+        return "{module}/{version}/metrics".format(**(self.__dict__))
 
 
     def gen_rr_request(self, sbrick_id):
@@ -17,6 +45,41 @@ class SbrickProtocol(object):
         return request
 
 
+    def gen_rr_attach(self, sbrick_id, lazy=None):
+        request = {'sbrick_id': sbrick_id}
+        if None != lazy:
+            request['lazy'] = lazy
+        return request
+
+
+    def gen_rr_set_latency_profile(self, sbrick_id, profile):
+        request = {
+            'sbrick_id': sbrick_id,
+            'profile': profile
+        }
+        return request
+
+
+    def gen_rr_telemetry(self, sbrick_id, rate, deadband_voltage=None, deadband_temperature=None):
+        request = {
+            'sbrick_id': sbrick_id,
+            'rate': rate
+        }
+        if None != deadband_voltage:
+            request['deadband_voltage'] = deadband_voltage
+        if None != deadband_temperature:
+            request['deadband_temperature'] = deadband_temperature
+        return request
+
+
+    def gen_rr_debug(self, action, mode=None, duration=None, top=None, interval=None):
+        request = {'action': action}
+        for key, value in (('mode', mode), ('duration', duration), ('top', top), ('interval', interval)):
+            if None != value:
+                request[key] = value
+        return request
+
+
     def gen_sp_drive(self, sbrick_id, channel, direction, power, exec_time):
         payload = {
             'sbrick_id': sbrick_id,
@@ -53,6 +116,64 @@ class SbrickProtocol(object):
         return response
 
 
+    def gen_rr_attach_response(self, ret_code, sbrick_id):
+        response = {
+            'ret_code': ret_code,
+            'sbrick_id': sbrick_id
+        }
+        return response
+
+
+    def gen_rr_get_scan_response(self, ret_code, msg):
+        response = {
+            'ret_code': ret_code,
+            'devices': msg
+        }
+        return response
+
+
+    def gen_rr_get_airtime_response(self, ret_code, msg):
+        response = {
+            'ret_code': ret_code,
+            'bricks': msg
+        }
+        return response
+
+
+    def gen_rr_debug_response(self, ret_code, msg):
+        response = {
+            'ret_code': ret_code,
+            'mode': msg.get('mode', None),
+            'duration': msg.get('duration', None),
+            'samples': msg.get('samples', None),
+            'top': msg.get('top', None),
+            'threads': msg.get('threads', [])
+        }
+        return response
+
+
+    def gen_rr_latency_profile_response(self, ret_code, msg):
+        response = {
+            'ret_code': ret_code,
+            'sbrick_id': msg.get('sbrick_id', None),
+            'profile': msg.get('profile', None),
+            'effective': msg.get('effective', None),
+            'verified': msg.get('verified', False)
+        }
+        return response
+
+
+    def gen_rr_telemetry_response(self, ret_code, msg):
+        response = {
+            'ret_code': ret_code,
+            'sbrick_id': msg.get('sbrick_id', None),
+            'rate': msg.get('rate', 0),
+            'deadband_voltage': msg.get('deadband_voltage', None),
+            'deadband_temperature': msg.get('deadband_temperature', None)
+        }
+        return response
+
+
     def gen_rr_get_general_response(self, ret_code, msg):
         response = {
             'ret_code': ret_code,
@@ -63,13 +184,26 @@ class SbrickProtocol(object):
             'thermal_limit': msg.get('thermal_limit', None),
             'is_quest_password_set': msg.get('is_quest_password_set', None),
             'power_cycle_count': msg.get('power_cycle_count', None),
-            'uptime_count': msg.get('uptime_count', None)
+            'uptime_count': msg.get('uptime_count', None),
+            'conn_param': msg.get('conn_param', None)
         }
         return response
 
 
+    @staticmethod
+    def is_sbrick_id(sbrick_id):
+        return isinstance(sbrick_id, str) and None != SBRICK_ID_PATTERN.match(sbrick_id)
+
+
+    @staticmethod
+    def normalize_sbrick_id(sbrick_id):
+        """ Upper-case MAC, the key of a SBrick on the server; anything but a string is returned as is """
+        return sbrick_id.upper() if isinstance(sbrick_id, str) else sbrick_id
+
+
 
 SbrickProtocol.CODE_SUCCESS = 100
 SbrickProtocol.CODE_ERR_COMMON = 200
+SbrickProtocol.CODE_ERR_BUSY = 210
 SbrickProtocol.CODE_ERR_PARM = 220
 SbrickProtocol.CODE_ERR_TIMEOUT = 300
@@ -0,0 +1,126 @@
+import time
+from threading import Thread, Event, Lock
+
+# Vengit Ltd. (SBrick) Bluetooth SIG company identifier 0x0198, little endian in manufacturer data
+SBRICK_MANUFACTURER_PREFIX = '9801'
+
+
+class ScanRegistry(object):
+    """ Nearby SBricks seen by the background scanner, keyed by MAC """
+
+    def __init__(self, ttl=120):
+        # drop devices not seen for ttl seconds
+        self._ttl = ttl
+        self._lock = Lock()
+        self._devices = {}
+
+
+    def update(self, addr, rssi, connectable, addr_type, iface, manufacturer):
+        now = time.time()
+        with self._lock:
+            dev = self._devices.get(addr.upper())
+            # every adapter hears a SBrick with its own signal strength
+            rssi_by_iface = dict(dev['rssi_by_iface']) if dev else {}
+            rssi_by_iface[iface] = rssi
+            self._devices[addr.upper()] = {
+                'sbrick_id': addr.upper(),
+                'rssi': rssi,
+                'connectable': connectable,
+                'addr_type': addr_type,
+                'iface': iface,
+                'rssi_by_iface': rssi_by_iface,
+                'manufacturer': manufacturer,
+                'last_seen': now
+            }
+
+
+    def expire(self):
+        deadline = time.time() - self._ttl
+        with self._lock:
+            for addr in [addr for addr, dev in self._devices.items() if dev['last_seen'] < deadline]:
+                del self._devices[addr]
+
+
+    def get(self, sbrick_id):
+        with self._lock:
+            dev = self._devices.get(sbrick_id.upper())
+            return dict(dev) if dev else None
+
+
+    def snapshot(self):
+        """ Copy of every device, strongest signal first, with the age of the last advertisement """
+        now = time.time()
+        with self._lock:
+            devices = [dict(dev) for dev in self._devices.values()]
+        for dev in devices:
+            dev['age'] = round(now - dev['last_seen'], 3)
+        devices.sort(key=lambda dev: dev['rssi'], reverse=True)
+        return devices
+
+
+
+class ScanService(Thread):
+    """
+    Background BLE scanner feeding a ScanRegistry.
+
+    Scans for `window` seconds every `interval` seconds and keeps the devices whose manufacturer
+    data (ScanAPI.ad_type_manufacturer) starts with `manufacturer_prefix`. The scanner is cleared
+    before every window, so last_seen and rssi are refreshed by every advertisement.
+    `transport` may be a list of the transports of several adapters, they scan one after another.
+    """
+
+    ad_type_manufacturer = 255
+
+    def __init__(self, logger, transport, registry, window=5, interval=30, passive=True,
+                 manufacturer_prefix=SBRICK_MANUFACTURER_PREFIX):
+        Thread.__init__(self)
+        self.setName('scan_service')
+        self.daemon = True
+        self._logger = logger
+        self._transports = transport if isinstance(transport, list) else [transport]
+        self._registry = registry
+        self._window = window
+        self._interval = interval
+        self._passive = passive
+        self._prefix = manufacturer_prefix.lower()
+        self._stop_event = Event()
+        self.windows = 0
+
+
+    def run(self):
+        scanners = [transport.new_scanner() for transport in self._transports]
+        while not self._stop_event.is_set():
+            started = time.monotonic()
+            for i, transport in enumerate(self._transports):
+                try:
+                    self._scan_window(scanners[i])
+                except Exception as e:
+                    self._logger.error('Background scan failed: {}'.format(e))
+                    scanners[i] = transport.new_scanner()
+            self._registry.expire()
+            self.windows += 1
+            self._stop_event.wait(max(0, self._interval - (time.monotonic() - started)))
+
+
+    def _scan_window(self, scanner):
+        scanner.clear()
+        scanner.start(passive=self._passive)
+        try:
+            scanner.process(self._window)
+        finally:
+            scanner.stop()
+
+        for dev in scanner.getDevices():
+            manufacturer = dev.getValueText(ScanService.ad_type_manufacturer)
+            if not manufacturer or not manufacturer.lower().startswith(self._prefix):
+                continue
+            self._registry.update(dev.addr, dev.rssi, dev.connectable, dev.addrType, dev.iface, manufacturer)
+
+
+    def stop(self):
+        self._stop_event.set()
+
+
+    @property
+    def registry(self):
+        return self._registry
@@ -0,0 +1,232 @@
+import queue
+from threading import Thread, Lock
+
+# RSSI of an adapter which never heard the SBrick
+RSSI_UNKNOWN = -127
+
+
+def adapter_name(iface):
+    return 'hci{}'.format(iface)
+
+
+
+class AdapterShard(Thread):
+    """
+    One BLE adapter: its transport, its connection pool, its airtime scheduler and the worker serving it.
+
+    The worker connects the SBricks moved to this adapter one at a time (a controller handles one
+    LE connection attempt at a time) and checks every check_interval seconds whether the adapter
+    is still up. When the adapter goes down the ShardManager moves its SBricks to the other ones.
+    GATT writes do not pass through the worker, they use the transport of the SBrick from the
+    channel threads.
+    """
+
+    def __init__(self, logger, manager, transport, pool=None, check_interval=5, airtime=None):
+        Thread.__init__(self)
+        self.adapter = adapter_name(transport.iface)
+        self.setName('adapter_' + self.adapter)
+        self.daemon = True
+        self._logger = logger
+        self._manager = manager
+        self._transport = transport
+        self._pool = pool
+        self._airtime = airtime
+        self._check_interval = check_interval
+        self._jobs = queue.Queue()
+        self.healthy = True
+        self.connects = 0
+
+
+    def run(self):
+        while True:
+            try:
+                sbrick = self._jobs.get(timeout=self._check_interval)
+            except queue.Empty:
+                sbrick = False
+            if None == sbrick:
+                break
+            if sbrick and self.healthy:
+                self._connect(sbrick)
+            self._check_health()
+
+
+    def _connect(self, sbrick):
+        if sbrick.transport is not self._transport:
+            # moved again before the worker got to it
+            return
+        try:
+            sbrick.ensure_connected()
+            self.connects += 1
+        except SystemExit:
+            # SbrickAPI exits on unrecoverable bluepy errors, the adapter worker must survive them
+            self._logger.error('Connect SBrick ({}) on {} failed'.format(sbrick.dev_mac, self.adapter))
+
+
+    def _check_health(self):
+        up = self._transport.adapter_up()
+        if self.healthy and not up:
+            self.healthy = False
+            self._logger.error('Adapter {} is down'.format(self.adapter))
+            self._manager.on_adapter_down(self)
+        elif not self.healthy and up:
+            self.healthy = True
+            self._logger.info('Adapter {} is up again'.format(self.adapter))
+
+
+    def submit_connect(self, sbrick):
+        self._jobs.put(sbrick)
+
+
+    def stop(self):
+        self._jobs.put(None)
+
+
+    @property
+    def transport(self):
+        return self._transport
+
+    @property
+    def pool(self):
+        return self._pool
+
+    @property
+    def airtime(self):
+        return self._airtime
+
+    @property
+    def iface(self):
+        return self._transport.iface
+
+
+
+class ShardManager(object):
+    """
+    Spread SBricks over several BLE adapters.
+
+    A new SBrick goes to a healthy adapter with the fewest SBricks; adapters within load_slack of the
+    fewest compete on the RSSI the background scanner measured from them, strongest first. SBricks of
+    an adapter which goes down are moved to the remaining ones, the linked ones reconnect at once
+    and the idle ones on their next command. SBricks do not move back when the adapter recovers.
+    """
+
+    def __init__(self, logger, transports, pools=None, registry=None, load_slack=1, check_interval=5, metrics=None, airtimes=None):
+        self._logger = logger
+        self._registry = registry
+        self._load_slack = load_slack
+        self._metrics = metrics
+        self._lock = Lock()
+        pools = pools if pools else [None] * len(transports)
+        airtimes = airtimes if airtimes else [None] * len(transports)
+        self._shards = [AdapterShard(logger, self, transport, pool, check_interval, airtime)
+                        for transport, pool, airtime in zip(transports, pools, airtimes)]
+        # sbrick_id -> AdapterShard
+        self._placement = {}
+        # sbrick_id -> SbrickAPI
+        self._sbricks = {}
+
+
+    def start(self):
+        for shard in self._shards:
+            shard.start()
+
+
+    def stop(self):
+        for shard in self._shards:
+            shard.stop()
+        for shard in self._shards:
+            shard.join()
+
+
+    def _load(self, shard):
+        return sum(1 for placed in self._placement.values() if placed is shard)
+
+
+    def _rssi(self, sbrick_id, shard):
+        dev = self._registry.get(sbrick_id) if self._registry else None
+        if not dev:
+            return RSSI_UNKNOWN
+        return dev.get('rssi_by_iface', {}).get(shard.iface, RSSI_UNKNOWN)
+
+
+    def _pick(self, sbrick_id, exclude=None):
+        candidates = [shard for shard in self._shards if shard.healthy and shard is not exclude]
+        if not candidates:
+            return None
+        loads = dict((shard, self._load(shard)) for shard in candidates)
+        least = min(loads.values())
+        candidates = [shard for shard in candidates if loads[shard] <= least + self._load_slack]
+        return max(candidates, key=lambda shard: (self._rssi(sbrick_id, shard), -loads[shard]))
+
+
+    def assign(self, sbrick_id):
+        """ Place a new SBrick, return its AdapterShard. Every adapter down falls back to the first one """
+        with self._lock:
+            shard = self._placement.get(sbrick_id)
+            if None == shard:
+                shard = self._pick(sbrick_id)
+                if None == shard:
+                    self._logger.error('Every adapter is down, place SBrick ({}) on {}'.format(sbrick_id, self._shards[0].adapter))
+                    shard = self._shards[0]
+                self._placement[sbrick_id] = shard
+        self._logger.info('Place SBrick ({}) on {}'.format(sbrick_id, shard.adapter))
+        self._update_gauges()
+        return shard
+
+
+    def register(self, sbrick):
+        with self._lock:
+            self._sbricks[sbrick.dev_mac] = sbrick
+
+
+    def release(self, sbrick_id):
+        with self._lock:
+            self._placement.pop(sbrick_id, None)
+            self._sbricks.pop(sbrick_id, None)
+        self._update_gauges()
+
+
+    def on_adapter_down(self, failed):
+        """ Called by the worker of an adapter which went down """
+        moves = []
+        with self._lock:
+            for sbrick_id, shard in list(self._placement.items()):
+                if shard is not failed:
+                    continue
+                target = self._pick(sbrick_id, exclude=failed)
+                if None == target:
+                    self._logger.error('No adapter left for SBrick ({})'.format(sbrick_id))
+                    continue
+                self._placement[sbrick_id] = target
+                sbrick = self._sbricks.get(sbrick_id)
+                if sbrick:
+                    moves.append((sbrick, target))
+
+        for sbrick, target in moves:
+            linked = sbrick.is_linked() or sbrick.is_pinned()
+            sbrick.set_transport(target.transport, target.pool, target.airtime)
+            self._logger.info('Move SBrick ({}) from {} to {}'.format(sbrick.dev_mac, failed.adapter, target.adapter))
+            if linked:
+                target.submit_connect(sbrick)
+        if self._metrics:
+            self._metrics.inc('adapter_down_total', adapter=failed.adapter)
+        self._update_gauges()
+
+
+    def _update_gauges(self):
+        if None == self._metrics:
+            return
+        with self._lock:
+            loads = [(shard.adapter, self._load(shard)) for shard in self._shards]
+        for name, load in loads:
+            self._metrics.set_gauge('adapter_sbricks', load, adapter=name)
+
+
+    def placement(self):
+        """ sbrick_id -> adapter name """
+        with self._lock:
+            return dict((sbrick_id, shard.adapter) for sbrick_id, shard in self._placement.items())
+
+
+    @property
+    def shards(self):
+        return list(self._shards)
@@ -0,0 +1,68 @@
+import json
+from threading import Lock
+from lib.m2mipc import REQ_RESP_DONE
+
+
+def request_key(action, json_msg):
+    """ Key of a rr request: the action and its fields in canonical order, None when the request is no JSON object """
+    try:
+        fields = json.loads(json_msg)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(fields, dict):
+        return None
+    return action + ' ' + json.dumps(fields, sort_keys=True)
+
+
+
+class SingleFlight(object):
+    """
+    Identical rr requests in flight at the same time share one execution.
+
+    The first request of a key runs; sessions of the same key arriving before it answers join it and
+    get the same response. A key is forgotten once answered, a later request runs again: nothing is
+    cached.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # key -> sessions waiting for the response
+        self._calls = {}
+        self.joined = 0
+
+
+    def join(self, key, session):
+        """ Return True when session joined a running call of key, False when the caller must run it """
+        with self._lock:
+            sessions = self._calls.get(key)
+            if None == sessions:
+                self._calls[key] = [session]
+                return False
+            sessions.append(session)
+            self.joined += 1
+            return True
+
+
+    def finish(self, key):
+        """ Forget key, return the sessions waiting for its response """
+        with self._lock:
+            return self._calls.pop(key, [])
+
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+
+    class FanOut(object):
+        """ Stands in for the ServerSession of the running call, its response goes to every joined session """
+
+        def __init__(self, single_flight, key):
+            self._single_flight = single_flight
+            self._key = key
+
+        def send_response(self, data, rr_status=REQ_RESP_DONE):
+            rc = rr_status
+            for session in self._single_flight.finish(self._key):
+                rc = session.send_response(data, rr_status)
+            return rc
@@ -0,0 +1,71 @@
+import json
+from threading import Lock
+from lib.aio_uv import uv_for
+
+
+def idle_state():
+    """ State of a channel which was not driven since the server started """
+    return {
+        'running': False,
+        'direction': '00',
+        'power': '00',
+        'deadline': None,
+        'last_write': None,
+        'write_ok': None
+    }
+
+
+class ChannelStatePublisher(object):
+    """
+    Publish channel states to retained MQTT topics, one topic per SBrick channel.
+
+    update() is called by the drive threads; states are handed to the event loop through a
+    pyuv.Async and published there, so paho is only used from the loop thread. States of the same
+    topic queued between two loop iterations are coalesced, only the newest one is published.
+    publish() does the same for any other retained topic, e.g. telemetry.
+    """
+
+    def __init__(self, loop, m2mipc, protocol):
+        self._m2mipc = m2mipc
+        self._protocol = protocol
+        self._lock = Lock()
+        # topic -> state, None clears the retained topic
+        self._pending = {}
+        self._async = uv_for(loop).Async(loop, self._on_async)
+        self.published = 0
+
+
+    def update(self, sbrick_id, channel, state):
+        state['sbrick_id'] = sbrick_id
+        state['channel'] = channel
+        self.publish(self._protocol.gen_state_topic(sbrick_id, channel), state)
+
+
+    def publish(self, topic, state):
+        with self._lock:
+            self._pending[topic] = state
+        self._async.send()
+
+
+    def clear(self, sbrick_id, channels):
+        """ Remove the retained states of a detached SBrick """
+        with self._lock:
+            for channel in channels:
+                self._pending[self._protocol.gen_state_topic(sbrick_id, channel)] = None
+        self._async.send()
+
+
+    def _on_async(self, handle):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for topic, state in pending.items():
+            # an empty retained message deletes the retained one
+            payload = json.dumps(state) if state else ''
+            self._m2mipc.publish(topic, payload, retain=True)
+            self.published += 1
+
+
+    def close(self):
+        # flush what is still queued, then release the handle
+        self._on_async(self._async)
+        self._async.close()
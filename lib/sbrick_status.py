@@ -0,0 +1,122 @@
+import os
+import time
+import socket
+from threading import Lock
+
+STATE_STARTING = 'starting'
+STATE_READY = 'ready'
+STATE_STOPPING = 'stopping'
+STATE_OFFLINE = 'offline'
+
+BRICK_CONNECTING = 'connecting'
+BRICK_READY = 'ready'
+BRICK_LAZY = 'lazy'
+BRICK_FAILED = 'failed'
+
+
+def sd_notify(state):
+    """ Send state, e.g. 'READY=1', to systemd when started by a Type=notify unit. Return False otherwise """
+    path = os.environ.get('NOTIFY_SOCKET', None)
+    if not path:
+        return False
+    if path.startswith('@'):
+        # abstract namespace socket
+        path = '\0' + path[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.connect(path)
+        sock.sendall(state.encode('utf-8'))
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+
+def offline_status():
+    """ Status of a server which is not running, also the payload of its MQTT last will """
+    return {'state': STATE_OFFLINE, 'mqtt': False, 'bricks': {}, 'ready': 0, 'total': 0, 'timestamp': None}
+
+
+
+class ServerStatus(object):
+    """
+    Readiness of the server, published to a retained topic and notified to systemd.
+
+    The server is starting until MQTT is connected and no SBrick is still connecting, then ready.
+    systemd gets READY=1 as soon as MQTT is connected, the server takes requests from then on, and a
+    STATUS= line on every SBrick change. publish(topic, status) is ChannelStatePublisher.publish, so
+    the status can be updated from any thread.
+    """
+
+    def __init__(self, publish, topic):
+        self._publish = publish
+        self._topic = topic
+        self._lock = Lock()
+        self._mqtt = False
+        self._stopping = False
+        # sbrick_id -> BRICK_* status
+        self._bricks = {}
+        self._notified = False
+
+
+    def mqtt_up(self):
+        with self._lock:
+            self._mqtt = True
+        self._emit()
+
+
+    def brick(self, sbrick_id, status):
+        """ status is a BRICK_* status, None forgets a detached SBrick """
+        with self._lock:
+            if None == status:
+                self._bricks.pop(sbrick_id, None)
+            else:
+                self._bricks[sbrick_id] = status
+        self._emit()
+
+
+    def stopping(self):
+        with self._lock:
+            self._stopping = True
+        self._emit()
+
+
+    def close(self):
+        """ Leave the offline status retained, like the last will does when the server dies """
+        self._publish(self._topic, offline_status())
+
+
+    def to_dict(self):
+        with self._lock:
+            bricks = dict(self._bricks)
+            if self._stopping:
+                state = STATE_STOPPING
+            elif self._mqtt and BRICK_CONNECTING not in bricks.values():
+                state = STATE_READY
+            else:
+                state = STATE_STARTING
+            return {
+                'state': state,
+                'mqtt': self._mqtt,
+                'bricks': bricks,
+                'ready': sum(1 for status in bricks.values() if status in (BRICK_READY, BRICK_LAZY)),
+                'total': len(bricks),
+                'timestamp': time.time()
+            }
+
+
+    def _emit(self):
+        status = self.to_dict()
+        self._publish(self._topic, status)
+
+        with self._lock:
+            ready = status['mqtt'] and not self._notified
+            self._notified = self._notified or ready
+        lines = ['STATUS={}, {}/{} SBricks ready'.format(status['state'], status['ready'], status['total'])]
+        if STATE_STOPPING == status['state']:
+            lines.append('STOPPING=1')
+        elif ready:
+            lines.append('READY=1')
+        sd_notify('\n'.join(lines))
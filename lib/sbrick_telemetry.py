@@ -0,0 +1,170 @@
+import time
+from threading import Thread, Event, Lock
+
+# drive threads refresh a running channel every second
+DRIVE_REFRESH = 1.0
+# keep this far from the previous and the next drive refresh
+SLOT_GUARD = 0.1
+# retry a sample which found no idle slot after this many seconds
+SLOT_RETRY = 0.05
+
+
+class TelemetryStream(object):
+    __slots__ = ('sbrick_id', 'rate', 'deadband_voltage', 'deadband_temperature', 'next_due',
+                 'voltage', 'temperature', 'samples', 'published', 'deferred', 'failures')
+
+    def __init__(self, sbrick_id, rate, deadband_voltage, deadband_temperature):
+        self.sbrick_id = sbrick_id
+        self.rate = rate
+        self.deadband_voltage = deadband_voltage
+        self.deadband_temperature = deadband_temperature
+        self.next_due = time.monotonic()
+        # last published values
+        self.voltage = None
+        self.temperature = None
+        self.samples = 0
+        self.published = 0
+        self.deferred = 0
+        self.failures = 0
+
+
+    def to_dict(self):
+        return {
+            'sbrick_id': self.sbrick_id,
+            'rate': self.rate,
+            'deadband_voltage': self.deadband_voltage,
+            'deadband_temperature': self.deadband_temperature
+        }
+
+
+
+class TelemetrySampler(Thread):
+    """
+    Sample voltage and temperature of subscribed SBricks and publish them when they move.
+
+    One 0x0F query reads both ADC channels (a write and a read, instead of the two pairs of
+    get_info_adc()). A sample is only taken in an idle BLE slot: the bluepy lock is free, the last
+    GATT operation is at least SLOT_GUARD old and, while a channel is driven, the next drive refresh
+    is at least SLOT_GUARD away. A value is published when it moved past its deadband since the last
+    published one. A SBrick which is not linked is skipped until a command connects it.
+    on_sample(sbrick, voltage, temperature), when given, is called with every sample.
+    """
+
+    def __init__(self, logger, get_sbrick, publish, metrics=None, on_sample=None):
+        Thread.__init__(self)
+        self.setName('telemetry')
+        self.daemon = True
+        self._logger = logger
+        # get_sbrick(sbrick_id) returns the SbrickAPI or None, publish(sbrick_id, voltage, temperature) sends a sample out
+        self._get_sbrick = get_sbrick
+        self._publish = publish
+        self._metrics = metrics
+        self._on_sample = on_sample
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = False
+        # sbrick_id -> TelemetryStream
+        self._streams = {}
+
+
+    def subscribe(self, sbrick_id, rate, deadband_voltage, deadband_temperature):
+        """ Start, change or (rate 0) stop the stream of a SBrick """
+        with self._lock:
+            if rate <= 0:
+                self._streams.pop(sbrick_id, None)
+                return None
+            stream = self._streams.get(sbrick_id)
+            if None == stream:
+                stream = TelemetryStream(sbrick_id, rate, deadband_voltage, deadband_temperature)
+                self._streams[sbrick_id] = stream
+            else:
+                stream.rate = rate
+                stream.deadband_voltage = deadband_voltage
+                stream.deadband_temperature = deadband_temperature
+                stream.next_due = time.monotonic()
+        self._wakeup.set()
+        return stream
+
+
+    def unsubscribe(self, sbrick_id):
+        with self._lock:
+            self._streams.pop(sbrick_id, None)
+
+
+    def get(self, sbrick_id):
+        with self._lock:
+            return self._streams.get(sbrick_id)
+
+
+    def stop(self):
+        self._stopped = True
+        self._wakeup.set()
+
+
+    def run(self):
+        while not self._stopped:
+            # a subscribe() from now on wakes the wait below up
+            self._wakeup.clear()
+            with self._lock:
+                streams = list(self._streams.values())
+            now = time.monotonic()
+            due = [stream for stream in streams if stream.next_due <= now]
+            for stream in due:
+                self._sample(stream)
+
+            with self._lock:
+                pending = [stream.next_due for stream in self._streams.values()]
+            timeout = max(0, min(pending) - time.monotonic()) if pending else None
+            self._wakeup.wait(timeout)
+
+
+    def _in_idle_slot(self, sbrick):
+        if sbrick.is_busy():
+            return False
+        idle = sbrick.idle_time()
+        if idle < SLOT_GUARD:
+            return False
+        # a driven channel writes again DRIVE_REFRESH after its last write
+        return not sbrick.is_driving() or idle <= DRIVE_REFRESH - SLOT_GUARD
+
+
+    def _sample(self, stream):
+        sbrick = self._get_sbrick(stream.sbrick_id)
+        if None == sbrick:
+            self.unsubscribe(stream.sbrick_id)
+            return
+        if not sbrick.is_linked():
+            # a lazy or evicted SBrick stays unlinked: connecting it would undo --lazy-connect and evict
+            # another SBrick of the --max-links pool on every tick
+            stream.deferred += 1
+            stream.next_due = time.monotonic() + 1.0 / stream.rate
+            return
+        if not self._in_idle_slot(sbrick):
+            stream.deferred += 1
+            stream.next_due = time.monotonic() + SLOT_RETRY
+            return
+
+        stream.next_due = time.monotonic() + 1.0 / stream.rate
+        try:
+            sample = sbrick.sample_adc()
+        except Exception as e:
+            self._logger.error('Telemetry of SBrick ({}): {}'.format(stream.sbrick_id, e))
+            sample = None
+        if None == sample:
+            stream.failures += 1
+            return
+
+        stream.samples += 1
+        if self._metrics:
+            self._metrics.inc('telemetry_samples_total', sbrick=stream.sbrick_id)
+        voltage, temperature = sample
+        if self._on_sample:
+            self._on_sample(sbrick, voltage, temperature)
+        if None != stream.voltage and abs(voltage - stream.voltage) < stream.deadband_voltage \
+                and abs(temperature - stream.temperature) < stream.deadband_temperature:
+            return
+
+        stream.voltage = voltage
+        stream.temperature = temperature
+        stream.published += 1
+        self._publish(stream.sbrick_id, voltage, temperature)
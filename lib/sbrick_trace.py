@@ -0,0 +1,142 @@
+import os
+import mmap
+import time
+import struct
+from threading import Lock
+
+TRACE_MAGIC = b'SBTRACE1'
+TRACE_VERSION = 1
+
+TRACE_WRITE = 0
+TRACE_READ = 1
+
+# magic, version, record size, capacity, records written, monotonic and wall clock time of creation
+HEADER = struct.Struct('<8sHHIQdd')
+HEADER_SIZE = 64
+# monotonic time, direction, SBrick MAC, frame length, frame
+RECORD = struct.Struct('<dB6sB16s')
+FRAME_MAX = 16
+
+
+def mac_to_bytes(dev_mac):
+    return bytes.fromhex(dev_mac.replace(':', ''))
+
+
+def bytes_to_mac(binary):
+    return ':'.join('{:02X}'.format(b) for b in binary)
+
+
+
+class TraceRecorder(object):
+    """
+    Fixed-size ring buffer of BLE frames in a memory-mapped file.
+
+    Every record is RECORD.size bytes; when the ring is full the oldest records are overwritten.
+    Recording is a struct.pack_into() on the mapping, the kernel writes the pages back to the file.
+    Frames longer than FRAME_MAX bytes are truncated, the original length is kept.
+    """
+
+    def __init__(self, path, capacity=65536):
+        if capacity < 1:
+            raise ValueError('Trace capacity must be positive')
+        self._path = path
+        self._capacity = capacity
+        self._lock = Lock()
+        self._count = 0
+        self._closed = False
+
+        size = HEADER_SIZE + capacity * RECORD.size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._created = time.monotonic()
+        self._created_wall = time.time()
+        self._write_header()
+
+
+    def _write_header(self):
+        HEADER.pack_into(self._mmap, 0, TRACE_MAGIC, TRACE_VERSION, RECORD.size, self._capacity,
+                         self._count, self._created, self._created_wall)
+
+
+    def record(self, direction, mac_bytes, frame):
+        with self._lock:
+            if self._closed:
+                return
+            offset = HEADER_SIZE + (self._count % self._capacity) * RECORD.size
+            RECORD.pack_into(self._mmap, offset, time.monotonic(), direction, mac_bytes, len(frame), frame[:FRAME_MAX])
+            self._count += 1
+            # the count is part of the header, it tells readers where the ring starts
+            struct.pack_into('<Q', self._mmap, 16, self._count)
+
+
+    def flush(self):
+        with self._lock:
+            if not self._closed:
+                self._mmap.flush()
+
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._mmap.flush()
+            self._mmap.close()
+
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def count(self):
+        return self._count
+
+
+
+class TraceRecord(object):
+    __slots__ = ('timestamp', 'direction', 'dev_mac', 'length', 'frame')
+
+    def __init__(self, timestamp, direction, dev_mac, length, frame):
+        self.timestamp = timestamp
+        self.direction = direction
+        self.dev_mac = dev_mac
+        self.length = length
+        self.frame = frame
+
+    def __str__(self):
+        return '{:.6f} {} {} {}{}'.format(self.timestamp, 'W' if TRACE_WRITE == self.direction else 'R',
+                                          self.dev_mac, self.frame.hex(), '' if self.length == len(self.frame) else '..')
+
+
+
+def read_trace(path):
+    """ Return (header dict, records from the oldest to the newest) of a trace file """
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    magic, version, record_size, capacity, count, created, created_wall = HEADER.unpack_from(data, 0)
+    if TRACE_MAGIC != magic:
+        raise ValueError('{} is not a SBrick trace file'.format(path))
+    if TRACE_VERSION != version or RECORD.size != record_size:
+        raise ValueError('Unsupported trace version {} (record size {})'.format(version, record_size))
+
+    records = []
+    first = max(0, count - capacity)
+    for i in range(first, count):
+        offset = HEADER_SIZE + (i % capacity) * RECORD.size
+        timestamp, direction, mac, length, frame = RECORD.unpack_from(data, offset)
+        records.append(TraceRecord(timestamp, direction, bytes_to_mac(mac), length, frame[:min(length, FRAME_MAX)]))
+
+    header = {
+        'version': version,
+        'capacity': capacity,
+        'count': count,
+        'created': created,
+        'created_wall': created_wall
+    }
+    return header, records
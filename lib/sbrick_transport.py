@@ -0,0 +1,50 @@
+import os
+import time
+import subprocess
+import shlex
+from bluepy.btle import Peripheral, Scanner
+
+
+class BluepyTransport(object):
+    """
+    Transport of SbrickAPI. Creates the peripheral objects SbrickAPI talks to and
+    releases stale links. This one drives a real SBrick through bluepy.
+    """
+    name = 'bluepy'
+
+    def __init__(self, iface=None):
+        # HCI interface number (0 for hci0). None means the default adapter
+        self.iface = iface
+
+
+    def new_peripheral(self):
+        return Peripheral()
+
+
+    def new_scanner(self):
+        return Scanner(self.iface if None != self.iface else 0)
+
+
+    def connect(self, peripheral, dev_mac):
+        # connect() is a blocking function
+        if None == self.iface:
+            peripheral.connect(dev_mac)
+        else:
+            peripheral.connect(dev_mac, iface=self.iface)
+
+
+    def adapter_up(self):
+        # the kernel lists a HCI adapter while it exists, an unplugged USB dongle disappears
+        return os.path.isdir('/sys/class/bluetooth/hci{}'.format(self.iface if None != self.iface else 0))
+
+
+    def release(self, dev_mac):
+        # disconnect SBrick using bluetoothctl command
+        bl_cmd = 'disconnect {}\nquit'.format(dev_mac)
+        cmd = "echo -e '{}'".format(bl_cmd)
+        p1 = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE)
+        p2 = subprocess.Popen(shlex.split('bluetoothctl'), stdin=p1.stdout, stdout=subprocess.PIPE, shell=True)
+        p1.stdout.close()
+        p2.communicate()
+        # wait 3 seconds for real disconnection, because `bluetoothctl #disconnect` is an asynchronous command
+        time.sleep(3)
@@ -0,0 +1,408 @@
+import time
+import random
+import struct
+from threading import Lock
+from bluepy.btle import BTLEException
+
+RCC_UUID = '02b8cbcc-0e25-4bda-8790-a15f53e6010f'
+RCS_UUID = '4dc591b0-857c-41de-b5f1-15abda665b0c'
+CHANNELS = 4
+
+
+def virtual_macs(count, start=1):
+    """ Locally administered MAC addresses for virtual SBricks: 02:00:00:00:00:01, ... """
+    macs = []
+    for i in range(start, start + count):
+        macs.append('02:00:00:{:02X}:{:02X}:{:02X}'.format((i >> 16) & 0xFF, (i >> 8) & 0xFF, i & 0xFF))
+    return macs
+
+
+
+class VirtualSbrickDevice(object):
+    """
+    Model of the SBrick protocol 17 remote control commands characteristic.
+
+    write() executes a command and keeps its response for the next read(), the same way a
+    real SBrick answers query commands. The watchdog is evaluated lazily: when no command was
+    written within watchdog_timeout, every driving channel is stopped before the next command.
+    """
+
+    def __init__(self, dev_mac, voltage=8.4, temperature=30.0, watchdog_timeout=5):
+        self._lock = Lock()
+        self.dev_mac = dev_mac
+        self.voltage = voltage
+        self.temperature = temperature
+        self.thermal_limit = 70.0
+        self.watchdog_timeout = watchdog_timeout   # 0.1 seconds
+        self.conn_param = (24, 40, 0)       # min interval, max interval (1.25 ms), slave latency
+        self.release_on_reset = 1
+        self.power_cycle_count = 1
+        self.boot_time = time.monotonic()
+        self.rssi = -60
+
+        # channel -> (direction, power), power 0 means stopped
+        self.channels = [(0, 0)] * CHANNELS
+        self.last_command = time.monotonic()
+        self.watchdog_expired = 0
+        self.writes = 0
+        self.reads = 0
+
+        self._response = b''
+
+
+    def _check_watchdog(self, now):
+        if 0 == self.watchdog_timeout:
+            return
+        if now - self.last_command < self.watchdog_timeout * 0.1:
+            return
+        if any(power for direction, power in self.channels):
+            self.channels = [(0, 0)] * CHANNELS
+            self.watchdog_expired += 1
+
+
+    def channel_status(self):
+        with self._lock:
+            self._check_watchdog(time.monotonic())
+            return self._channel_status()
+
+
+    def _channel_status(self):
+        """ Bit mask of driving channels, power of every channel, direction bit mask, watchdog flag """
+        mask = 0
+        directions = 0
+        powers = []
+        for ch, (direction, power) in enumerate(self.channels):
+            if power:
+                mask |= 1 << ch
+            if direction:
+                directions |= 1 << ch
+            powers.append(power)
+        return struct.pack('<7B', mask, powers[0], powers[1], powers[2], powers[3], directions, 1 if self.watchdog_expired else 0)
+
+
+    def write(self, binary):
+        if not binary:
+            raise BTLEException(BTLEException.GATT_ERROR, 'Empty command')
+
+        now = time.monotonic()
+        opcode = binary[0]
+        args = binary[1:]
+        response = b''
+        with self._lock:
+            self._check_watchdog(now)
+            self.last_command = now
+            self.writes += 1
+
+            if 0x00 == opcode:
+                # brake: list of channels
+                for ch in args:
+                    self.channels[ch % CHANNELS] = (0, 0)
+            elif 0x01 == opcode:
+                # drive: list of <channel, direction, power>
+                if 0 == len(args) or len(args) % 3:
+                    raise BTLEException(BTLEException.GATT_ERROR, 'Invalid drive command')
+                for i in range(0, len(args), 3):
+                    ch, direction, power = args[i:i + 3]
+                    self.channels[ch % CHANNELS] = (direction & 1, power)
+            elif 0x03 == opcode:
+                response = struct.pack('<B', 1)
+            elif 0x09 == opcode:
+                response = struct.pack('<B', 50)
+            elif 0x0A == opcode:
+                response = bytes(int(x, 16) for x in self.dev_mac.split(':'))
+            elif 0x0D == opcode:
+                self.watchdog_timeout = args[0] if args else 0
+            elif 0x0E == opcode:
+                response = struct.pack('<B', self.watchdog_timeout)
+            elif 0x0F == opcode:
+                # one 16-bit value per queried channel
+                response = b''.join(self._adc(ch) for ch in (args if args else b'\x00'))
+            elif 0x15 == opcode:
+                response = struct.pack('<H', int((self.thermal_limit + 160) * 118.85795))
+            elif 0x20 == opcode:
+                response = struct.pack('<H', 255)
+            elif 0x22 == opcode:
+                response = self._channel_status()
+            elif 0x23 == opcode:
+                response = struct.pack('<B', 0)
+            elif 0x24 == opcode:
+                if len(args) < 6:
+                    raise BTLEException(BTLEException.GATT_ERROR, 'Invalid connection parameters')
+                min_interval, max_interval, latency = struct.unpack('<3H', args[:6])
+                # the SBrick clamps the request to the BLE limits
+                min_interval = min(max(min_interval, 6), 3200)
+                max_interval = min(max(max_interval, min_interval), 3200)
+                self.conn_param = (min_interval, max_interval, min(latency, 499))
+            elif 0x25 == opcode:
+                response = struct.pack('<3H', *self.conn_param)
+            elif 0x26 == opcode:
+                self.release_on_reset = args[0] if args else 0
+            elif 0x27 == opcode:
+                response = struct.pack('<B', self.release_on_reset)
+            elif 0x28 == opcode:
+                response = struct.pack('<I', self.power_cycle_count)
+            elif 0x29 == opcode:
+                response = struct.pack('<I', int((now - self.boot_time) * 10))
+            else:
+                raise BTLEException(BTLEException.GATT_ERROR, 'Unsupported opcode 0x{:02X}'.format(opcode))
+
+            self._response = response
+
+
+    def read(self):
+        with self._lock:
+            self.reads += 1
+            return self._response
+
+
+    def _adc(self, channel):
+        if 0x08 == channel:
+            value = int(self.voltage * 2047.0 / 0.83875)
+        elif 0x09 == channel:
+            value = int((self.temperature + 160) * 118.85795)
+        else:
+            value = 0
+        return struct.pack('<H', value & 0xFFFF)
+
+
+
+class VirtualUUID(object):
+    def __init__(self, value):
+        self._value = value
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(self._value)
+
+    def __str__(self):
+        return self._value
+
+    def getCommonName(self):
+        return self._value
+
+
+
+class VirtualCharacteristic(object):
+    def __init__(self, peripheral, uuid):
+        self._peripheral = peripheral
+        self.uuid = VirtualUUID(uuid)
+
+    def __str__(self):
+        return 'Characteristic <{}>'.format(self.uuid)
+
+    def write(self, val, withResponse=False):
+        device = self._peripheral._io()
+        device.write(val)
+        on_write = self._peripheral._transport.on_write
+        if on_write:
+            on_write(device.dev_mac, val, time.monotonic())
+
+    def read(self):
+        device = self._peripheral._io()
+        return device.read()
+
+    def supportsRead(self):
+        return True
+
+    def propertiesToString(self):
+        return 'READ WRITE '
+
+
+
+class VirtualService(object):
+    def __init__(self, uuid, chars):
+        self.uuid = VirtualUUID(uuid)
+        self._chars = chars
+
+    def __str__(self):
+        return 'Service <uuid={}>'.format(self.uuid)
+
+    def getCharacteristics(self, forUUID=None):
+        return self._chars
+
+
+
+class VirtualPeripheral(object):
+    """ bluepy.btle.Peripheral look-alike bound to a VirtualTransport """
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._device = None
+        self._rcc_char = VirtualCharacteristic(self, RCC_UUID)
+        self._services = [VirtualService(RCS_UUID, [self._rcc_char])]
+
+
+    def connect(self, addr, addrType='public', iface=None):
+        transport = self._transport
+        if not transport.up:
+            raise BTLEException(BTLEException.DISCONNECTED, 'Adapter down')
+        if transport.connect_latency:
+            time.sleep(transport.connect_latency)
+        self._device = transport.device(addr)
+
+
+    def disconnect(self):
+        self._device = None
+
+
+    def getCharacteristics(self, startHnd=1, endHnd=0xFFFF, uuid=None):
+        if None == self._device:
+            raise BTLEException(BTLEException.DISCONNECTED, 'Not connected')
+        return [self._rcc_char]
+
+
+    def getServices(self):
+        if None == self._device:
+            raise BTLEException(BTLEException.DISCONNECTED, 'Not connected')
+        return self._services
+
+
+    def _io(self):
+        device = self._device
+        if None == device:
+            raise BTLEException(BTLEException.DISCONNECTED, 'Device disconnected')
+
+        transport = self._transport
+        if not transport.up:
+            self._device = None
+            raise BTLEException(BTLEException.DISCONNECTED, 'Device disconnected')
+        if transport.latency:
+            time.sleep(transport.latency)
+        if transport.failure_rate and transport.random.random() < transport.failure_rate:
+            self._device = None
+            transport.failures += 1
+            raise BTLEException(BTLEException.DISCONNECTED, 'Device disconnected')
+        return device
+
+
+
+class VirtualScanEntry(object):
+    """ bluepy.btle.ScanEntry look-alike of an advertising VirtualSbrickDevice """
+
+    # Vengit company identifier 0x0198, SBrick product id, hardware and firmware version
+    manufacturer = '980100060004'
+
+    def __init__(self, device, iface):
+        self.addr = device.dev_mac.lower()
+        self.addrType = 'public'
+        self.iface = iface
+        self.rssi = device.rssi
+        self.connectable = True
+        self.updateCount = 1
+
+    def getValueText(self, sdid):
+        return self.manufacturer if 255 == sdid else None
+
+
+
+class VirtualScanner(object):
+    """ bluepy.btle.Scanner look-alike which discovers every device of a VirtualTransport """
+
+    def __init__(self, transport, iface=0):
+        self._transport = transport
+        self._iface = iface
+        self._delegate = None
+        self._entries = {}
+
+    def withDelegate(self, delegate):
+        self._delegate = delegate
+        return self
+
+    def clear(self):
+        self._entries = {}
+
+    def start(self, passive=False):
+        pass
+
+    def stop(self):
+        pass
+
+    def process(self, timeout=10):
+        for dev_mac, device in self._transport.devices.items():
+            is_new = dev_mac not in self._entries
+            entry = VirtualScanEntry(device, self._iface)
+            self._entries[dev_mac] = entry
+            if self._delegate:
+                self._delegate.handleDiscovery(entry, is_new, False)
+
+    def getDevices(self):
+        return list(self._entries.values())
+
+    def scan(self, timeout=10, passive=False):
+        self.clear()
+        self.process(timeout)
+        return self.getDevices()
+
+
+
+class VirtualTransport(object):
+    """
+    Transport of SbrickAPI backed by in-process VirtualSbrickDevice objects.
+
+    latency         : seconds slept by every GATT write and read
+    connect_latency : seconds slept by every connect
+    failure_rate    : probability (0 ~ 1) that a GATT write or read drops the link
+    on_write        : called as on_write(dev_mac, binary, monotonic_time) after every successful GATT write
+
+    adapter() returns a transport of another virtual adapter sharing the same devices, setting its `up`
+    to False simulates an unplugged adapter.
+    """
+    name = 'virtual'
+
+    def __init__(self, latency=0.0, connect_latency=0.0, failure_rate=0.0, seed=None, on_write=None):
+        self.iface = None
+        self.on_write = on_write
+        self.latency = latency
+        self.connect_latency = connect_latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.failures = 0
+        self.up = True
+        self._lock = Lock()
+        self._devices = {}
+
+
+    def adapter(self, iface):
+        transport = VirtualTransport(self.latency, self.connect_latency, self.failure_rate, on_write=self.on_write)
+        transport.iface = iface
+        transport.random = self.random
+        transport._lock = self._lock
+        transport._devices = self._devices
+        return transport
+
+
+    def device(self, dev_mac):
+        with self._lock:
+            device = self._devices.get(dev_mac)
+            if None == device:
+                device = VirtualSbrickDevice(dev_mac)
+                self._devices[dev_mac] = device
+            return device
+
+
+    @property
+    def devices(self):
+        return dict(self._devices)
+
+
+    def new_peripheral(self):
+        return VirtualPeripheral(self)
+
+
+    def new_scanner(self):
+        return VirtualScanner(self, self.iface if None != self.iface else 0)
+
+
+    def connect(self, peripheral, dev_mac):
+        peripheral.connect(dev_mac)
+
+
+    def adapter_up(self):
+        return self.up
+
+
+    def release(self, dev_mac):
+        """ Virtual links never go stale """
+        pass
@@ -0,0 +1,379 @@
+import sys
+import json
+import math
+import time
+import random
+import logging
+import argparse
+from threading import Thread, Lock, Event
+
+import pyuv
+from lib.aio_uv import uv_for, Loop as AioLoop
+from lib.sbrick_airtime import AirtimeScheduler
+from lib.mqtt_broker import MqttBroker
+from lib.sbrick_m2mipc import SbrickIpcServer, SbrickIpcClient
+from lib.sbrick_protocol import SbrickProtocol
+from lib.sbrick_virtual import VirtualTransport, virtual_macs
+
+LOG_FORMAT = "%(asctime)s [%(filename)s:%(lineno)s(%(levelname)s)] %(threadName)s - %(message)s"
+
+
+class LoadArgParse(object):
+    def __init__(self):
+        self._parser = argparse.ArgumentParser(description='End-to-end load generator: simulated clients -> MQTT broker -> SBrick server -> virtual SBricks')
+        self._args = None
+
+
+    def parse_args(self):
+        parser = self._parser
+        parser.add_argument('--clients', type=self._positive_int, default=10, help='Number of concurrent simulated clients. Default is 10')
+        parser.add_argument('--sbricks', type=self._positive_int, default=10, help='Number of virtual SBricks served by the server. Default is 10')
+        parser.add_argument('--channels', type=self._channel_count, default=4, help='Number of channels per SBrick the clients drive (1~4). Default is 4')
+        parser.add_argument('--duration', type=self._positive_float, default=30, help='Seconds of traffic. Default is 30')
+        parser.add_argument('--drain', type=self._non_negative_float, default=2, help='Seconds to wait for in-flight commands after the traffic stops. Default is 2')
+        parser.add_argument('--drive-rate', type=self._non_negative_float, default=5, help='Drive messages per second per client. Default is 5')
+        parser.add_argument('--stop-rate', type=self._non_negative_float, default=0.5, help='Stop messages per second per client. Default is 0.5')
+        parser.add_argument('--rr-rate', type=self._non_negative_float, default=0.1, help='rr/get_adc requests per second per client. Default is 0.1')
+        parser.add_argument('--rr-timeout', type=self._positive_float, default=5, help='Timeout of a request-response in seconds. Default is 5')
+        parser.add_argument('--exec-time', type=self._positive_float, default=5, help='exec_time of drive messages in seconds. Default is 5')
+        parser.add_argument('--write-latency', type=self._non_negative_float, default=0, metavar='MS', help='Latency of every virtual GATT write/read in milliseconds. Default is 0')
+        parser.add_argument('--failure-rate', type=self._non_negative_float, default=0, help='Probability (0~1) that a virtual GATT write/read drops the link. Default is 0')
+        parser.add_argument('--broker-ip', default=None, help='Use this MQTT broker instead of the built-in stand-in')
+        parser.add_argument('--broker-port', type=int, default=1883, help='Port of --broker-ip. Default is 1883')
+        parser.add_argument('--local-socket', default=None, metavar='PATH', help='Clients talk to the server over this Unix domain socket instead of the broker')
+        parser.add_argument('--per-brick-topics', action='store_true', help='Address commands to per-brick topics')
+        parser.add_argument('--airtime-slots', type=int, default=0, metavar='N', help='Schedule the GATT operations of the server N at a time. Default is 0 (unscheduled)')
+        parser.add_argument('--background-clients', action='store_true', help='Clients run their event loop in an I/O thread')
+        parser.add_argument('--engine', choices=['pyuv', 'asyncio'], default='pyuv', help='Event loop of the server. Default is pyuv')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed')
+        parser.add_argument('--output', default=None, help='Save the report as JSON to this file')
+        parser.add_argument('--log-level', default='WARNING', help='Log verbose level. Default is WARNING. [DEBUG | INFO | WARNING | ERROR | CRITICAL]')
+        self._args = parser.parse_args()
+        return self._args
+
+
+    def _positive_int(self, string):
+        value = int(string)
+        if value < 1:
+            raise argparse.ArgumentTypeError("{} must be positive".format(string))
+        return value
+
+
+    def _channel_count(self, string):
+        value = int(string)
+        if value < 1 or value > 4:
+            raise argparse.ArgumentTypeError("{} is out of range (1~4)".format(string))
+        return value
+
+
+    def _positive_float(self, string):
+        value = float(string)
+        if value <= 0:
+            raise argparse.ArgumentTypeError("{} must be positive".format(string))
+        return value
+
+
+    def _non_negative_float(self, string):
+        value = float(string)
+        if value < 0:
+            raise argparse.ArgumentTypeError("{} must not be negative".format(string))
+        return value
+
+
+
+class WriteTracker(object):
+    """
+    Matches published sp commands with the GATT writes of the virtual SBricks.
+
+    A write resolves the latest pending command of its channel that it carries out. Older pending
+    commands of that channel were overwritten before reaching the radio, they count as coalesced.
+    Commands still pending when the run ends count as dropped.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # (sbrick_id, channel) -> [(publish time, expected frame)]
+        self._pending = {}
+        self.drive_latency = []
+        self.stop_latency = []
+        self.coalesced = 0
+        self.writes = 0
+
+
+    def expect_drive(self, sbrick_id, channel, direction, power, t):
+        key = (sbrick_id, int(channel, 16))
+        with self._lock:
+            self._pending.setdefault(key, []).append((t, (0x01, int(direction, 16), int(power, 16))))
+
+
+    def expect_stop(self, sbrick_id, channels, t):
+        with self._lock:
+            for channel in channels:
+                self._pending.setdefault((sbrick_id, int(channel, 16)), []).append((t, (0x00,)))
+
+
+    def on_write(self, sbrick_id, binary, t):
+        with self._lock:
+            self.writes += 1
+            opcode = binary[0]
+            if 0x01 == opcode:
+                for i in range(1, len(binary) - 2, 3):
+                    self._resolve((sbrick_id, binary[i]), (0x01, binary[i + 1], binary[i + 2]), t, self.drive_latency)
+            elif 0x00 == opcode:
+                for channel in binary[1:]:
+                    self._resolve((sbrick_id, channel), (0x00,), t, self.stop_latency)
+
+
+    def _resolve(self, key, frame, t, samples):
+        pending = self._pending.get(key)
+        if not pending:
+            return
+        for i in range(len(pending) - 1, -1, -1):
+            if pending[i][1] == frame:
+                samples.append(t - pending[i][0])
+                self.coalesced += i
+                del pending[:i + 1]
+                return
+
+
+    def unresolved(self):
+        """ Return (dropped drive commands, unmatched stop commands) """
+        drives = 0
+        stops = 0
+        with self._lock:
+            for pending in self._pending.values():
+                for t, frame in pending:
+                    if 0x01 == frame[0]:
+                        drives += 1
+                    else:
+                        stops += 1
+        return drives, stops
+
+
+
+class SimulatedClient(Thread):
+    def __init__(self, index, args, broker_port, sbrick_ids, tracker, start_event, stop_event, logger):
+        Thread.__init__(self)
+        self.setName('client_{}'.format(index))
+        self._index = index
+        self._args = args
+        self._broker_ip = args.broker_ip if args.broker_ip else '127.0.0.1'
+        self._broker_port = broker_port
+        self._sbrick_ids = sbrick_ids
+        self._tracker = tracker
+        self._start_event = start_event
+        self._stop_event = stop_event
+        self._logger = logger
+        self._random = random.Random(None if None == args.seed else args.seed + index)
+
+        self.published = {'drive': 0, 'stop': 0, 'rr': 0}
+        self.rr_latency = []
+        self.rr_timeouts = 0
+        self.rr_errors = 0
+
+
+    def _next(self, rate, now):
+        if rate <= 0:
+            return float('inf')
+        return now + self._random.expovariate(rate)
+
+
+    def run(self):
+        args = self._args
+        client = SbrickIpcClient(logger=self._logger, broker_ip=self._broker_ip, broker_port=self._broker_port,
+                                 name='sbrick_loadgen_{}'.format(self._index), loop=pyuv.Loop(), local_path=args.local_socket,
+                                 per_brick_topics=args.per_brick_topics, background=args.background_clients)
+        client.connect()
+        self._start_event.wait()
+
+        channels = ['{:02x}'.format(ch) for ch in range(args.channels)]
+        now = time.monotonic()
+        next_time = {
+            'drive': self._next(args.drive_rate, now),
+            'stop': self._next(args.stop_rate, now),
+            'rr': self._next(args.rr_rate, now)
+        }
+
+        while not self._stop_event.is_set():
+            action = min(next_time, key=next_time.get)
+            delay = next_time[action] - time.monotonic()
+            if delay > 0 and self._stop_event.wait(delay):
+                break
+
+            sbrick_id = self._random.choice(self._sbrick_ids)
+            if 'drive' == action:
+                channel = self._random.choice(channels)
+                direction = self._random.choice(['00', '01'])
+                power = '{:02x}'.format(self._random.randint(0x10, 0xff))
+                self._tracker.expect_drive(sbrick_id, channel, direction, power, time.monotonic())
+                client.publish_drive(sbrick_id=sbrick_id, channel=channel, direction=direction, power=power, exec_time=args.exec_time)
+                next_time['drive'] = self._next(args.drive_rate, next_time['drive'])
+            elif 'stop' == action:
+                channel_list = [self._random.choice(channels)]
+                self._tracker.expect_stop(sbrick_id, channel_list, time.monotonic())
+                client.publish_stop(sbrick_id=sbrick_id, channel_list=channel_list)
+                next_time['stop'] = self._next(args.stop_rate, next_time['stop'])
+            else:
+                start = time.monotonic()
+                response = json.loads(client.rr_get_adc(sbrick_id=sbrick_id, timeout=args.rr_timeout))
+                ret_code = response['ret_code']
+                if SbrickProtocol.CODE_ERR_TIMEOUT == ret_code:
+                    self.rr_timeouts += 1
+                elif SbrickProtocol.CODE_SUCCESS != ret_code:
+                    self.rr_errors += 1
+                else:
+                    self.rr_latency.append(time.monotonic() - start)
+                # a blocking request delays the schedule, do not burst to catch up
+                next_time['rr'] = self._next(args.rr_rate, time.monotonic())
+            self.published[action] += 1
+
+        client.disconnect()
+
+
+
+class ServerThread(Thread):
+    """ Run SbrickIpcServer on its own libuv (or asyncio) loop """
+
+    def __init__(self, logger, broker_ip, broker_port, transport, sbrick_ids, local_path=None, per_brick_topics=False, engine='pyuv', airtime=None):
+        Thread.__init__(self)
+        self.setName('server')
+        self._logger = logger
+        self._loop = AioLoop(logger=logger) if 'asyncio' == engine else pyuv.Loop()
+        self._server = SbrickIpcServer(logger, broker_ip, broker_port, self._loop, transport=transport, local_path=local_path,
+                                       per_brick_topics=per_brick_topics, airtime=airtime)
+        self._sbrick_ids = sbrick_ids
+        self._stop_async = uv_for(self._loop).Async(self._loop, self._on_stop)
+        self.ready = Event()
+
+
+    def run(self):
+        self._server.connect(self._sbrick_ids)
+        self.ready.set()
+        self._loop.run()
+
+
+    def _on_stop(self, handle):
+        self._server.disconnect()
+        handle.close()
+        self._loop.stop()
+
+
+    def stop(self):
+        # libuv loops are not thread-safe, wake the server loop to stop itself
+        self._stop_async.send()
+        self.join()
+
+
+
+def percentile(samples, p):
+    """ Nearest-rank percentile, p in 0 ~ 100 """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, int(math.ceil(p / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(samples):
+    ms = lambda v: None if None == v else round(v * 1000.0, 3)
+    return {
+        'count': len(samples),
+        'p50_ms': ms(percentile(samples, 50)),
+        'p99_ms': ms(percentile(samples, 99)),
+        'p999_ms': ms(percentile(samples, 99.9)),
+        'max_ms': ms(max(samples) if samples else None)
+    }
+
+
+def set_logger(level):
+    logger = logging.getLogger('SBrick_Loadgen')
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(fmt=LOG_FORMAT))
+    logger.setLevel(level)
+    logger.addHandler(stream_handler)
+    return logger
+
+
+def print_report(report):
+    print('duration {duration_s} s, clients {clients}, sbricks {sbricks}'.format(**report))
+    published = report['published']
+    for action in ('drive', 'stop', 'rr'):
+        print('published {:<6} {:>8} ({:.1f}/s)'.format(action, published[action], published[action] / report['duration_s']))
+    print('gatt writes      {:>8} ({:.1f}/s)'.format(report['gatt_writes'], report['gatt_writes'] / report['duration_s']))
+    for name in ('drive_to_write', 'stop_to_write', 'rr_round_trip'):
+        s = report[name]
+        print('{:<16} n={:<7} p50={} ms p99={} ms p999={} ms max={} ms'.format(name, s['count'], s['p50_ms'], s['p99_ms'], s['p999_ms'], s['max_ms']))
+    print('coalesced {coalesced}, dropped {dropped}, stop_unmatched {stop_unmatched}, rr_timeouts {rr_timeouts}, rr_errors {rr_errors}'.format(**report))
+
+
+
+if __name__ == '__main__':
+
+    args = LoadArgParse().parse_args()
+    logger = set_logger(getattr(logging, args.log_level.upper(), logging.WARNING))
+
+    broker = None
+    broker_ip = args.broker_ip
+    broker_port = args.broker_port
+    if None == broker_ip:
+        broker = MqttBroker(port=0, logger=logger)
+        broker.start()
+        broker_ip = '127.0.0.1'
+        broker_port = broker.port
+
+    tracker = WriteTracker()
+    transport = VirtualTransport(latency=args.write_latency / 1000.0, failure_rate=args.failure_rate,
+                                 seed=args.seed, on_write=tracker.on_write)
+    sbrick_ids = virtual_macs(args.sbricks)
+
+    server = ServerThread(logger, broker_ip, broker_port, transport, sbrick_ids, local_path=args.local_socket,
+                          per_brick_topics=args.per_brick_topics, engine=args.engine,
+                          airtime=AirtimeScheduler(args.airtime_slots) if args.airtime_slots > 0 else None)
+    server.start()
+    server.ready.wait()
+
+    start_event = Event()
+    stop_event = Event()
+    clients = [SimulatedClient(i, args, broker_port, sbrick_ids, tracker, start_event, stop_event, logger) for i in range(args.clients)]
+    for client in clients:
+        client.start()
+
+    # give every client time to connect before the clock starts
+    time.sleep(0.5)
+    start = time.monotonic()
+    start_event.set()
+    try:
+        time.sleep(args.duration)
+    except KeyboardInterrupt:
+        pass
+    stop_event.set()
+    duration = time.monotonic() - start
+    for client in clients:
+        client.join()
+
+    time.sleep(args.drain)
+    dropped, stop_unmatched = tracker.unresolved()
+    gatt_writes = tracker.writes
+    server.stop()
+    if broker:
+        broker.stop()
+
+    report = {
+        'duration_s': round(duration, 3),
+        'clients': args.clients,
+        'sbricks': args.sbricks,
+        'published': {action: sum(c.published[action] for c in clients) for action in ('drive', 'stop', 'rr')},
+        'gatt_writes': gatt_writes,
+        'drive_to_write': summarize(tracker.drive_latency),
+        'stop_to_write': summarize(tracker.stop_latency),
+        'rr_round_trip': summarize([v for c in clients for v in c.rr_latency]),
+        'coalesced': tracker.coalesced,
+        'dropped': dropped,
+        'stop_unmatched': stop_unmatched,
+        'rr_timeouts': sum(c.rr_timeouts for c in clients),
+        'rr_errors': sum(c.rr_errors for c in clients)
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
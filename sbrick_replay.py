@@ -0,0 +1,180 @@
+import sys
+import math
+import time
+import logging
+import argparse
+from threading import Thread, Event
+
+from lib.sbrick_trace import read_trace, TRACE_WRITE, TRACE_READ
+
+LOG_FORMAT = "%(asctime)s [%(filename)s:%(lineno)s(%(levelname)s)] %(threadName)s - %(message)s"
+
+
+class ReplayArgParse(object):
+    def __init__(self):
+        self._parser = argparse.ArgumentParser(description='Replay a trace recorded by sbrick_server.py --trace')
+        self._args = None
+
+
+    def parse_args(self):
+        parser = self._parser
+        parser.add_argument('trace', help='Trace file recorded by sbrick_server.py --trace')
+        parser.add_argument('--dump', action='store_true', help='Print the records and exit')
+        parser.add_argument('--speed', type=self._non_negative_validation, default=1.0, help='Replay speed factor, 2 replays twice as fast. 0 means as fast as possible. Default is 1')
+        parser.add_argument('--virtual', action='store_true', help='Replay against virtual SBricks instead of real ones')
+        parser.add_argument('--virtual-latency', type=self._non_negative_validation, default=0, metavar='MS', help='Latency of every virtual GATT write/read in milliseconds. Default is 0')
+        parser.add_argument('--sbrick-id', nargs='+', default=None, help='Only replay frames of these SBrick MACs')
+        parser.add_argument('--map', nargs='+', default=[], metavar='FROM=TO', help='Replay frames of SBrick FROM against SBrick TO')
+        parser.add_argument('--log-level', default='WARNING', help='Log verbose level. Default is WARNING. [DEBUG | INFO | WARNING | ERROR | CRITICAL]')
+        self._args = parser.parse_args()
+        return self._args
+
+
+    def _non_negative_validation(self, string):
+        value = float(string)
+        if value < 0:
+            raise argparse.ArgumentTypeError("{} must not be negative".format(string))
+        return value
+
+
+
+class BrickReplay(Thread):
+    """
+    Replay the frames of one SBrick in order. Writes are issued at their recorded offset from the
+    start of the trace (divided by speed); every read is compared with the recorded response.
+    """
+
+    def __init__(self, sbrick, records, t0, speed, start_event):
+        Thread.__init__(self)
+        self.setName('replay_' + sbrick.dev_mac)
+        self._sbrick = sbrick
+        self._records = records
+        self._t0 = t0
+        self._speed = speed
+        self._start_event = start_event
+        self.start_time = 0
+
+        self.writes = 0
+        self.reads = 0
+        self.mismatches = 0
+        self.failures = 0
+        self.lag = []
+        self.write_latency = []
+
+
+    def run(self):
+        self._start_event.wait()
+        start = self.start_time
+        for record in self._records:
+            if TRACE_WRITE == record.direction:
+                if self._speed > 0:
+                    due = start + (record.timestamp - self._t0) / self._speed
+                    delay = due - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    self.lag.append(max(0.0, time.monotonic() - due))
+                begin = time.monotonic()
+                if False == self._sbrick.rcc_char_write_ex(record.frame):
+                    self.failures += 1
+                self.write_latency.append(time.monotonic() - begin)
+                self.writes += 1
+            elif TRACE_READ == record.direction:
+                out = self._sbrick.rcc_char_read_ex()
+                self.reads += 1
+                if False == out:
+                    self.failures += 1
+                elif bytes(out)[:len(record.frame)] != record.frame:
+                    self.mismatches += 1
+
+
+    @property
+    def sbrick(self):
+        return self._sbrick
+
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, int(math.ceil(p / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def set_logger(level):
+    logger = logging.getLogger('SBrick_Replay')
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(fmt=LOG_FORMAT))
+    logger.setLevel(level)
+    logger.addHandler(stream_handler)
+    return logger
+
+
+
+if __name__ == '__main__':
+
+    args = ReplayArgParse().parse_args()
+    logger = set_logger(getattr(logging, args.log_level.upper(), logging.WARNING))
+
+    header, records = read_trace(args.trace)
+    if args.sbrick_id:
+        wanted = set(mac.upper() for mac in args.sbrick_id)
+        records = [r for r in records if r.dev_mac in wanted]
+
+    if args.dump:
+        print('capacity {capacity}, recorded {count}'.format(**header))
+        for record in records:
+            print(record)
+        sys.exit(0)
+
+    if not records:
+        print('No records to replay')
+        sys.exit(0)
+
+    mapping = dict(item.upper().split('=', 1) for item in args.map)
+    by_brick = {}
+    for record in records:
+        by_brick.setdefault(mapping.get(record.dev_mac, record.dev_mac), []).append(record)
+
+    if args.virtual:
+        from lib.sbrick_virtual import VirtualTransport
+        transport = VirtualTransport(latency=args.virtual_latency / 1000.0)
+    else:
+        from lib.sbrick_transport import BluepyTransport
+        transport = BluepyTransport()
+
+    from lib.sbrick_api import SbrickAPI
+    t0 = records[0].timestamp
+    start_event = Event()
+    replays = []
+    for dev_mac, brick_records in sorted(by_brick.items()):
+        sbrick = SbrickAPI(logger=logger, dev_mac=dev_mac, transport=transport)
+        sbrick.connect()
+        replays.append(BrickReplay(sbrick, brick_records, t0, args.speed, start_event))
+
+    for replay in replays:
+        replay.start()
+    start = time.monotonic()
+    for replay in replays:
+        replay.start_time = start
+    start_event.set()
+    for replay in replays:
+        replay.join()
+    elapsed = time.monotonic() - start
+
+    recorded = records[-1].timestamp - t0
+    lag = [v for r in replays for v in r.lag]
+    latency = [v for r in replays for v in r.write_latency]
+    writes = sum(r.writes for r in replays)
+    print('replayed {} writes and {} reads of {} SBricks in {:.3f} s (recorded span {:.3f} s, speed {})'.format(
+        writes, sum(r.reads for r in replays), len(replays), elapsed, recorded, args.speed if args.speed else 'max'))
+    print('write throughput {:.1f}/s'.format(writes / elapsed if elapsed > 0 else 0))
+    print('write latency  p50={:.3f} ms p99={:.3f} ms max={:.3f} ms'.format(
+        percentile(latency, 50) * 1000, percentile(latency, 99) * 1000, max(latency) * 1000 if latency else 0))
+    if lag:
+        print('schedule lag   p50={:.3f} ms p99={:.3f} ms max={:.3f} ms'.format(
+            percentile(lag, 50) * 1000, percentile(lag, 99) * 1000, max(lag) * 1000))
+    print('read mismatches {}, failures {}'.format(sum(r.mismatches for r in replays), sum(r.failures for r in replays)))
+
+    for replay in replays:
+        replay.sbrick.disconnect()
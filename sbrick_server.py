@@ -1,11 +1,11 @@
-import pyuv
 import signal
 import logging
 import argparse
 import re
 import sys
-from lib.sbrick_api import ScanAPI
-from lib.sbrick_m2mipc import SbrickIpcServer
+from lib.sbrick_profile import parse_profile
+from lib.sbrick_protocol import SBRICK_ID_PATTERN
+# bluepy, pyuv and paho are imported by the mode which needs them, --scan does not load MQTT
 
 LOG_FORMAT = "%(asctime)s [%(filename)s:%(lineno)s(%(levelname)s)] %(threadName)s - %(message)s"
 
@@ -27,7 +27,35 @@ class ServerArgParse(object):
         connect.add_argument('--broker-port', type=self._port_validation, default=1883, help='MQTT broker port. Default is 1883')
         connect.add_argument('--broker-user', type=self._user_validation, default=None, help='MQTT broker username. Default is None')
         connect.add_argument('--broker-passwd', type=self._passwd_validation, default=None, help='MQTT broker password. Default is None')
+        connect.add_argument('--local-socket', default=None, metavar='PATH', help='Also serve clients on this host over a Unix domain socket, bypassing the broker. Default is None (disabled)')
+        connect.add_argument('--per-brick-topics', action='store_true', help='Subscribe to sbrick/01/sp|rr/<action>/<sbrick_id> of the own SBricks only, instead of the shared topics')
         connect.add_argument('--sbrick-id', nargs='+', type=self._mac_validation, help='list of SBrick MAC to connect to')
+        connect.add_argument('--lazy-connect', action='store_true', help='Connect to a SBrick on its first command instead of at startup')
+        connect.add_argument('--adapter', nargs='+', type=self._adapter_validation, default=None, metavar='HCI', help='Spread the SBricks over these BLE adapters, e.g. hci0 hci1. Default is None (the default adapter)')
+        connect.add_argument('--max-links', type=self._count_validation, default=0, metavar='N', help='Keep at most N SBricks connected, idle ones are disconnected least recently used first and reconnect on demand. Default is 0 (unbounded)')
+        connect.add_argument('--airtime-slots', type=self._count_validation, default=0, metavar='N', help='Schedule GATT operations per adapter, N at a time: stops first, then drive refreshes, telemetry and discovery, with a token bucket per SBrick. Default is 0 (unscheduled)')
+        connect.add_argument('--airtime-budget', nargs=2, type=self._interval_validation, default=[20, 40], metavar=('RATE', 'BURST'), help='Token bucket of a SBrick under --airtime-slots: GATT operations per second and burst. Default is 20 40')
+        connect.add_argument('--latency-profile', nargs='+', type=self._latency_profile_validation, default=[], metavar='[MAC=]PROFILE', help='BLE connection interval requested on connect: drive, balanced, telemetry or MIN_MS:MAX_MS:LATENCY. MAC=PROFILE sets the profile of one SBrick. Default is None (keep the SBrick setting)')
+        connect.add_argument('--telemetry-rate', type=self._interval_validation, default=0, metavar='HZ', help='Sample voltage and temperature of every SBrick N times per second, published to sbrick/01/telemetry/<sbrick_id>. Default is 0 (only on rr/telemetry request)')
+        connect.add_argument('--telemetry-deadband', nargs=2, type=self._interval_validation, default=[0.05, 0.5], metavar=('VOLT', 'CELSIUS'), help='Publish a telemetry sample only when voltage or temperature moved this far. Default is 0.05 0.5')
+        connect.add_argument('--virtual-sbrick', type=self._count_validation, default=0, metavar='N', help='Connect to N virtual SBricks instead of real ones. MACs are generated unless --sbrick-id is given. Default is 0')
+        connect.add_argument('--virtual-latency', type=self._interval_validation, default=0, metavar='MS', help='Latency of every virtual GATT write/read in milliseconds. Default is 0')
+        connect.add_argument('--virtual-failure-rate', type=self._rate_validation, default=0, metavar='RATE', help='Probability (0~1) that a virtual GATT write/read drops the link. Default is 0')
+        connect.add_argument('--background-scan', action='store_true', help='Keep a registry of nearby SBricks, served over rr/get_scan')
+        connect.add_argument('--scan-window', type=self._interval_validation, default=5, metavar='SECONDS', help='Length of a background scan window. Default is 5')
+        connect.add_argument('--scan-interval', type=self._interval_validation, default=30, metavar='SECONDS', help='Start a background scan window every N seconds. Default is 30')
+        connect.add_argument('--scan-ttl', type=self._interval_validation, default=120, metavar='SECONDS', help='Forget SBricks not seen for N seconds. Default is 120')
+        connect.add_argument('--trace', default=None, metavar='FILE', help='Record every rcc frame to a memory-mapped ring buffer file. Default is None (disabled)')
+        connect.add_argument('--trace-size', type=self._size_validation, default=65536, metavar='RECORDS', help='Capacity of the --trace ring buffer in records. Default is 65536')
+        connect.add_argument('--governor', action='store_true', help='Scale down the drive power of SBricks approaching their thermal limit or with a sagging battery, by telemetry samples taken at least once per second')
+        connect.add_argument('--governor-thermal', nargs=2, type=self._interval_validation, default=[15, 3], metavar=('BAND', 'MARGIN'), help='--governor throttles from BAND degrees below the thermal limit down to --governor-min-scale at MARGIN degrees below it. Default is 15 3')
+        connect.add_argument('--governor-voltage', nargs=2, type=self._interval_validation, default=[6.0, 5.0], metavar=('KNEE', 'FLOOR'), help='--governor throttles from KNEE volts down to --governor-min-scale at FLOOR volts. Default is 6.0 5.0')
+        connect.add_argument('--governor-min-scale', type=self._rate_validation, default=0.4, metavar='SCALE', help='Lowest power multiplier (0~1) of --governor. Default is 0.4')
+        connect.add_argument('--journal', default=None, metavar='FILE', help='Journal the running channel commands to FILE and restore them after a crash, as soon as their SBrick reconnects. Default is None (disabled)')
+        connect.add_argument('--journal-sync', type=self._interval_validation, default=0.5, metavar='SECONDS', help='Append and fsync the --journal every N seconds, a crash loses at most that much. Default is 0.5')
+        connect.add_argument('--metrics-interval', type=self._interval_validation, default=0, help='Publish metrics to the retained sbrick/01/metrics topic every N seconds. Default is 0 (disabled)')
+        connect.add_argument('--metrics-http-port', type=self._port_validation, default=None, help='Serve Prometheus metrics on http://0.0.0.0:PORT/metrics. Default is None (disabled)')
+        connect.add_argument('--engine', choices=['pyuv', 'asyncio'], default='pyuv', help='Event loop of MQTT I/O, drive scheduling and rr handling. asyncio runs BLE I/O in an executor instead of a thread per channel. Default is pyuv')
         connect.add_argument('--log-level', type=self._log_level_validation, default='INFO', help='Log verbose level. Default is INFO. [DEBUG | INFO | WARNING | ERROR | CRITICAL]')
 
         scan = parser.add_argument_group('--scan')
@@ -54,6 +82,42 @@ class ServerArgParse(object):
             return port
 
 
+    def _interval_validation(self, string):
+        interval = float(string)
+        if interval < 0:
+            msg = "{} must not be negative".format(string)
+            raise argparse.ArgumentTypeError(msg)
+        else:
+            return interval
+
+
+    def _count_validation(self, string):
+        count = int(string)
+        if count < 0:
+            msg = "{} must not be negative".format(string)
+            raise argparse.ArgumentTypeError(msg)
+        else:
+            return count
+
+
+    def _size_validation(self, string):
+        size = int(string)
+        if size < 1:
+            msg = "{} must be positive".format(string)
+            raise argparse.ArgumentTypeError(msg)
+        else:
+            return size
+
+
+    def _rate_validation(self, string):
+        rate = float(string)
+        if rate < 0 or rate > 1:
+            msg = "{} is out of range (0~1)".format(string)
+            raise argparse.ArgumentTypeError(msg)
+        else:
+            return rate
+
+
     def _log_level_validation(self, string):
         levels = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
         if string.upper() in levels:
@@ -63,9 +127,29 @@ class ServerArgParse(object):
             raise argparse.ArgumentTypeError(msg)
 
 
+    def _adapter_validation(self, string):
+        result = re.match('^(?:hci)?([0-9]+)$', string)
+        if result:
+            return int(result.group(1))
+        else:
+            msg = "Adapter format error, expect hciN. {}".format(string)
+            raise argparse.ArgumentTypeError(msg)
+
+
+    def _latency_profile_validation(self, string):
+        mac, profile = string.split('=', 1) if '=' in string else (None, string)
+        try:
+            return (mac, parse_profile(profile))
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+
+
     def _mac_validation(self, string):
-        # TODO
-        return string
+        if SBRICK_ID_PATTERN.match(string):
+            return string
+        else:
+            msg = "SBrick MAC format error, expect XX:XX:XX:XX:XX:XX. {}".format(string)
+            raise argparse.ArgumentTypeError(msg)
     
     def _user_validation(self, string):
         return string
@@ -76,7 +160,7 @@ class ServerArgParse(object):
 
 
 def signal_cb(handle, num):
-    print("Receive SIGINT signal")
+    print("Receive {} signal".format(signal.Signals(num).name))
     loop.stop()
     server.disconnect()
 
@@ -107,14 +191,104 @@ if __name__ == '__main__':
 
     """ Connect or Scan SBrick """
     if args.connect:
-        loop = pyuv.Loop.default_loop()
+        from lib.sbrick_m2mipc import SbrickIpcServer
+        from lib.sbrick_metrics import SbrickMetrics, start_http_exporter
+        from lib.aio_uv import uv_for
+        if 'asyncio' == args.engine:
+            from lib.aio_uv import Loop
+            loop = Loop(logger=logger)
+        else:
+            import pyuv
+            loop = pyuv.Loop.default_loop()
 
-        signal_h = pyuv.Signal(loop)
-        signal_h.start(signal_cb, signal.SIGINT)
+        # Ctrl-C and systemctl stop (SIGTERM) both stop the channels before exiting, the journal restores nothing after either
+        signal_handles = []
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal_h = uv_for(loop).Signal(loop)
+            signal_h.start(signal_cb, signum)
+            signal_handles.append(signal_h)
         
-        server = SbrickIpcServer(logger, args.broker_ip, args.broker_port, loop, args.broker_user, args.broker_passwd)
-        server.connect(args.sbrick_id)
+        metrics = None
+        if args.metrics_interval > 0 or args.metrics_http_port:
+            metrics = SbrickMetrics()
+        if args.metrics_http_port:
+            start_http_exporter(metrics, args.metrics_http_port)
+
+        transport = None
+        sbrick_list = args.sbrick_id
+        if args.virtual_sbrick:
+            from lib.sbrick_virtual import VirtualTransport, virtual_macs
+            transport = VirtualTransport(latency=args.virtual_latency / 1000.0, failure_rate=args.virtual_failure_rate)
+            sbrick_list = args.sbrick_id if args.sbrick_id else virtual_macs(args.virtual_sbrick)
+
+        trace = None
+        if args.trace:
+            from lib.sbrick_trace import TraceRecorder
+            trace = TraceRecorder(args.trace, capacity=args.trace_size)
+
+        governor = None
+        if args.governor:
+            from lib.sbrick_governor import PowerGovernor
+            band, margin = args.governor_thermal
+            knee, floor = args.governor_voltage
+            governor = PowerGovernor(logger, thermal_band=band, thermal_margin=margin, voltage_knee=knee, voltage_floor=floor,
+                                     min_scale=args.governor_min_scale, metrics=metrics)
+
+        journal = None
+        if args.journal:
+            from lib.sbrick_journal import DriveJournal
+            journal = DriveJournal(args.journal, logger, sync_interval=args.journal_sync)
+
+        if None == transport:
+            from lib.sbrick_transport import BluepyTransport
+
+        pool = None
+        pools = None
+        adapters = None
+        if args.adapter:
+            # one transport (and pool) per adapter, the ShardManager picks one per SBrick
+            adapters = [transport.adapter(iface) if transport else BluepyTransport(iface) for iface in args.adapter]
+        if args.max_links:
+            from lib.sbrick_pool import SbrickConnectionPool
+            if adapters:
+                pools = [SbrickConnectionPool(args.max_links, logger, metrics=metrics, adapter='hci{}'.format(a.iface)) for a in adapters]
+            else:
+                pool = SbrickConnectionPool(args.max_links, logger, metrics=metrics)
+
+        airtime = None
+        airtimes = None
+        if args.airtime_slots:
+            from lib.sbrick_airtime import AirtimeScheduler
+            rate, burst = args.airtime_budget
+            if adapters:
+                airtimes = [AirtimeScheduler(args.airtime_slots, rate, burst, metrics=metrics, adapter='hci{}'.format(a.iface)) for a in adapters]
+            else:
+                airtime = AirtimeScheduler(args.airtime_slots, rate, burst, metrics=metrics)
+
+        scan_service = None
+        if args.background_scan:
+            from lib.sbrick_scan import ScanRegistry, ScanService
+            scan_transport = adapters if adapters else (transport if transport else BluepyTransport())
+            scan_service = ScanService(logger, scan_transport, ScanRegistry(ttl=args.scan_ttl),
+                                       window=args.scan_window, interval=args.scan_interval)
+
+        shards = None
+        if adapters:
+            from lib.sbrick_shard import ShardManager
+            shards = ShardManager(logger, adapters, pools, registry=scan_service.registry if scan_service else None, metrics=metrics,
+                                  airtimes=airtimes)
+
+        server = SbrickIpcServer(logger, args.broker_ip, args.broker_port, loop, args.broker_user, args.broker_passwd,
+                                 metrics=metrics, metrics_interval=args.metrics_interval, transport=transport, trace=trace,
+                                 scan_service=scan_service, lazy_connect=args.lazy_connect, pool=pool, shards=shards,
+                                 latency_profiles=dict(args.latency_profile), telemetry_rate=args.telemetry_rate,
+                                 telemetry_deadband=tuple(args.telemetry_deadband), local_path=args.local_socket,
+                                 per_brick_topics=args.per_brick_topics, airtime=airtime, journal=journal,
+                                 governor=governor)
+        # the loop runs while the SBricks connect, sbrick/01/status and systemd tell when they are ready
+        server.connect(sbrick_list, wait=False)
 
         loop.run()
     elif args.scan:
+        from lib.sbrick_api import ScanAPI
         ScanAPI().scan(timeout=10)
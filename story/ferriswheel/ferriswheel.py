@@ -1,12 +1,14 @@
 import time
 import sys
 import random
+from threading import Event
 from lib.sbrick_m2mipc import SbrickIpcClient
 
 # sbrick setting
 SBRICK_MAC = '88:6B:0F:23:7B:81'
 SBRICK_CHANNEL = '01'
 EXEC_TIME = 10    # seconds
+READY_TIMEOUT = 60    # seconds to wait for the server to connect to the SBrick
 
 def signal_cb(handl, num):
     print("Receive SIGINT signal")
@@ -14,9 +16,18 @@ def signal_cb(handl, num):
 
 if __name__ == '__main__':
 
-    client = SbrickIpcClient(broker_ip='127.0.0.1', broker_port=1883)
+    # the I/O thread keeps the MQTT connection alive while the wheel spins
+    client = SbrickIpcClient(broker_ip='127.0.0.1', broker_port=1883, background=True)
     client.connect()
 
+    # start as soon as the server reports the SBrick connected, drives to a SBrick still connecting are dropped
+    ready = Event()
+    client.subscribe_status(lambda status: status.get('bricks', {}).get(SBRICK_MAC) in ('ready', 'lazy') and ready.set())
+    if not ready.wait(READY_TIMEOUT):
+        print("SBrick {} is not ready".format(SBRICK_MAC))
+        client.disconnect()
+        sys.exit(1)
+
     # client.rr_get_adc(sbrick_id=SBRICK_MAC, timeout=10)
     # response = client.json_response
     
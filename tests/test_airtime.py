@@ -0,0 +1,140 @@
+"""
+AirtimeScheduler: the token bucket of every SBrick and the order waiting GATT operations are granted.
+
+    $ python3 -m unittest tests.test_airtime
+"""
+import time
+import unittest
+from threading import Thread, Lock
+
+from lib.sbrick_airtime import (AirtimeScheduler, BrickBudget, traffic, traffic_class,
+                                CLASS_STOP, CLASS_DRIVE, CLASS_TELEMETRY, CLASS_DISCOVERY)
+
+
+
+class BrickBudgetTest(unittest.TestCase):
+
+    def test_refill_up_to_burst(self):
+        budget = BrickBudget('A', rate=10, burst=5, now=100.0)
+        self.assertEqual(5, budget.tokens)
+        budget.tokens = 0
+        budget.refill(100.2)
+        self.assertAlmostEqual(2, budget.tokens)
+        budget.refill(200.0)
+        self.assertEqual(5, budget.tokens)
+
+
+
+class AirtimeSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        # the buckets do not refill within a test
+        self._scheduler = AirtimeScheduler(slots=1, rate=0.001, burst=2)
+        self._lock = Lock()
+        self._granted = []
+        self._threads = []
+
+
+    def tearDown(self):
+        for thread in self._threads:
+            thread.join(5)
+
+
+    def _use(self, sbrick_id, traffic_class=CLASS_DRIVE):
+        self._scheduler.release(self._scheduler.acquire(sbrick_id, traffic_class))
+
+
+    def _queue(self, sbrick_id, traffic_class):
+        """ Wait for the radio in a thread, the grant is recorded and released at once """
+        def run():
+            ticket = self._scheduler.acquire(sbrick_id, traffic_class)
+            with self._lock:
+                self._granted.append(sbrick_id)
+            self._scheduler.release(ticket)
+        thread = Thread(target=run)
+        thread.start()
+        self._threads.append(thread)
+        self._wait_waiting(len(self._threads))
+
+
+    def _wait_waiting(self, count, timeout=5):
+        deadline = time.monotonic() + timeout
+        while len(self._scheduler._waiting) < count:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+
+    def _granted_after(self, ticket):
+        self._scheduler.release(ticket)
+        for thread in self._threads:
+            thread.join(5)
+        return self._granted
+
+
+    def test_grant_takes_a_token(self):
+        self._use('A')
+        usage = self._scheduler.usage('A')[0]
+        self.assertAlmostEqual(1, usage['tokens'], places=2)
+        self.assertEqual((1, 0), (usage['granted']['drive'], usage['over_budget']))
+
+
+    def test_spent_budget_is_still_granted_when_nobody_waits(self):
+        for i in range(3):
+            self._use('A')
+        usage = self._scheduler.usage('A')[0]
+        self.assertEqual((3, 1), (usage['granted']['drive'], usage['over_budget']))
+
+
+    def test_traffic_class_goes_first(self):
+        held = self._scheduler.acquire('H', CLASS_DRIVE)
+        self._queue('discovery', CLASS_DISCOVERY)
+        self._queue('telemetry', CLASS_TELEMETRY)
+        self._queue('drive', CLASS_DRIVE)
+        self._queue('stop', CLASS_STOP)
+        self.assertEqual(['stop', 'drive', 'telemetry', 'discovery'], self._granted_after(held))
+
+
+    def test_sbrick_with_tokens_goes_before_a_spent_one(self):
+        self._use('A')
+        self._use('A')
+        held = self._scheduler.acquire('H', CLASS_DRIVE)
+        self._queue('A', CLASS_DRIVE)
+        self._queue('B', CLASS_DRIVE)
+        self._queue('C', CLASS_DRIVE)
+        # then the oldest first
+        self.assertEqual(['B', 'C', 'A'], self._granted_after(held))
+
+
+    def test_slots(self):
+        scheduler = AirtimeScheduler(slots=2)
+        first = scheduler.acquire('A', CLASS_DRIVE)
+        second = scheduler.acquire('B', CLASS_DRIVE)
+        self.assertEqual(2, scheduler.slots)
+        scheduler.release(first)
+        scheduler.release(second)
+
+
+    def test_forget(self):
+        self._use('A')
+        self._use('B')
+        self._scheduler.forget('A')
+        self.assertEqual(['B'], [usage['sbrick_id'] for usage in self._scheduler.usage()])
+
+
+    def test_adapter_label(self):
+        scheduler = AirtimeScheduler(adapter='hci1')
+        scheduler.release(scheduler.acquire('A', CLASS_STOP))
+        self.assertEqual('hci1', scheduler.usage()[0]['adapter'])
+
+
+    def test_traffic_decorator(self):
+        @traffic(CLASS_STOP)
+        def stop():
+            return traffic_class()
+        self.assertEqual(CLASS_STOP, stop())
+        self.assertEqual(CLASS_DISCOVERY, traffic_class())
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+"""
+rr/attach of a SBrick which cannot be connected: the request fails and leaves nothing behind, a
+later attach connects it.
+
+    $ python3 -m unittest tests.test_attach
+"""
+import json
+import time
+import unittest
+from threading import Lock
+
+from lib.sbrick_protocol import SbrickProtocol
+from lib.sbrick_virtual import VirtualTransport
+from tests.virtual_server import VirtualServer
+
+SBRICK_MAC = '02:00:00:00:00:01'
+ATTACHED_MAC = '02:00:00:00:00:02'
+
+
+
+class AttachTest(unittest.TestCase):
+
+    def setUp(self):
+        self._server = VirtualServer([SBRICK_MAC], telemetry_rate=10)
+        self._server.transport.device(ATTACHED_MAC)
+        self._client = self._server.client('attach')
+        self._lock = Lock()
+        self._states = []
+        self._client.subscribe_channel_state(self._on_state, ATTACHED_MAC)
+        self.assertTrue(self._server.wait_brick(SBRICK_MAC, 'ready'))
+
+
+    def tearDown(self):
+        self._server.close()
+
+
+    def _on_state(self, state):
+        with self._lock:
+            self._states.append(state)
+
+
+    def _attach(self):
+        return json.loads(self._client.rr_attach(ATTACHED_MAC, 5))['ret_code']
+
+
+    def test_attach_with_the_adapter_down_fails(self):
+        self._server.transport.up = False
+        self.assertEqual(SbrickProtocol.CODE_ERR_COMMON, self._attach())
+        self.assertTrue(self._server.wait_brick(ATTACHED_MAC, 'failed'))
+        self.assertEqual(1, self._server.status()['ready'])
+
+        time.sleep(0.3)
+        server = self._server.server
+        self.assertNotIn(ATTACHED_MAC, server._sbrick_map)
+        self.assertIsNone(server._telemetry.get(ATTACHED_MAC))
+        with self._lock:
+            self.assertEqual([], self._states)
+
+
+    def test_attach_again_once_the_adapter_is_up(self):
+        self._server.transport.up = False
+        self.assertEqual(SbrickProtocol.CODE_ERR_COMMON, self._attach())
+
+        self._server.transport.up = True
+        self.assertEqual(SbrickProtocol.CODE_SUCCESS, self._attach())
+        self.assertTrue(self._server.wait_brick(ATTACHED_MAC, 'ready'))
+        response = json.loads(self._client.rr_get_adc(ATTACHED_MAC, 5))
+        self.assertEqual(SbrickProtocol.CODE_SUCCESS, response['ret_code'])
+        self.assertIsNotNone(self._server.server._telemetry.get(ATTACHED_MAC))
+
+
+
+class BringUpTest(unittest.TestCase):
+
+    def _bring_up(self, wait):
+        transport = VirtualTransport()
+        transport.up = False
+        server = VirtualServer([SBRICK_MAC], transport=transport, wait=wait)
+        try:
+            self.assertTrue(server.wait_brick(SBRICK_MAC, 'failed'))
+            status = server.status()
+            self.assertEqual(('ready', 0, 1), (status['state'], status['ready'], status['total']))
+        finally:
+            server.close()
+
+
+    def test_unreachable_sbrick_is_failed(self):
+        self._bring_up(wait=False)
+
+
+    def test_unreachable_sbrick_is_failed_when_connected_first(self):
+        self._bring_up(wait=True)
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Power governor: a server brings a virtual SBrick up and throttles it once its temperature or its
+battery voltage leaves the band.
+
+    $ python3 -m unittest tests.test_governor
+"""
+import time
+import unittest
+from threading import Lock
+
+from lib.sbrick_governor import PowerGovernor
+from lib.sbrick_metrics import SbrickMetrics
+from tests.virtual_server import VirtualServer, quiet_logger
+
+SBRICK_MAC = '02:00:00:00:00:01'
+
+
+
+class GovernorTest(unittest.TestCase):
+
+    def setUp(self):
+        self._metrics = SbrickMetrics()
+        governor = PowerGovernor(quiet_logger(), metrics=self._metrics)
+        self._server = VirtualServer([SBRICK_MAC], metrics=self._metrics, governor=governor)
+        self._device = self._server.transport.device(SBRICK_MAC)
+        self._lock = Lock()
+        self._reports = []
+        self._server.client('governor').subscribe_governor(self._on_report, SBRICK_MAC)
+        self.assertTrue(self._server.wait_brick(SBRICK_MAC, 'ready'))
+
+
+    def tearDown(self):
+        self._server.close()
+
+
+    def _on_report(self, report):
+        if report:
+            with self._lock:
+                self._reports.append(report)
+
+
+    def _sample(self, kind, name):
+        for sample in self._metrics.snapshot()[kind]:
+            if name == sample['name'] and SBRICK_MAC == sample['labels'].get('sbrick'):
+                return sample['value']
+        return None
+
+
+    def _wait_throttled(self, reason, timeout=5):
+        """ The first report throttling for reason """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                for report in self._reports:
+                    if reason == report['reason'] and report['power_scale'] < 1.0:
+                        return report
+            time.sleep(0.05)
+        self.fail('not throttled for {} after {}s'.format(reason, timeout))
+
+
+    def _wait_full_power(self, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if 1.0 == self._sample('gauges', 'governor_power_scale'):
+                return
+            time.sleep(0.05)
+        self.fail('not at full power after {}s'.format(timeout))
+
+
+    def test_hot_sbrick_is_throttled(self):
+        self._wait_full_power()
+        self.assertIsNone(self._sample('counters', 'governor_throttles_total'))
+
+        # 9C into the 15C band below the 70C thermal limit
+        self._device.temperature = 64.0
+        report = self._wait_throttled('thermal')
+        self.assertLess(report['power_scale'], 1.0)
+        self.assertLess(self._sample('gauges', 'governor_power_scale'), 1.0)
+        self.assertEqual(1, self._sample('counters', 'governor_throttles_total'))
+
+
+    def test_sagging_battery_is_throttled(self):
+        self._wait_full_power()
+
+        self._device.voltage = 5.5
+        report = self._wait_throttled('voltage')
+        self.assertAlmostEqual(0.7, report['power_scale'], places=1)
+        self.assertLess(self._sample('gauges', 'governor_power_scale'), 1.0)
+        self.assertEqual(1, self._sample('counters', 'governor_throttles_total'))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+"""
+IngressDecoder: sp/drive and sp/stop payloads decoded into commands with pre-packed frames, or
+rejected with the reason counted by ingress_rejected_total.
+
+    $ python3 -m unittest tests.test_ingress_decoder
+"""
+import unittest
+
+from lib.sbrick_command import (IngressDecoder, DRIVE_FRAMES, BRAKE_FRAMES, drive_frame, brake_frame, scale_frame,
+                                REASON_NOT_OBJECT, REASON_BAD_SBRICK_ID, REASON_BAD_CHANNEL, REASON_BAD_DIRECTION,
+                                REASON_BAD_POWER, REASON_BAD_EXEC_TIME)
+
+SBRICK_MAC = '02:00:00:00:00:01'
+
+
+def _drive(**fields):
+    msg = {'sbrick_id': SBRICK_MAC, 'channel': '00', 'direction': '01', 'power': 'f0', 'exec_time': 5}
+    msg.update(fields)
+    return msg
+
+
+
+class FrameTest(unittest.TestCase):
+
+    def test_drive_frames(self):
+        self.assertEqual(b'\x01\x00\x01\xf0', drive_frame('00', '01', 'f0'))
+        self.assertEqual(b'\x01\x03\x00\xff', drive_frame('03', '00', 'FF'))
+        self.assertEqual(4 * 2 * 256, sum(len(powers) for directions in DRIVE_FRAMES.values() for powers in directions.values()))
+
+
+    def test_frames_are_shared(self):
+        # every spelling looks the same bytes object up
+        self.assertIs(drive_frame('02', '01', 'ab'), drive_frame('02', '01', 'AB'))
+        self.assertIs(DRIVE_FRAMES['02']['01']['ab'], drive_frame('02', '01', 'aB'))
+
+
+    def test_brake_frames(self):
+        self.assertEqual(b'\x00\x02', brake_frame('02'))
+        self.assertIs(BRAKE_FRAMES['01'], brake_frame('01'))
+
+
+    def test_scale_frame(self):
+        frame = drive_frame('01', '00', 'c8')
+        self.assertEqual(b'\x01\x01\x00\x64', scale_frame(frame, 0.5))
+        self.assertIs(frame, scale_frame(frame, 1.0))
+        self.assertEqual(b'\x01\x01\x00\x00', scale_frame(frame, 0))
+
+
+
+class DecodeDriveTest(unittest.TestCase):
+
+    def setUp(self):
+        self._decoder = IngressDecoder()
+
+
+    def _rejected(self, msg):
+        command, reason = self._decoder.decode_drive(msg)
+        self.assertIsNone(command)
+        return reason
+
+
+    def test_valid(self):
+        command, reason = self._decoder.decode_drive(_drive(sbrick_id='0a:0b:0c:0d:0e:0f', channel='03', power='Fe', exec_time=0.25))
+        self.assertIsNone(reason)
+        self.assertEqual(('0A:0B:0C:0D:0E:0F', '03', '01', 'fe', 0.25), (command.sbrick_id, command.channel, command.direction,
+                                                                          command.power, command.exec_time))
+        self.assertIs(DRIVE_FRAMES['03']['01']['fe'], command.frame)
+
+
+    def test_forever(self):
+        command, reason = self._decoder.decode_drive(_drive(exec_time=5566))
+        self.assertEqual(5566, command.exec_time)
+
+
+    def test_malformed(self):
+        self.assertEqual(REASON_NOT_OBJECT, self._rejected(None))
+        self.assertEqual(REASON_NOT_OBJECT, self._rejected(['00', '01']))
+        self.assertEqual(REASON_NOT_OBJECT, self._rejected('{"sbrick_id": "02:00:00:00:00:01"}'))
+        self.assertEqual(REASON_BAD_SBRICK_ID, self._rejected(_drive(sbrick_id=None)))
+        self.assertEqual(REASON_BAD_SBRICK_ID, self._rejected(_drive(sbrick_id='02:00:00:00:00')))
+        self.assertEqual(REASON_BAD_SBRICK_ID, self._rejected(_drive(sbrick_id='02-00-00-00-00-01')))
+        self.assertEqual(REASON_BAD_CHANNEL, self._rejected(_drive(channel=0)))
+        self.assertEqual(REASON_BAD_CHANNEL, self._rejected(_drive(channel=['00'])))
+        self.assertEqual(REASON_BAD_DIRECTION, self._rejected(_drive(direction=None)))
+        self.assertEqual(REASON_BAD_POWER, self._rejected(_drive(power={'value': 'f0'})))
+        self.assertEqual(REASON_BAD_POWER, self._rejected(_drive(power='0xf0')))
+        self.assertEqual(REASON_BAD_EXEC_TIME, self._rejected(_drive(exec_time='5')))
+        self.assertEqual(REASON_BAD_EXEC_TIME, self._rejected(_drive(exec_time=True)))
+        self.assertEqual(REASON_BAD_EXEC_TIME, self._rejected(_drive(exec_time=None)))
+
+
+    def test_out_of_range(self):
+        self.assertEqual(REASON_BAD_CHANNEL, self._rejected(_drive(channel='04')))
+        self.assertEqual(REASON_BAD_DIRECTION, self._rejected(_drive(direction='02')))
+        self.assertEqual(REASON_BAD_POWER, self._rejected(_drive(power='100')))
+        self.assertEqual(REASON_BAD_POWER, self._rejected(_drive(power='f')))
+        self.assertEqual(REASON_BAD_EXEC_TIME, self._rejected(_drive(exec_time=0)))
+        self.assertEqual(REASON_BAD_EXEC_TIME, self._rejected(_drive(exec_time=-1)))
+        self.assertEqual(REASON_BAD_EXEC_TIME, self._rejected(_drive(exec_time=float('inf'))))
+        self.assertEqual(REASON_BAD_EXEC_TIME, self._rejected(_drive(exec_time=float('nan'))))
+
+
+
+class DecodeStopTest(unittest.TestCase):
+
+    def setUp(self):
+        self._decoder = IngressDecoder()
+
+
+    def _rejected(self, msg):
+        command, reason = self._decoder.decode_stop(msg)
+        self.assertIsNone(command)
+        return reason
+
+
+    def test_valid(self):
+        command, reason = self._decoder.decode_stop({'sbrick_id': '02:00:00:00:00:0a', 'channels': ['03', '01', '03', '01']})
+        self.assertIsNone(reason)
+        self.assertEqual(('02:00:00:00:00:0A', ('03', '01')), (command.sbrick_id, command.channels))
+
+
+    def test_malformed(self):
+        self.assertEqual(REASON_NOT_OBJECT, self._rejected(42))
+        self.assertEqual(REASON_BAD_SBRICK_ID, self._rejected({'channels': ['00']}))
+        self.assertEqual(REASON_BAD_CHANNEL, self._rejected({'sbrick_id': SBRICK_MAC}))
+        self.assertEqual(REASON_BAD_CHANNEL, self._rejected({'sbrick_id': SBRICK_MAC, 'channels': '00'}))
+        self.assertEqual(REASON_BAD_CHANNEL, self._rejected({'sbrick_id': SBRICK_MAC, 'channels': []}))
+        self.assertEqual(REASON_BAD_CHANNEL, self._rejected({'sbrick_id': SBRICK_MAC, 'channels': ['00', None]}))
+
+
+    def test_out_of_range(self):
+        self.assertEqual(REASON_BAD_CHANNEL, self._rejected({'sbrick_id': SBRICK_MAC, 'channels': ['00', '04']}))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
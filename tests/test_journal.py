@@ -0,0 +1,148 @@
+"""
+DriveJournal: the record format, what a reopened journal restores and the compaction.
+
+    $ python3 -m unittest tests.test_journal
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from lib.sbrick_journal import DriveJournal, JOURNAL_MAGIC, RECORD, RECORD_DRIVE, RECORD_STOP
+from tests.virtual_server import quiet_logger
+
+SBRICK_MAC = '02:00:00:00:00:01'
+OTHER_MAC = '02:00:00:00:00:02'
+
+
+def _running(direction, power, deadline=None):
+    return {'running': True, 'direction': direction, 'power': power, 'deadline': deadline}
+
+
+STOPPED = {'running': False, 'direction': '00', 'power': '00', 'deadline': None}
+
+
+
+class DriveJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'drive.journal')
+        self._journals = []
+
+
+    def tearDown(self):
+        for journal in self._journals:
+            journal.close()
+        shutil.rmtree(self._dir)
+
+
+    def _open(self, compact_records=4096):
+        """ Open the journal, return it and what it restores. The tests flush, the writer thread does not """
+        journal = DriveJournal(self._path, quiet_logger(), sync_interval=60, compact_records=compact_records)
+        self._journals.append(journal)
+        return journal, journal.open()
+
+
+    def _reopen(self):
+        """ What the next run restores, as after a crash """
+        return self._open()[1]
+
+
+    def _records(self):
+        with open(self._path, 'rb') as f:
+            data = f.read()
+        self.assertTrue(data.startswith(JOURNAL_MAGIC))
+        return [RECORD.unpack_from(data, offset) for offset in range(len(JOURNAL_MAGIC), len(data), RECORD.size)]
+
+
+    def test_no_journal(self):
+        self.assertEqual({}, self._open()[1])
+        self.assertEqual([], self._records())
+
+
+    def test_record_format(self):
+        journal, restore = self._open()
+        journal.update(SBRICK_MAC, '02', _running('01', 'f0', 1234.5))
+        journal.update(SBRICK_MAC, '02', STOPPED)
+        journal.flush()
+        self.assertEqual(18, RECORD.size)
+        self.assertEqual([(b'\x02\x00\x00\x00\x00\x01', RECORD_DRIVE, 2, 1, 0xf0, 1234.5),
+                          (b'\x02\x00\x00\x00\x00\x01', RECORD_STOP, 2, 0, 0, 0.0)], self._records())
+
+
+    def test_unchanged_command_is_journaled_once(self):
+        journal, restore = self._open()
+        journal.update(SBRICK_MAC, '00', _running('01', 'f0'))
+        journal.update(SBRICK_MAC, '00', _running('01', 'f0'))
+        journal.flush()
+        self.assertEqual(1, len(self._records()))
+
+
+    def test_restore_running_commands(self):
+        journal, restore = self._open()
+        deadline = time.time() + 60
+        journal.update(SBRICK_MAC.lower(), '00', _running('01', 'f0'))
+        journal.update(SBRICK_MAC, '01', _running('00', '80', deadline))
+        journal.update(SBRICK_MAC, '02', _running('00', '40'))
+        journal.update(SBRICK_MAC, '02', STOPPED)
+        journal.update(OTHER_MAC, '03', _running('01', 'ff', time.time() - 1))
+        journal.flush()
+
+        restore = self._reopen()
+        self.assertEqual({SBRICK_MAC: [('00', '01', 'f0', None), ('01', '00', '80', deadline)]}, restore)
+
+
+    def test_reopen_compacts(self):
+        journal, restore = self._open()
+        journal.update(SBRICK_MAC, '00', _running('01', 'f0'))
+        journal.update(SBRICK_MAC, '01', _running('01', 'f0'))
+        journal.update(SBRICK_MAC, '01', STOPPED)
+        journal.flush()
+        self.assertEqual(3, len(self._records()))
+
+        self._reopen()
+        self.assertEqual([(b'\x02\x00\x00\x00\x00\x01', RECORD_DRIVE, 0, 1, 0xf0, 0.0)], self._records())
+
+
+    def test_torn_record_is_ignored(self):
+        journal, restore = self._open()
+        journal.update(SBRICK_MAC, '00', _running('01', 'f0'))
+        journal.flush()
+        with open(self._path, 'ab') as f:
+            f.write(RECORD.pack(b'\x02\x00\x00\x00\x00\x01', RECORD_DRIVE, 1, 1, 0xf0, 0.0)[:10])
+
+        self.assertEqual({SBRICK_MAC: [('00', '01', 'f0', None)]}, self._reopen())
+
+
+    def test_not_a_journal(self):
+        with open(self._path, 'wb') as f:
+            f.write(b'not a journal')
+        logger = quiet_logger()
+        journal = DriveJournal(self._path, logger, sync_interval=60)
+        self._journals.append(journal)
+        with self.assertLogs(logger, 'ERROR'):
+            self.assertEqual({}, journal.open())
+        self.assertEqual([], self._records())
+
+
+    def test_compaction(self):
+        journal, restore = self._open(compact_records=3)
+        for power in range(1, 5):
+            journal.update(SBRICK_MAC, '00', _running('01', '{:02x}'.format(power)))
+            journal.update(SBRICK_MAC, '01', STOPPED if power % 2 else _running('00', '10'))
+            journal.flush()
+        # 2 appended records and 2 pending ones: the last flush rewrote the file with the running channels
+        self.assertEqual([(b'\x02\x00\x00\x00\x00\x01', RECORD_DRIVE, 0, 1, 4, 0.0),
+                          (b'\x02\x00\x00\x00\x00\x01', RECORD_DRIVE, 1, 0, 0x10, 0.0)], self._records())
+
+        journal.update(SBRICK_MAC, '02', _running('00', '20'))
+        journal.flush()
+        self.assertEqual(3, len(self._records()))
+        self.assertEqual({SBRICK_MAC: [('00', '01', '04', None), ('01', '00', '10', None), ('02', '00', '20', None)]}, self._reopen())
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+"""
+A stopped server restores nothing from its --journal: sbrick_server.py is run with a virtual SBrick,
+drives a channel forever and is stopped by SIGTERM, as systemctl stop does.
+
+    $ python3 -m unittest tests.test_journal_shutdown
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import logging
+import tempfile
+import unittest
+import subprocess
+
+from lib.aio_uv import Loop as AioLoop
+from lib.mqtt_broker import MqttBroker
+from lib.sbrick_m2mipc import SbrickIpcClient
+from lib.sbrick_journal import DriveJournal
+from lib.sbrick_protocol import SbrickProtocol
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SBRICK_MAC = '02:00:00:00:00:01'
+
+
+def _logger():
+    logger = logging.getLogger('SBrick_Test')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    return logger
+
+
+def _restore(path):
+    """ Commands the journal at path would restore, read from a copy so path is left as it is """
+    copy = path + '.copy'
+    shutil.copy(path, copy)
+    journal = DriveJournal(copy, _logger())
+    try:
+        return journal.open()
+    finally:
+        journal.close()
+
+
+
+class JournalShutdownTest(unittest.TestCase):
+
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._journal = os.path.join(self._dir, 'drive.journal')
+        self._broker = MqttBroker(port=0)
+        self._broker.start()
+        # the asyncio engine, the signal handling of the server does not depend on libuv
+        self._server = subprocess.Popen([sys.executable, os.path.join(ROOT, 'sbrick_server.py'), '--connect',
+                                         '--broker-port', str(self._broker.port), '--virtual-sbrick', '1', '--sbrick-id', SBRICK_MAC,
+                                         '--journal', self._journal, '--journal-sync', '0.05', '--engine', 'asyncio',
+                                         '--log-level', 'WARNING'],
+                                        cwd=ROOT, stdout=subprocess.DEVNULL)
+        self._loop = AioLoop()
+        self._client = SbrickIpcClient(logger=_logger(), broker_port=self._broker.port, name='test_journal', loop=self._loop,
+                                       background=True)
+        self._client.connect()
+
+
+    def tearDown(self):
+        self._client.disconnect()
+        self._loop.close()
+        if None == self._server.poll():
+            self._server.kill()
+            self._server.wait()
+        self._broker.stop()
+        shutil.rmtree(self._dir)
+
+
+    def _wait_ready(self, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            response = json.loads(self._client.rr_get_adc(SBRICK_MAC, 1))
+            if SbrickProtocol.CODE_SUCCESS == response['ret_code']:
+                return
+            time.sleep(0.1)
+        self.fail('server not ready after {}s'.format(timeout))
+
+
+    def test_sigterm_restores_nothing(self):
+        self._wait_ready()
+        self._client.publish_drive(SBRICK_MAC, '00', '01', 'f0', 5566)
+        time.sleep(0.5)
+        # what a crash would leave: the forever drive
+        self.assertEqual({SBRICK_MAC: [('00', '01', 'f0', None)]}, _restore(self._journal))
+
+        self._server.send_signal(signal.SIGTERM)
+        self.assertEqual(0, self._server.wait(timeout=10))
+        self.assertEqual({}, _restore(self._journal))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
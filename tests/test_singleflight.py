@@ -0,0 +1,91 @@
+"""
+SingleFlight: identical rr requests in flight share one execution and its response.
+
+    $ python3 -m unittest tests.test_singleflight
+"""
+import unittest
+
+from lib.m2mipc import REQ_RESP_DONE
+from lib.sbrick_singleflight import SingleFlight, request_key
+
+
+
+class Session(object):
+    """ Records the responses of a ServerSession """
+
+    def __init__(self):
+        self.responses = []
+
+    def send_response(self, data, rr_status=REQ_RESP_DONE):
+        self.responses.append((data, rr_status))
+        return rr_status
+
+
+
+class RequestKeyTest(unittest.TestCase):
+
+    def test_fields_in_any_order_share_a_key(self):
+        self.assertEqual(request_key('get_adc', '{"sbrick_id": "02:00:00:00:00:01", "timeout": 5}'),
+                         request_key('get_adc', '{"timeout": 5, "sbrick_id": "02:00:00:00:00:01"}'))
+
+
+    def test_action_and_fields_tell_requests_apart(self):
+        msg = '{"sbrick_id": "02:00:00:00:00:01"}'
+        self.assertNotEqual(request_key('get_adc', msg), request_key('get_general', msg))
+        self.assertNotEqual(request_key('get_adc', msg), request_key('get_adc', '{"sbrick_id": "02:00:00:00:00:02"}'))
+
+
+    def test_no_json_object_has_no_key(self):
+        self.assertIsNone(request_key('get_adc', 'not json'))
+        self.assertIsNone(request_key('get_adc', '["02:00:00:00:00:01"]'))
+        self.assertIsNone(request_key('get_adc', None))
+
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    def setUp(self):
+        self._single_flight = SingleFlight()
+
+
+    def test_first_request_runs_the_others_join(self):
+        first, second, third = Session(), Session(), Session()
+        self.assertFalse(self._single_flight.join('key', first))
+        self.assertTrue(self._single_flight.join('key', second))
+        self.assertTrue(self._single_flight.join('key', third))
+        self.assertEqual((1, 2), (self._single_flight.in_flight(), self._single_flight.joined))
+        self.assertEqual([first, second, third], self._single_flight.finish('key'))
+
+
+    def test_keys_do_not_share(self):
+        self.assertFalse(self._single_flight.join('a', Session()))
+        self.assertFalse(self._single_flight.join('b', Session()))
+        self.assertEqual((2, 0), (self._single_flight.in_flight(), self._single_flight.joined))
+
+
+    def test_finished_key_runs_again(self):
+        self._single_flight.join('key', Session())
+        self._single_flight.finish('key')
+        self.assertEqual(0, self._single_flight.in_flight())
+        self.assertFalse(self._single_flight.join('key', Session()))
+        self.assertEqual([], self._single_flight.finish('unknown'))
+
+
+    def test_fan_out_answers_every_session_once(self):
+        sessions = [Session() for i in range(3)]
+        for session in sessions:
+            self._single_flight.join('key', session)
+        fan_out = SingleFlight.FanOut(self._single_flight, 'key')
+
+        self.assertEqual(REQ_RESP_DONE, fan_out.send_response('{"ret_code": 100}'))
+        self.assertEqual([[('{"ret_code": 100}', REQ_RESP_DONE)]] * 3, [session.responses for session in sessions])
+        self.assertEqual(0, self._single_flight.in_flight())
+
+        # a second response of the handler has nobody left to answer
+        fan_out.send_response('{"ret_code": 100}')
+        self.assertEqual(1, len(sessions[0].responses))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
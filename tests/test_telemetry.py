@@ -0,0 +1,154 @@
+"""
+Telemetry stream: the deadband of TelemetrySampler and the telemetry/<sbrick_id> publishes of a
+server bringing a virtual SBrick up.
+
+    $ python3 -m unittest tests.test_telemetry
+"""
+import time
+import unittest
+from threading import Lock
+
+from lib.sbrick_telemetry import TelemetrySampler
+from tests.virtual_server import VirtualServer, quiet_logger
+
+SBRICK_MAC = '02:00:00:00:00:01'
+
+
+
+class IdleSbrick(object):
+    """ A linked SBrick in an idle slot, sample_adc() returns sample """
+
+    def __init__(self, sample):
+        self.linked = True
+        self.sample = sample
+
+    def is_linked(self):
+        return self.linked
+
+    def is_busy(self):
+        return False
+
+    def idle_time(self):
+        return 0.5
+
+    def is_driving(self):
+        return False
+
+    def sample_adc(self):
+        return self.sample
+
+
+
+class DeadbandTest(unittest.TestCase):
+
+    def setUp(self):
+        self._sbrick = IdleSbrick((8.4, 30.0))
+        self._sbricks = {SBRICK_MAC: self._sbrick}
+        self._published = []
+        # not started: the tests take the samples
+        self._sampler = TelemetrySampler(quiet_logger(), self._sbricks.get, self._publish)
+        self._stream = self._sampler.subscribe(SBRICK_MAC, 10, 0.05, 0.5)
+
+
+    def _publish(self, sbrick_id, voltage, temperature):
+        self._published.append((sbrick_id, voltage, temperature))
+
+
+    def _sample(self, voltage, temperature):
+        self._sbrick.sample = (voltage, temperature)
+        self._sampler._sample(self._stream)
+
+
+    def test_first_sample_is_published(self):
+        self._sample(8.4, 30.0)
+        self.assertEqual([(SBRICK_MAC, 8.4, 30.0)], self._published)
+        self.assertEqual((1, 1), (self._stream.samples, self._stream.published))
+
+
+    def test_moves_within_the_deadband_are_dropped(self):
+        self._sample(8.4, 30.0)
+        self._sample(8.43, 30.4)
+        self._sample(8.37, 29.6)
+        self.assertEqual(1, len(self._published))
+        self.assertEqual((3, 1), (self._stream.samples, self._stream.published))
+
+
+    def test_voltage_or_temperature_past_the_deadband_is_published(self):
+        self._sample(8.4, 30.0)
+        self._sample(8.3, 30.0)
+        self._sample(8.3, 31.0)
+        self.assertEqual([(SBRICK_MAC, 8.4, 30.0), (SBRICK_MAC, 8.3, 30.0), (SBRICK_MAC, 8.3, 31.0)], self._published)
+
+
+    def test_deadband_is_measured_from_the_last_published_value(self):
+        # a slow drift is published once it adds up to the deadband
+        self._sample(8.4, 30.0)
+        self._sample(8.37, 30.0)
+        self._sample(8.34, 30.0)
+        self.assertEqual([(SBRICK_MAC, 8.4, 30.0), (SBRICK_MAC, 8.34, 30.0)], self._published)
+
+
+    def test_failed_sample_is_counted(self):
+        self._sbrick.sample = None
+        self._sampler._sample(self._stream)
+        self.assertEqual((0, 1), (self._stream.samples, self._stream.failures))
+        self.assertEqual([], self._published)
+
+
+    def test_unlinked_sbrick_is_deferred(self):
+        self._sbrick.linked = False
+        self._sample(8.4, 30.0)
+        self.assertEqual((0, 1), (self._stream.samples, self._stream.deferred))
+        self.assertIs(self._stream, self._sampler.get(SBRICK_MAC))
+
+
+    def test_removed_sbrick_is_unsubscribed(self):
+        del self._sbricks[SBRICK_MAC]
+        self._sample(8.4, 30.0)
+        self.assertIsNone(self._sampler.get(SBRICK_MAC))
+        self.assertEqual([], self._published)
+
+
+
+class TelemetryPublishTest(unittest.TestCase):
+
+    def setUp(self):
+        self._server = VirtualServer([SBRICK_MAC], telemetry_rate=10)
+        self._lock = Lock()
+        self._samples = []
+        self._server.client('telemetry').subscribe_telemetry(self._on_sample, SBRICK_MAC)
+
+
+    def tearDown(self):
+        self._server.close()
+
+
+    def _on_sample(self, sample):
+        with self._lock:
+            self._samples.append(sample)
+
+
+    def _wait_voltage(self, voltage, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._lock:
+                if any(abs(sample['voltage'] - voltage) < 0.01 for sample in self._samples):
+                    return True
+            time.sleep(0.05)
+        return False
+
+
+    def test_samples_of_a_brought_up_sbrick_are_published(self):
+        self.assertTrue(self._server.wait_brick(SBRICK_MAC, 'ready'))
+        self.assertTrue(self._wait_voltage(8.4))
+        with self._lock:
+            self.assertEqual(SBRICK_MAC, self._samples[0]['sbrick_id'])
+
+        # past the deadband
+        self._server.transport.device(SBRICK_MAC).voltage = 7.5
+        self.assertTrue(self._wait_voltage(7.5))
+
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+"""
+MQTT broker and SbrickIpcServer on virtual SBricks for the tests, run in-process the way
+`sbrick_server.py --connect --engine asyncio --virtual-sbrick N` runs them.
+"""
+import time
+import logging
+from threading import Thread, Lock
+
+from lib.aio_uv import Loop as AioLoop
+from lib.mqtt_broker import MqttBroker
+from lib.sbrick_m2mipc import SbrickIpcServer, SbrickIpcClient
+from lib.sbrick_virtual import VirtualTransport
+
+
+def quiet_logger():
+    logger = logging.getLogger('SBrick_Test')
+    if not logger.handlers:
+        logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+    return logger
+
+
+
+class VirtualServer(object):
+    """
+    Connects sbrick_list in the background as the daemon does, or before the loop runs when wait,
+    and records the retained status.
+    """
+
+    def __init__(self, sbrick_list, transport=None, wait=False, **server_kwargs):
+        self.transport = transport if transport else VirtualTransport()
+        for sbrick_id in sbrick_list:
+            self.transport.device(sbrick_id)
+        self.broker = MqttBroker(port=0)
+        self.broker.start()
+        self.loop = AioLoop(logger=quiet_logger())
+        self.server = SbrickIpcServer(quiet_logger(), '127.0.0.1', self.broker.port, self.loop, transport=self.transport, **server_kwargs)
+        self._clients = []
+        self._lock = Lock()
+        self._status = {}
+
+        self._thread = Thread(target=self._run, args=(sbrick_list, wait), name='server')
+        self._thread.start()
+        self.client('status').subscribe_status(self._on_status)
+
+
+    def _run(self, sbrick_list, wait):
+        self.server.connect(sbrick_list, wait=wait)
+        self.loop.run()
+
+
+    def _on_status(self, status):
+        with self._lock:
+            self._status = status
+
+
+    def client(self, name):
+        loop = AioLoop()
+        client = SbrickIpcClient(logger=quiet_logger(), broker_port=self.broker.port, name=name, loop=loop, background=True)
+        client.connect()
+        self._clients.append((client, loop))
+        return client
+
+
+    def status(self):
+        """ The last retained server status """
+        with self._lock:
+            return dict(self._status)
+
+
+    def brick_status(self, sbrick_id):
+        return self.status().get('bricks', {}).get(sbrick_id)
+
+
+    def wait_brick(self, sbrick_id, status, timeout=10):
+        """ Return True once the status topic reports sbrick_id as status """
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if status == self.brick_status(sbrick_id):
+                return True
+            time.sleep(0.05)
+        return False
+
+
+    def close(self):
+        for client, loop in self._clients:
+            client.disconnect()
+            loop.close()
+
+        def stop():
+            self.loop.stop()
+            self.server.disconnect()
+        self.loop.call_soon_threadsafe(stop)
+        self._thread.join()
+        self.loop.close()
+        self.broker.stop()